@@ -0,0 +1,267 @@
+"""
+功能：
+    服务器压力测试工具。在一台Linux机器上启动成百上千个无界面的机器人客户端（Bot），连接服务器、就绪、
+    在整局游戏中不断发送动作（随机的，或者按固定路线的），最后统计：
+        服务器每一轮tick+广播的耗时、每个快照帧的字节数（只有由本工具在子进程中启动的本地服务器才有这两项）；
+        输入到回显的延迟：机器人发出一批动作，到收到ack_seq不小于该批序号的快照帧为止的时间（包括网络、服务器排队和广播间隔）。
+    用来估算一台服务器能承载多少局游戏，以及发现network.py、Game.update_by_dt的性能退化。
+    机器人和NetworkClient说同样的协议（TCP），但不需要游戏镜像和pygame窗口：
+        收到快照帧只回复ACK、记下ack_seq，不还原快照；服务器的PING照样回复PONG.
+    所有机器人由几个进程（--procs）分担，每个进程一个selectors事件循环驱动它负责的所有机器人。
+用法：
+    python bots.py --bots 200 --seconds 30                  # 在子进程中启动一个本地服务器，测试它
+    python bots.py --bots 200 --connect 192.168.1.2:17777   # 测试已经在运行的服务器（没有服务器端的统计）
+    python bots.py --bots 200 --map-seed 7                  # 本地服务器的每个房间都从同样的seed开始，测试可以重复
+    python bots.py --bots 200 --profile                     # 本地服务器开启性能分析，最后显示各阶段的耗时
+"""
+import argparse
+import collections
+import functools
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import sys
+import threading
+import time
+import numpy as np
+import game
+import network
+import profiler
+from game import Action
+
+
+class Bot:
+    """
+    一个无界面的机器人客户端，由run_bots的事件循环驱动。socket是阻塞的：只在可读时读取，发送的报文都很小。
+    pattern:
+        'random'，每批随机按下/松开1~3个方向；
+        'circle'，按右、下、左、上的顺序轮流转向（固定路线，便于重复测试）。
+    """
+    DIRS = 4
+
+    def __init__(self, address, rng, action_interval=0.1, pattern='random'):
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        network.send(self.socket, ['JOIN'])
+        self.reader = network.FrameReader()
+        self.rng = rng
+        self.action_interval = action_interval
+        self.pattern = pattern
+        self.id = None
+        self.mode = None        # 最近收到的服务器报文类型（MATCHING、PREPARING、GAMING...）
+        self.playing = False
+        self.ready = False
+        self.t_ready = 0.0
+        self.t_action = 0.0
+        self.seq = 0
+        self.step = 0
+        self.sent = collections.OrderedDict()   # 已发出、还没有回显的输入序号: 发出的时间。
+        ''' 统计 '''
+        self.latencies = []
+        self.n_frames = 0
+        self.n_batches = 0
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def send(self, data):
+        network.send(self.socket, data)
+
+    def read(self, t_now):
+        """ 读取并处理已到达的报文。对方断开时抛出ConnectionError. """
+        for msg in self.reader.read(self.socket):
+            self.handle(msg, t_now)
+
+    def handle(self, msg, t_now):
+        name = msg[0]
+        if name in ('MATCHING', 'PREPARING', 'GAMING'):
+            self.mode = name
+        if name == 'MATCHING':
+            self.id = msg[1]
+        elif name == 'PREPARING':
+            # 新的一局（或者一局结束后）重新就绪。
+            self.playing = False
+            self.ready = self.id is not None and self.id < len(msg[1]) and msg[1][self.id]
+            self.sent.clear()
+        elif name == 'GAMING':
+            tick, _, content = msg[1]
+            self.send(['ACK', tick])
+            self.n_frames += 1
+            self.playing = content['mode'] == 'RUNNING'
+            ack_seq = content['ack_seq']
+            while self.sent:
+                seq, t_sent = next(iter(self.sent.items()))
+                if seq > ack_seq:
+                    break
+                self.latencies.append(t_now - t_sent)
+                del self.sent[seq]
+        elif name == 'PING':
+            self.send(['PONG', msg[1], msg[2]])
+
+    def act(self, t_now):
+        """ 没就绪的话隔一会儿发一次READY；游戏中每隔action_interval秒（有随机抖动）发一批动作。 """
+        if not self.playing:
+            if self.mode == 'PREPARING' and not self.ready and t_now - self.t_ready >= 1.0:
+                self.t_ready = t_now
+                self.send(['READY'])
+            return
+        if t_now < self.t_action:
+            return
+        self.t_action = t_now + self.action_interval * self.rng.uniform(0.5, 1.5)
+        actions = []
+        if self.pattern == 'circle':
+            # 右、下、左、上 对应方向下标1、3、0、2.
+            order = (1, 3, 0, 2)
+            actions.append(Action(Action.MOVE_UNTURN, order[self.step % 4], self.id, self.id))
+            self.step += 1
+            actions.append(Action(Action.MOVE_TURN, order[self.step % 4], self.id, self.id))
+        else:
+            for _ in range(self.rng.randint(1, 3)):
+                _type = Action.MOVE_TURN if self.rng.random() < 0.5 else Action.MOVE_UNTURN
+                actions.append(Action(_type, self.rng.randrange(self.DIRS), self.id, self.id))
+        self.seq += 1
+        self.sent[self.seq] = t_now
+        self.send(['ACTIONS', self.seq, actions])
+        self.n_batches += 1
+
+    def close(self):
+        self.socket.close()
+
+
+def run_bots(address, n_bots, seconds, action_interval=0.1, pattern='random', seed=0):
+    """ 一个进程：连接n_bots个机器人，运行seconds秒，返回统计结果。 """
+    rng = random.Random(seed)
+    selector = selectors.DefaultSelector()
+    bots = []
+    for _ in range(n_bots):
+        bot = Bot(address, random.Random(rng.random()), action_interval, pattern)
+        selector.register(bot, selectors.EVENT_READ, bot)
+        bots.append(bot)
+    alive = set(bots)
+    t_end = time.perf_counter() + seconds
+    while alive and time.perf_counter() < t_end:
+        for key, _ in selector.select(0.005):
+            bot = key.data
+            try:
+                bot.read(time.perf_counter())
+            except (ConnectionError, OSError, ValueError):
+                selector.unregister(bot)
+                alive.discard(bot)
+        t_now = time.perf_counter()
+        for bot in list(alive):
+            try:
+                bot.act(t_now)
+            except OSError:
+                selector.unregister(bot)
+                alive.discard(bot)
+    for bot in bots:
+        bot.close()
+    selector.close()
+    return {'bots': n_bots,
+            'dropped': n_bots - len(alive),
+            'playing': sum(1 for bot in bots if bot.n_frames),
+            'frames': sum(bot.n_frames for bot in bots),
+            'bytes': sum(bot.reader.n_bytes for bot in bots),
+            'batches': sum(bot.n_batches for bot in bots),
+            'latencies': [t for bot in bots for t in bot.latencies]}
+
+
+def serve(address, n_players, pipe, verbose=False, map_seed=None, profile=False):
+    """
+    子进程：运行一个记录耗时和快照帧大小的本地服务器，收到停止命令后把记录发回。
+    map_seed不为None时，每个房间的游戏都从这个seed开始（之后每一局的seed由它依次决定）。
+    profile为True时开启性能分析，最后连同记录一起发回（最近profile_window秒的）。
+    """
+    if not verbose:
+        sys.stdout = open(os.devnull, 'w')
+    server = network.NetworkServer(address, functools.partial(game.Game, n_players, seed=map_seed))
+    server.t_work_log = []
+    server.frame_size_log = []
+    server.profiling = profile
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    pipe.send('READY')
+    pipe.recv()
+    server.mode.update('CLOSED')
+    thread.join()
+    pipe.send({'work': server.t_work_log, 'frame_sizes': server.frame_size_log, 'stats': server.stats(),
+               'profile': server.profile()})
+
+
+def percentiles(values, scale=1.0):
+    """ p50/p90/p99/max，没有数据时为None. """
+    if len(values) == 0:
+        return None
+    values = np.asarray(values, dtype=float) * scale
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': values.max(), 'n': len(values)}
+
+
+def report(name, stats, unit):
+    if stats is None:
+        print('%-22s 无数据' % name)
+        return
+    print('%-22s p50 %8.2f  p90 %8.2f  p99 %8.2f  max %8.2f  %s  (%d个样本)'
+          % (name, stats['p50'], stats['p90'], stats['p99'], stats['max'], unit, stats['n']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MazeAdventure服务器压力测试')
+    parser.add_argument('--bots', type=int, default=100, help='机器人数')
+    parser.add_argument('--seconds', type=float, default=20.0, help='测试时长（秒）')
+    parser.add_argument('--procs', type=int, default=max(1, min(4, (os.cpu_count() or 2) - 1)),
+                        help='运行机器人的进程数')
+    parser.add_argument('--players', type=int, default=2, help='每局的玩家数（本地服务器）')
+    parser.add_argument('--interval', type=float, default=0.1, help='每个机器人发送动作的平均间隔（秒）')
+    parser.add_argument('--pattern', choices=['random', 'circle'], default='random', help='动作：随机或固定路线')
+    parser.add_argument('--connect', default=None, help='测试已经在运行的服务器 host:port')
+    parser.add_argument('--port', type=int, default=17999, help='本地服务器的端口')
+    parser.add_argument('--seed', type=int, default=0, help='机器人动作的随机种子')
+    parser.add_argument('--map-seed', type=int, default=None, help='本地服务器生成地图和物品的随机种子')
+    parser.add_argument('--profile', action='store_true', help='本地服务器开启性能分析')
+    parser.add_argument('--verbose', action='store_true', help='显示本地服务器的输出')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    server_pipe = None
+    if args.connect:
+        host, port = args.connect.rsplit(':', 1)
+        address = (host, int(port))
+    else:
+        address = ('127.0.0.1', args.port)
+        server_pipe, child = ctx.Pipe()
+        ctx.Process(target=serve, args=(address, args.players, child, args.verbose, args.map_seed, args.profile),
+                    daemon=True).start()
+        server_pipe.recv()
+
+    n_procs = max(1, min(args.procs, args.bots))
+    counts = [args.bots // n_procs + (1 if i < args.bots % n_procs else 0) for i in range(n_procs)]
+    print('机器人：', args.bots, '进程：', n_procs, '时长(秒)：', args.seconds, '服务器：', address)
+    with ctx.Pool(n_procs) as pool:
+        results = pool.starmap(run_bots, [(address, n, args.seconds, args.interval, args.pattern, args.seed + i)
+                                          for i, n in enumerate(counts)])
+
+    server_result = None
+    if server_pipe is not None:
+        server_pipe.send('STOP')
+        server_result = server_pipe.recv()
+
+    frames = sum(r['frames'] for r in results)
+    print('进入游戏的机器人：', sum(r['playing'] for r in results), '断开：', sum(r['dropped'] for r in results))
+    print('收到的快照帧：', frames, '（每个机器人每秒 %.1f）' % (frames / max(1, args.bots) / args.seconds),
+          '收到的字节/秒：', round(sum(r['bytes'] for r in results) / args.seconds),
+          '发出的动作批：', sum(r['batches'] for r in results))
+    report('输入->回显延迟', percentiles([t for r in results for t in r['latencies']], 1000), 'ms')
+    if server_result is not None:
+        report('服务器每轮耗时', percentiles(server_result['work'], 1000), 'ms')
+        report('快照帧大小', percentiles(server_result['frame_sizes']), '字节')
+        stats = server_result['stats']
+        print('服务器 tick：', stats['ticks'], '追赶：', stats['overruns'], '丢弃的步数：', stats['skipped'])
+        if server_result['profile'] is not None:
+            print(profiler.report(server_result['profile']))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,8 +2,11 @@
 功能：
     定义游戏的基本逻辑。
 """
+import array
+import collections
 import pygame
 import random
+import secrets
 import numpy as np
 import threading
 import os
@@ -13,18 +16,45 @@ import copy
 
 class Map:
     """ 地图 'ROAD':1,'WALL':0 """
-    def __init__(self, rows_road, cols_road, width, density=0.97):
-        """ 矩阵的奇数列和行表示格挡物，偶数列和行表示可行地块。最外层为格挡物。 """
+    ID_CUR = 0
+
+    def __init__(self, rows_road, cols_road, width, density=0.97, seed=None):
+        """
+        矩阵的奇数列和行表示格挡物，偶数列和行表示可行地块。最外层为格挡物。
+        迷宫由自己的随机数生成器生成：同样的seed和参数（rows_road, cols_road, density）一定生成同样的迷宫，
+        所以客户端收到服务器的seed就能在本地重新生成。seed为None时用secrets随机选取（不可预测）。
+        """
+        # 每张地图都有独一无二的id。快照的差分只能在同一张地图之间进行。
+        self.id = Map.ID_CUR
+        Map.ID_CUR += 1
         self.rows_road = rows_road  # 可行地块的行数。
         self.cols_road = cols_road  # 可行地块的列数。
         self.rows = rows_road * 2 + 1
         self.cols = cols_road * 2 + 1
+        self.density = density
+        self.seed = secrets.randbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
         ''' 地图的0-1矩阵 '''
         self.maze = np.zeros((self.rows, self.cols), dtype=int)
-        ''' 地图上的物体容器(由外界进行初始化或更改) '''
-        self.objects = [[[] for _ in range(self.cols)] for _ in range(self.rows)]
-        ''' 地图上的标记容器(由外界进行初始化或更改) '''
-        self.marks = [[[] for _ in range(self.cols)] for _ in range(self.rows)]
+        '''
+        地图上的物体容器和标记容器(由外界进行初始化或更改)，用法是self.objects[r][c].
+        每行是一个defaultdict(list)：用到的地图块才有列表，大地图不必先建好几百万个空列表。
+        '''
+        self.objects = [collections.defaultdict(list) for _ in range(self.rows)]
+        self.marks = [collections.defaultdict(list) for _ in range(self.rows)]
+        '''
+        实体登记表：物品id -> 物品（放到过这张地图上的所有物品，包括已被拾取的，动作和事件只记录id），
+        以及地图块索引：物品id -> 它现在所在的地图块(r, c)（被拾取后删除）。都由add_object等函数维护。
+        '''
+        self.entities = dict()
+        self.object_cells = dict()
+        '''
+        物品和标记是地图上会变化的部分，每次更改都必须通过add_object等函数，让地图的版本号加1，
+        并记录被更改的地图块（脏块）及其版本号。这样只需要发送某个版本之后的脏块。
+        cell_revision按更改的先后排序（最近更改的在最后）。
+        '''
+        self.revision = 0
+        self.cell_revision = dict()
         ''' 地图生成 '''
         self.__generate_by_prim()
         self.__simplify(density=density)
@@ -32,51 +62,155 @@ class Map:
         ''' 多媒体材料（用于客户端和本地） '''
         self.materials = {'images': ['wall', 'road']}
 
-    def __get_neighbors(self,r,c,val):
-        """ get neighbors which value equals val. """
-        neighbors = set()
-        for dir in [[2, 0], [0, 2], [-2, 0], [0, -2]]:
-            rn, cn = r + dir[0], c + dir[1]
-            if 0 <= rn < self.rows and 0 <= cn < self.cols and self.maze[rn, cn] == val:
-                neighbors.add((rn,cn))
-        return neighbors
-
     def __generate_by_prim(self):
-        """ generate matrix using random prim algorithm. """
-        r_start = random.randint(0, self.rows_road - 1)*2+1
-        c_start = random.randint(0, self.cols_road - 1)*2+1
-        frontiers=set()
-        frontiers.add((r_start,c_start))
-        while frontiers:
-            # 第一步：当前树的周围集frontiers中随机找到一个节点，并接纳该节点到当前树。
-            r,c = random.choice(list(frontiers))
-            self.maze[r, c] = 1
-            # 第二步：该节点可能和当前树有多个边相连，随机选择其中一个边并连通。
-            edges=self.__get_neighbors(r,c,1)
-            if edges:
-                rp,cp= random.choice(list(edges))
-                self.maze[(r+rp)//2,(c+cp)//2]=1
-            # 第三步：将该节点的周围节点加入到周围集frontiers中，并把该节点从frontier删除。
-            frontiers=frontiers.union(self.__get_neighbors(r,c,0))
-            frontiers.remove((r,c))
+        """
+        generate matrix using random prim algorithm.
+        直接在展平的矩阵下标上进行：每个单元的状态放在一个bytearray里，上下左右的相邻地块是下标±2*cols和±2；
+        不是地块的单元（墙、边界）以及末尾多出的两行填充的状态都是3，所以边界上不需要判断越界
+        （第一行地块往上的下标是负数，从末尾的填充里取到3）。
+        周围集frontier是一个数组，随机取出一个节点时把它和最后一个交换再删除（O(1)），
+        总的时间和内存都和地块数成线性关系。最后一次性写入self.maze.
+        """
+        cols = self.cols
+        n = self.rows * cols
+        state = bytearray(b'\x03') * (n + 2 * cols)    # 0 未访问的地块，1 在周围集中，2 已在树中，3 不是地块。
+        for r in range(1, self.rows, 2):
+            state[r * cols + 1:(r + 1) * cols:2] = bytes(self.cols_road)
+        walls = array.array('q')    # 被打通的墙的下标。
+        random = self.rng.random
+        k_start = (self.rng.randint(0, self.rows_road - 1) * 2 + 1) * cols + self.rng.randint(0, self.cols_road - 1) * 2 + 1
+        frontier = array.array('q', [k_start])
+        state[k_start] = 1
+        steps = (-2 * cols, 2 * cols, -2, 2)
+        while frontier:
+            # 第一步：当前树的周围集frontier中随机找到一个节点，并接纳该节点到当前树。
+            i = int(random() * len(frontier))
+            k = frontier[i]
+            frontier[i] = frontier[-1]
+            frontier.pop()
+            state[k] = 2
+            # 第二步：将该节点周围未访问的节点加入到周围集frontier中；
+            # 第三步：该节点可能和当前树有多个边相连，随机选择其中一个边并连通（墙在两个地块的正中间）。
+            tree = []
+            for step in steps:
+                kn = k + step
+                if state[kn] == 0:
+                    state[kn] = 1
+                    frontier.append(kn)
+                elif state[kn] == 2:
+                    tree.append(kn)
+            if tree:
+                walls.append((k + tree[int(random() * len(tree))]) // 2)
+        maze = self.maze.reshape(-1)
+        maze[:] = np.frombuffer(state, dtype=np.uint8, count=n) == 2
+        maze[np.frombuffer(walls, dtype=np.int64)] = 1
 
     def __simplify(self, density=1.0):
         """
                 function: simplify maze by changing some walls to paths.
                 density means density of inner walls, where 0.0 means no wall.
+                在展平的bytearray副本上进行（比逐个读写numpy元素快得多），最后写回self.maze.
         """
         # 对于一棵树，内墙单元的个数=外墙内部总单元个数-最小生成树的节点和边的个数总和。
         n_inner_walls=(self.rows-2)*(self.cols-2)-(self.rows_road*self.cols_road*2-1)
         n_inner_walls_remove=int((1-density)*n_inner_walls)
+        if not n_inner_walls_remove:
+            return
+        cols = self.cols
+        maze = bytearray(self.maze.astype(np.uint8).tobytes())
+        random = self.rng.random
         while n_inner_walls_remove:
             # r=random.randint(0,self.rows-2)*2+2 错！这样会漏掉大量的墙。
-            r = random.randint(1, self.rows-2)
-            c = random.randint(1, self.cols-2)
+            k = (1 + int(random() * (self.rows - 2))) * cols + 1 + int(random() * (cols - 2))
             # 若该单元为墙，且不是角落。
-            if self.maze[r,c]==0 and (self.maze[r-1,c]==self.maze[r+1,c]==1
-                                      or self.maze[r,c-1]==self.maze[r,c+1]==1):
-                self.maze[r,c]=1
+            if maze[k]==0 and (maze[k-cols]==maze[k+cols]==1 or maze[k-1]==maze[k+1]==1):
+                maze[k]=1
                 n_inner_walls_remove-=1
+        self.maze.reshape(-1)[:] = np.frombuffer(maze, dtype=np.uint8)
+
+    def touch(self, r, c):
+        """ 地图块(r, c)的物品或标记发生了更改，版本号加1。 """
+        self.revision += 1
+        self.cell_revision.pop((r, c), None)
+        self.cell_revision[(r, c)] = self.revision
+
+    def add_object(self, r, c, obj):
+        self.objects[r][c].append(obj)
+        self.entities[obj.id] = obj
+        self.object_cells[obj.id] = (r, c)
+        self.touch(r, c)
+
+    def remove_object(self, r, c, obj):
+        self.objects[r][c].remove(obj)
+        self.object_cells.pop(obj.id, None)
+        self.touch(r, c)
+
+    def find_object(self, _id):
+        """ 按id查找地图上的物品，返回(物品, r, c)；不在地图上（不存在或已被拾取）时返回None. """
+        cell = self.object_cells.get(_id)
+        if cell is None:
+            return None
+        return self.entities[_id], cell[0], cell[1]
+
+    def add_mark(self, r, c, mark):
+        self.marks[r][c].append(mark)
+        self.touch(r, c)
+
+    def get_cells(self, since=0, window=None, viewer=None):
+        """
+        获取版本号since之后被更改过的所有地图块的完整内容（纯数据）：
+            {(r, c): (物品元组, 标记元组)}，
+            物品：(id, 名字, x, y, w, h)，标记：(id, 名字, x, y, w, h, visible_id).
+        从最近更改的地图块往前找，所以只和更改的数量有关，和地图大小无关。
+        window=(r0, r1, c0, c1)时只要窗口内的地图块；viewer不为None时只要该玩家可见的标记。
+        """
+        cells = dict()
+        for (r, c), revision in reversed(self.cell_revision.items()):
+            if revision <= since:
+                break
+            if window is None or (window[0] <= r < window[1] and window[2] <= c < window[3]):
+                cells[(r, c)] = self.__cell(r, c, viewer)
+        return cells
+
+    def get_cells_at(self, cells, viewer=None):
+        """ 获取指定地图块的完整内容（同get_cells）。从未被更改过的地图块一定是空的，不返回。 """
+        return {(r, c): self.__cell(r, c, viewer) for r, c in cells if (r, c) in self.cell_revision}
+
+    def __cell(self, r, c, viewer=None):
+        objects = tuple((obj.id, obj.name, obj.x, obj.y, obj.size[0], obj.size[1])
+                        for obj in self.objects[r][c])
+        marks = tuple((mark.id, mark.name, mark.x, mark.y, mark.size[0], mark.size[1], mark.visible_id)
+                      for mark in self.marks[r][c] if viewer is None or mark.visible_id in (-1, viewer))
+        return objects, marks
+
+    def clear_cells(self):
+        """ 清空地图上所有的物品和标记（迷宫不变），版本号归零。 """
+        self.objects = [collections.defaultdict(list) for _ in range(self.rows)]
+        self.marks = [collections.defaultdict(list) for _ in range(self.rows)]
+        self.entities.clear()
+        self.object_cells.clear()
+        self.revision = 0
+        self.cell_revision.clear()
+
+    def set_cells(self, cells):
+        """ get_cells()的逆操作：用地图块的完整内容覆盖本地的地图块。用于客户端的镜像。 """
+        for (r, c), (objects, marks) in cells.items():
+            for obj in self.objects[r][c]:
+                self.object_cells.pop(obj.id, None)
+            self.objects[r][c] = []
+            for _id, name, x, y, w, h in objects:
+                obj = Object(name, [x, y], [w, h])
+                obj.id = _id
+                self.objects[r][c].append(obj)
+                self.entities[_id] = obj
+                self.object_cells[_id] = (r, c)
+            self.marks[r][c] = []
+            for _id, name, x, y, w, h, visible_id in marks:
+                mark = Mark(name, [x, y], [w, h])
+                mark.id = _id
+                mark.visible_id = visible_id
+                self.marks[r][c].append(mark)
+            self.touch(r, c)
 
     def calc_path(self, pos_a, pos_b):
         """ calc shortest path between A and B using bfs. """
@@ -200,6 +334,8 @@ class Explorer(pygame.sprite.Sprite):
         self.crystals_found = dict()
         ''' 所受效果列表。对于每个效果：[类型名称，所剩时间]，用dt相减。 '''
         self.effects = []
+        ''' 是否在本客户端的视野内（服务器只发送视野内的其他玩家，见Game.view_snapshot） '''
+        self.visible = True
         ''' 图像和音轨（仅在客户端或本地会被调用） '''
         self.materials = {'images': ['explorerUp','explorerDown',
                                      'explorerLeft','explorerRight']}
@@ -300,6 +436,52 @@ class Explorer(pygame.sprite.Sprite):
                 else:
                     ith += 1
 
+    def get_state(self):
+        """
+        导出需要广播的人物状态（纯数据）。按部分划分，差分时只发送发生了变化的部分。
+        背包和效果只导出名字，客户端只需要名字就能绘制。
+        """
+        return {
+            'pos': (self.x, self.y),
+            'dir': tuple(self.direction) + (self.facial_orientation,),
+            'body': (self.width, self.height, self.v[0], self.v[1], self.fov),
+            'bag': tuple(obj.name if obj else None for obj in self.bag),
+            'crystals': tuple(self.crystals_found.keys()),
+            'effects': tuple((obj.name, obj.effect_name) for obj in self.effects),
+        }
+
+    def set_state(self, state):
+        """ 用get_state()导出的状态（可以只包含部分）更新自己。用于客户端的镜像。 """
+        if 'pos' in state:
+            self.x, self.y = state['pos']
+            self.pos = [self.x, self.y]
+        if 'dir' in state:
+            self.direction = list(state['dir'][:4])
+            self.facial_orientation = state['dir'][4]
+        if 'body' in state:
+            self.width, self.height, v0, v1, self.fov = state['body']
+            self.size = [self.width, self.height]
+            self.v = [v0, v1]
+        if 'bag' in state:
+            # 背包可能是完整的元组，也可能是差分得到的{格子下标: 名字}。
+            slots = state['bag']
+            if not isinstance(slots, dict):
+                self.bag_capacity = len(slots)
+                self.bag = [None for _ in range(self.bag_capacity)]
+                slots = dict(enumerate(slots))
+            for i, name in slots.items():
+                self.bag[i] = Object(name, [0, 0], [0, 0]) if name else None
+        if 'crystals' in state:
+            self.crystals_found = {name: 1 for name in state['crystals']}
+        if 'effects' in state:
+            self.effects = []
+            for name, effect_name in state['effects']:
+                obj = Object(name, [0, 0], [0, 0])
+                obj.effect_name = effect_name
+                self.effects.append(obj)
+        if 'visible' in state:
+            self.visible = bool(state['visible'])
+
 
 class Object(pygame.sprite.Sprite):
     INFO = {
@@ -372,7 +554,7 @@ class Object(pygame.sprite.Sprite):
             r = int(y/_map.width)
             c = int(x/_map.width)
             w = int(_map.width*0.3)
-            _map.marks[r][c].append(Mark('circle', [x,y], [w, w]))
+            _map.add_mark(r, c, Mark('circle', [x,y], [w, w]))
         elif self.name == 'cat':
             '''  猫咪产生直接永久效果：在地图上留个到最近有效宝石或目的地的脚印（对方不可见） '''
             pass
@@ -477,7 +659,12 @@ class Object(pygame.sprite.Sprite):
 
 
 class Mark:
+    ID_CUR = 0
+
     def __init__(self, name, pos, size):
+        # 和物品一样，每个标记都有独一无二的id，用于快照的差分。
+        self.id = Mark.ID_CUR
+        Mark.ID_CUR += 1
         # 类型/名称：rect, circle, footprint(暂略).
         self.name = name
         # 所在的位置和大小
@@ -519,9 +706,13 @@ class Action:
 
 
 class Game:
-    def __init__(self, n_players=1):
+    def __init__(self, n_players=1, seed=None):
         """
         游戏有自己的视野边框，与Interface中的显示框大小无关。
+        随机数：每局游戏有自己的随机数生成器rng（seed为None时随机选取），迷宫和物品的布局都由它决定，
+            同样的seed一定生成同样的一局（地图的seed也由它产生，见init_map）。
+            地图的seed会发给客户端，所以本局的seed必须猜不出来（64位，来自secrets），否则客户端可以离线穷举出
+            本局的seed，进而算出物品（水晶）的布局。
         游戏有自己的坐标系。坐标以self.map的范围为准，map左上角为(0,0).
         game_status: (只会用于game.py, 网络服务器或interface都只是媒介。)
             'map': map对象；
@@ -532,6 +723,8 @@ class Game:
         """
         self.mode = 'RUNNING'
         self.winner = -1
+        self.seed = secrets.randbits(64) if seed is None else seed
+        self.rng = random.Random(self.seed)
         # 互斥锁（为了实现线程安全。放在最前，因为后续初始化过程会用到。）
         self.lock = threading.Lock()
         # 离散地图
@@ -569,6 +762,16 @@ class Game:
         self.adjust_screen_style = 'stretch'
         # 音频通道列表。用于客户端播放音乐时候的控制。
         self.channels = dict()
+        # 客户端：最近一次同步到本地镜像的快照，以及镜像地图对应的服务器地图id（见apply_snapshot, load_map）。
+        self.__snapshot = None
+        self.__map_id = None
+        # 客户端预测：被预测的玩家（本客户端的玩家id，None表示不预测）、输入序号、输入日志[(序号, 转向动作, dt)]。
+        self.predict_id = None
+        self.input_seq = 0
+        self.input_log = []
+        self.n_input_log = 600
+        # 客户端：每个玩家的网络状况（见network.NetworkClient.net_status），绘制在头像旁边。
+        self.net_status = dict()
 
     def __call__(self, func, **kwargs):
         """ 重写魔法函数call(),方便在interface中对所有元素（地图、玩家等）同时调用某函数。"""
@@ -577,13 +780,14 @@ class Game:
         for explorer in self.explorers:
             func(explorer, **kwargs)
 
-    def reset(self, n_players=1):
-        self.__init__(n_players)
+    def reset(self, n_players=1, seed=None):
+        """ 开始新的一局。不指定seed时由本局的随机数生成器决定，所以从同一个seed开始的一连串对局都是确定的。 """
+        self.__init__(n_players, self.rng.getrandbits(64) if seed is None else seed)
 
     def init_map(self, rows_road, cols_road, width, density=0.97):
-        """ 生成地图 """
+        """ 生成地图（地图的seed由本局的随机数生成器决定） """
         with self.lock:
-            self.map = Map(rows_road, cols_road, width, density)
+            self.map = Map(rows_road, cols_road, width, density, seed=self.rng.getrandbits(64))
 
     def init_explores(self, mode, size, **kwargs):
         """
@@ -631,8 +835,8 @@ class Game:
                 for inum in range(num):
                     placed = False
                     while not placed:
-                        r = random.randint(1, self.map.rows - 2)
-                        c = random.randint(1, self.map.cols - 2)
+                        r = self.rng.randint(1, self.map.rows - 2)
+                        c = self.rng.randint(1, self.map.cols - 2)
                         if self.map.maze[r][c] > 0:
                             # 计算探险家的初始位置，确保物体生成位置与之不重合。
                             overlap = False
@@ -644,14 +848,14 @@ class Game:
                                     break
                             if not overlap:
                                 # 在选定的地图块上，再随机选择坐标（中心点）。
-                                ex = random.randint(size[0] // 2, self.map.width - size[0] // 2)
-                                ey = random.randint(size[1] // 2, self.map.width - size[1] // 2)
+                                ex = self.rng.randint(size[0] // 2, self.map.width - size[0] // 2)
+                                ey = self.rng.randint(size[1] // 2, self.map.width - size[1] // 2)
                                 x = ex + c * self.map.width
                                 y = ey + r * self.map.width
                                 # 是否为非一次性物品？
                                 depreciation = 100 if len(objects_list[name])<3 else objects_list[name][2]
                                 # 创建并添加
-                                self.map.objects[r][c].append(Object(name, [x, y], size, depreciation))
+                                self.map.add_object(r, c, Object(name, [x, y], size, depreciation))
                                 placed = True
 
     def selfmade_images(self):
@@ -712,33 +916,40 @@ class Game:
         ''' 
         改进：任何动作都是尝试性的！服务器必须先进行合法性检验然后才进行实质性更改。
         '''
+        # 客户端会把多帧的动作合并成一批发来，一个动作不合法时只放弃这个动作，继续处理后面的。
+        # i_explorer是发来这批动作的玩家：施加者只能是他自己；承受者也只能是自己，物品使用除外（可以对其他玩家使用）。
         with self.lock:
             if self.mode == 'GAMEOVER':
                 return
             for action in actions:
+                if action.applier != i_explorer or not 0 <= action.target < len(self.explorers) \
+                        or (action.type != Action.OBJ_USE and action.target != i_explorer):
+                    continue
                 # 游戏退出。(暂略）
                 #
                 applier = self.explorers[action.applier]
                 target = self.explorers[action.target]
-                # 尝试动作：人物转向。
+                # 尝试动作：人物转向。方向必须是合法的下标。
+                if action.type in (Action.MOVE_TURN, Action.MOVE_UNTURN) \
+                        and not 0 <= action.value < len(target.direction):
+                    continue
                 if action.type == Action.MOVE_TURN:
                     target.update_direction(action.value, 1)
                 elif action.type == Action.MOVE_UNTURN:
                     target.update_direction(action.value, 0)
-                # 尝试动作：物品拾取。value=obj, args=[r,c].
+                # 尝试动作：物品拾取。value=物品id, args=[r,c]（客户端看到的位置，以服务器的地图块索引为准）。
                 elif action.type == Action.OBJ_PICK:
-
-                    obj = action.value
-                    r, c = action.args
                     # 对于服务器，要拾取的物品是否还在地上？
-                    if obj not in self.map.objects[r][c]:
-                        return
+                    found = self.map.find_object(action.value)
+                    if found is None:
+                        continue
+                    obj, r, c = found
                     # 对于服务器，要拾取的物品是否在玩家的拾取范围内？
                     x = target.x
                     y = target.y
                     act_range = target.act_scale * min(target.size)/2
                     if (x-obj.x)**2+(y-obj.y)**2 > act_range**2:
-                        return
+                        continue
                     # 如果该物体是终点标记，且玩家对应的水晶足够，则赢取游戏。
                     if obj.name.startswith('destination'):
                         if len(applier.crystals_found) >= 3:
@@ -749,30 +960,32 @@ class Game:
                     elif obj.name.startswith('crystal'):
                         if obj.name not in applier.crystals_found:
                             applier.crystals_found[obj.name] = 1
-                            self.map.objects[r][c].remove(obj)
-                            # 构成了游戏事件通告。
+                            self.map.remove_object(r, c, obj)
+                            # 构成了游戏事件通告（value仍是物品id），然后存储。
                             self.events.append([action, 1.5])
                     # 如果该物体是其他，且玩家的背包未满，就拾取，否则放弃。
                     else:
                         if applier.update_bag(obj, 'add'):
-                            self.map.objects[r][c].remove(obj)
+                            self.map.remove_object(r, c, obj)
                 # 尝试动作：物品放置。
                 elif action.type == Action.OBJ_PLACE:
                     # 对于服务器，要放置的物品是否还在背包？
                     pass
                 # 尝试动作：物品使用。
                 elif action.type == Action.OBJ_USE:
+                    if not 0 <= action.value < len(applier.bag):
+                        continue
                     obj = applier.bag[action.value]
                     # 对于服务器，所要使用的物品是否还在背包？
                     if not obj:
-                        return
+                        continue
                     # 使用。然后计算物品的剩余寿命。
                     obj.use(target, self.map)
                     if obj.life_span <= 0:
                         self.explorers[action.applier].update_bag(action.value, mode='remove')
-                    # 如果是玩家间互相使用，则构成一个游戏事件通告,把物品位置换成物品，然后存储。
+                    # 如果是玩家间互相使用，则构成一个游戏事件通告,把背包格子换成物品id，然后存储。
                     if action.applier != action.target:
-                        action.value = obj
+                        action.value = obj.id
                         # 将[动作，持续时间]加入游戏事件通告列表。
                         self.events.append([action, 1.5])
 
@@ -783,17 +996,7 @@ class Game:
                 return
             # explorer移动。
             for i_explorer, explorer in enumerate(self.explorers):
-                w, h = explorer.width, explorer.height
-                # 计算可能的下一个位置。（尝试移动）
-                xn, yn = explorer.next_pos(dt)
-                # 如果位置不合法就缩小一下dt,依次尝试dt/2, dt/4, dt/8, ...。
-                if not self.map.valid_area('rect', [xn - w // 2, yn - h // 2, w, h]):
-                    xn, yn = explorer.next_pos(dt/2)
-                    if not self.map.valid_area('rect', [xn - w // 2, yn - h // 2, w, h]):
-                        xn, yn = explorer.next_pos(dt/4)
-                if self.map.valid_area('rect', [xn-w//2, yn-h//2, w, h]):
-                    explorer.x = xn
-                    explorer.y = yn
+                self.__move(explorer, dt)
 
             # 对于任何有时效的东西，都减去dt的时效。
             # 身上的effects，统一更新。
@@ -807,18 +1010,303 @@ class Game:
                 else:
                     i_event += 1
 
-    def get_status(self):
+    def __move(self, explorer, dt):
+        """ 让explorer按当前方向移动dt时间，不能穿过墙体。 """
+        w, h = explorer.width, explorer.height
+        # 计算可能的下一个位置。（尝试移动）
+        xn, yn = explorer.next_pos(dt)
+        # 如果位置不合法就缩小一下dt,依次尝试dt/2, dt/4, dt/8, ...。
+        if not self.map.valid_area('rect', [xn - w // 2, yn - h // 2, w, h]):
+            xn, yn = explorer.next_pos(dt/2)
+            if not self.map.valid_area('rect', [xn - w // 2, yn - h // 2, w, h]):
+                xn, yn = explorer.next_pos(dt/4)
+        if self.map.valid_area('rect', [xn-w//2, yn-h//2, w, h]):
+            explorer.x = xn
+            explorer.y = yn
+
+    def direction_actions(self, i_explorer):
+        """ 按本地的按键情况（dir_keys）生成每个方向的转向或停止转向动作，用于把按键状态完整地同步给服务器。 """
+        return [Action(Action.MOVE_TURN if held else Action.MOVE_UNTURN, i_dir, i_explorer, i_explorer)
+                for i_dir, held in enumerate(self.dir_keys)]
+
+    def opponent(self, i_explorer):
+        """ 玩家i_explorer的敌方（除他以外下标最小的玩家）的下标。只有一个玩家时返回None. """
+        for i in range(len(self.explorers)):
+            if i != i_explorer:
+                return i
+        return None
+
+    def predict(self, actions, dt):
+        """
+        客户端预测：不等服务器，先在本地镜像上执行自己的转向动作，并让自己移动dt时间。
+        每批动作分配一个输入序号（返回值，随动作一起发给服务器），并记入输入日志，
+        收到服务器的快照后，从快照中的位置开始重放服务器还没处理的输入（见reconcile）。
+        """
+        with self.lock:
+            if actions:
+                self.input_seq += 1
+            if self.predict_id is None or self.mode != 'RUNNING' or self.predict_id >= len(self.explorers):
+                return self.input_seq
+            moves = [(action.type, action.value) for action in actions
+                     if action.type in (Action.MOVE_TURN, Action.MOVE_UNTURN)]
+            self.__replay(self.explorers[self.predict_id], moves, dt)
+            self.input_log.append((self.input_seq, moves, dt))
+            # 日志只需要覆盖一个往返的时间，太旧的（服务器早已处理）直接丢弃。
+            if len(self.input_log) > self.n_input_log:
+                del self.input_log[:len(self.input_log) - self.n_input_log]
+            return self.input_seq
+
+    def __replay(self, explorer, moves, dt):
+        for _type, i_dir in moves:
+            explorer.update_direction(i_dir, 1 if _type == Action.MOVE_TURN else 0)
+        if dt > 0:
+            self.__move(explorer, dt)
+
+    def set_remote_positions(self, positions):
+        """
+        客户端：把其他玩家画在插值得到的位置上（见network.SnapshotBuffer），自己的玩家由预测决定，不受影响。
+        外推的位置可能会进到墙里，这种位置直接忽略。
+        """
+        with self.lock:
+            for i, (x, y) in positions.items():
+                if i == self.predict_id or i >= len(self.explorers) or not self.explorers[i].visible:
+                    continue
+                explorer = self.explorers[i]
+                w, h = explorer.width, explorer.height
+                if self.map.valid_area('rect', [x - w // 2, y - h // 2, w, h]):
+                    explorer.x, explorer.y = x, y
+
+    def __reconcile(self, snapshot):
+        """
+        服务器校正：把自己的位置和方向设为快照中的权威值，然后重放服务器还没处理的输入。
+        快照中的ack_seq是服务器最近处理的输入序号，ack_dt是处理之后服务器已经模拟的时间，
+        日志中这段时间的移动已经包含在快照里，需要跳过。
+        """
+        i = self.predict_id
+        if i is None or i >= len(self.explorers) or 'ack_seq' not in snapshot:
+            return
+        state = snapshot['explorers'][i]
+        explorer = self.explorers[i]
+        explorer.set_state({'pos': state['pos'], 'dir': state['dir']})
+        ack_seq, skip = snapshot['ack_seq'], snapshot['ack_dt']
+        while self.input_log and self.input_log[0][0] < ack_seq:
+            self.input_log.pop(0)
+        for seq, moves, dt in self.input_log:
+            if seq == ack_seq:
+                moves = []
+            used = min(skip, dt)
+            skip -= used
+            self.__replay(explorer, moves, dt - used)
+
+    def get_status(self, deep=True):
         """ 获取当前游戏中各元素的坐标和状态，并读取并清空在上个周期内发生的所有离散事件。 """
         ''' 主要是因为self.lock无法用pickle，同时get_status也是线程安全的。 '''
+        ''' deep=False时直接引用自身的元素，用于客户端绘制本地的镜像（不需要拷贝）。 '''
         with self.lock:
             status = dict()
             status['mode'] = self.mode
             status['winner'] = self.winner
+            if not deep:
+                status['map'] = self.map
+                status['explorers'] = self.explorers
+                status['events'] = self.events
+                return status
             status['map'] = copy.deepcopy(self.map)
             status['explorers'] = copy.deepcopy(self.explorers)
             status['events'] = copy.deepcopy(self.events)
             return status
 
+    def get_snapshot(self):
+        """
+        获取当前游戏的快照（纯数据，不含pygame对象），用于网络广播。
+        snapshot:
+            'map_id', 'mode', 'winner';
+            'revision': 地图（物品和标记）的版本号;
+            'explorers': 每个探险家的get_state();
+            'events': [(动作类型, 施加者, 承受者, 物品名字)].
+        迷宫矩阵每局只发送一次（get_map_info）。物品和标记不在快照里，按版本号发送脏块（get_map_cells）。
+        """
+        with self.lock:
+            events = []
+            for action, _ in self.events:
+                obj = self.event_object(action)
+                events.append((action.type, action.applier, action.target, obj.name if obj else ''))
+            snapshot = dict()
+            snapshot['map_id'] = self.map.id
+            snapshot['mode'] = self.mode
+            snapshot['winner'] = self.winner
+            snapshot['revision'] = self.map.revision
+            snapshot['explorers'] = [explorer.get_state() for explorer in self.explorers]
+            snapshot['events'] = events
+            return snapshot
+
+    def event_object(self, action):
+        """
+        游戏事件涉及的物品。服务器和单机的事件只记录物品id，在地图的实体登记表中查找；
+        客户端镜像从快照还原的事件里直接是只有名字的物品（见apply_snapshot）。
+        """
+        if isinstance(action.value, Object):
+            return action.value
+        return self.map.entities.get(action.value)
+
+    def get_map_info(self):
+        """ 地图的静态部分（生成迷宫的参数和seed，见Map），每局只需要发送一次。 """
+        with self.lock:
+            return {'id': self.map.id, 'rows_road': self.map.rows_road, 'cols_road': self.map.cols_road,
+                    'width': self.map.width, 'density': self.map.density, 'seed': self.map.seed}
+
+    def get_map_cells(self, since=0, window=None, viewer=None):
+        """ 地图版本号since之后的脏块，见Map.get_cells(). """
+        with self.lock:
+            return self.map.get_cells(since, window, viewer)
+
+    def get_map_cells_at(self, cells, viewer=None):
+        """ 指定地图块的完整内容，见Map.get_cells_at(). """
+        with self.lock:
+            return self.map.get_cells_at(cells, viewer)
+
+    def view_half(self):
+        """ 视野的半径（地图块数）：(rows_half, cols_half)，和draw_map绘制的范围一致。 """
+        return self.map_rows_per_height//2 + 1, int(self.map_rows_per_height*self.width_height_ratio/2) + 1
+
+    def view_window(self, pos, margin=1):
+        """ 以pos为中心的视野窗口，四周再加margin个地图块的余量：(r0, r1, c0, c1)，左闭右开。 """
+        rows_half, cols_half = self.view_half()
+        rows_half += margin
+        cols_half += margin
+        r_ctr = int(pos[1]) // self.map.width
+        c_ctr = int(pos[0]) // self.map.width
+        return (max(0, r_ctr-rows_half), min(self.map.rows, r_ctr+rows_half+1),
+                max(0, c_ctr-cols_half), min(self.map.cols, c_ctr+cols_half+1))
+
+    def view_snapshot(self, snapshot, i_explorer, window):
+        """
+        快照中玩家i_explorer能知道的部分（服务器对每个客户端分别过滤）：
+            窗口外的其他玩家只保留水晶进度（头像栏要用），并标记为不可见；窗口内的玩家完整发送。
+        地图块的过滤见get_map_cells的window和viewer参数。
+        """
+        explorers = []
+        for i, state in enumerate(snapshot['explorers']):
+            c = int(state['pos'][0]) // self.map.width
+            r = int(state['pos'][1]) // self.map.width
+            if i == i_explorer or (window[0] <= r < window[1] and window[2] <= c < window[3]):
+                explorers.append(dict(state, visible=1))
+            else:
+                explorers.append({'crystals': state['crystals'], 'visible': 0})
+        view = dict(snapshot)
+        view['explorers'] = explorers
+        return view
+
+    def load_map(self, info):
+        """ 客户端：用服务器发来的get_map_info()在本地重新生成同样的迷宫（物品和标记随后由脏块添加）。 """
+        with self.lock:
+            self.map = Map(info['rows_road'], info['cols_road'], info['width'], info['density'], seed=info['seed'])
+            self.__map_id = info['id']
+            self.__snapshot = None
+            self.input_log = []
+
+    def clear_map_cells(self):
+        """ 清空本地地图上的物品和标记（不重新生成迷宫），之后由完整的地图块重新填充。用于回放跳转到关键帧。 """
+        with self.lock:
+            self.map.clear_cells()
+            self.__snapshot = None
+            self.input_log = []
+
+    def apply_map_cells(self, map_id, cells):
+        """ 客户端：把服务器发来的脏块覆盖到本地的地图。脏块的内容是完整的，所以重复覆盖也没关系。 """
+        with self.lock:
+            if map_id != self.__map_id:
+                return
+            self.map.set_cells(cells)
+
+    @staticmethod
+    def diff_snapshot(base, cur):
+        """
+        计算快照cur相对于快照base的差分（delta）。两个快照必须来自同一张地图（map_id相同）。
+        delta:
+            'mode', 'winner': 总是发送（很小）；
+            'revision': 若地图版本号有变化则发送；
+            'explorers': {探险家下标: {发生变化的部分: 新值}}，背包按格子发送{格子下标: 名字}；
+            'events': 若有变化则发送整个列表。
+        没有变化的项不会出现在delta中。地图的脏块由服务器另外附加。
+        """
+        delta = {'mode': cur['mode'], 'winner': cur['winner']}
+        if cur['revision'] != base['revision']:
+            delta['revision'] = cur['revision']
+        explorers = dict()
+        for i, state in enumerate(cur['explorers']):
+            if i >= len(base['explorers']):
+                explorers[i] = dict(state)
+                continue
+            state_base = base['explorers'][i]
+            parts = dict()
+            for key, val in state.items():
+                val_base = state_base.get(key)
+                if val == val_base:
+                    continue
+                if key == 'bag' and val_base is not None and len(val) == len(val_base):
+                    parts[key] = {j: name for j, name in enumerate(val) if name != val_base[j]}
+                else:
+                    parts[key] = val
+            if parts:
+                explorers[i] = parts
+        if explorers:
+            delta['explorers'] = explorers
+        if cur['events'] != base['events']:
+            delta['events'] = cur['events']
+        return delta
+
+    @staticmethod
+    def patch_snapshot(base, delta):
+        """ diff_snapshot的逆操作：将delta作用于base，得到新的快照（不修改base）。 """
+        snapshot = {'map_id': base['map_id'], 'mode': delta['mode'], 'winner': delta['winner'],
+                    'revision': delta.get('revision', base['revision']),
+                    'events': delta.get('events', base['events'])}
+        explorers = list(base['explorers'])
+        for i, parts in sorted(delta.get('explorers', {}).items()):
+            if i >= len(explorers):
+                explorers.append(dict(parts))
+                continue
+            state = dict(explorers[i])
+            for key, val in parts.items():
+                if key == 'bag' and isinstance(val, dict):
+                    bag = list(state['bag'])
+                    for j, name in val.items():
+                        bag[j] = name
+                    val = tuple(bag)
+                state[key] = val
+            explorers[i] = state
+        snapshot['explorers'] = explorers
+        return snapshot
+
+    def apply_snapshot(self, snapshot):
+        """
+        客户端：把服务器发来的完整快照同步到本地的镜像（self.explorers等），然后就能直接绘制自己。
+        只对和上一次同步的快照相比发生了变化的部分进行修改。
+        地图由load_map和apply_map_cells同步，快照必须和本地地图属于同一局，否则忽略。
+        """
+        if snapshot is self.__snapshot or snapshot['map_id'] != self.__map_id:
+            return
+        base = self.__snapshot
+        if base is None:
+            base = {'mode': '', 'winner': -1, 'revision': 0, 'explorers': [], 'events': []}
+        delta = Game.diff_snapshot(base, snapshot)
+        with self.lock:
+            self.mode = delta['mode']
+            self.winner = delta['winner']
+            for i, parts in sorted(delta.get('explorers', {}).items()):
+                while len(self.explorers) <= i:
+                    self.explorers.append(Explorer([0, 0], [50, 50]))
+                self.explorers[i].set_state(parts)
+            self.n_players = len(self.explorers)
+            if 'events' in delta:
+                self.events = []
+                for _type, applier, target, name in delta['events']:
+                    value = Object(name, [0, 0], [0, 0]) if name else None
+                    self.events.append([Action(_type, value, applier, target), 0])
+            self.__reconcile(snapshot)
+        self.__snapshot = snapshot
+
     def draw_and_act(self, screen, status, resources, frame, main_player_id = 0):
         """
         draw:
@@ -891,11 +1379,6 @@ class Game:
                 mouse_clicked[event.button-1] = 1
             if event.type == pygame.MOUSEBUTTONUP:
                 mouse_clicked[event.button-1] = 2
-        # 校正本地的按键情况和服务器发来的主玩家的方向是否匹配，如果不匹配则需要重发转向动作！
-        if tuple(me.direction) != tuple(self.dir_keys):
-            for i, _direction in enumerate(self.dir_keys):
-                act_type = Action.MOVE_TURN if _direction == 1 else Action.MOVE_UNTURN
-                self.actions.append(Action(act_type, i, my_id, my_id))
 
         # 创建临时surface.
         surf = pygame.Surface(self.size)
@@ -933,8 +1416,7 @@ class Game:
             c_ctr = pos_me[0] // status['map'].width
             r_ctr = pos_me[1] // status['map'].width
             # 绘制以pos_center为中心的地图块。
-            rows_half = self.map_rows_per_height//2 + 1
-            cols_half = int(self.map_rows_per_height*self.width_height_ratio/2) + 1
+            rows_half, cols_half = self.view_half()
             # 绘制路面。
             for r in range(max(0, r_ctr-rows_half),
                            min(self.map.rows, r_ctr+rows_half+1)):
@@ -993,6 +1475,9 @@ class Game:
         # 绘制所有玩家（注意：玩家坐标和玩家图片左上角坐标的关系）。
         def draw_explorers():
             for i_explorer, explorer in enumerate(status['explorers']):
+                # 不在视野内的玩家（服务器没有发来它的位置）。
+                if not explorer.visible:
+                    continue
                 x = int(explorer.x - explorer.size[0]/2)
                 y = int(explorer.y - explorer.size[1]/2)
                 # 判断是否站立，若站立，图像没有动画。
@@ -1046,7 +1531,7 @@ class Game:
                     for c in range(max(0, c_ctr-1), min(c_ctr+2, status['map'].cols)):
                         for obj in status['map'].objects[r][c]:
                             if (me.x-obj.x)**2+(me.y-obj.y)**2 <= (me.act_scale * min(me.size)/2)**2:
-                                self.actions.append(Action(Action.OBJ_PICK, obj, my_id, my_id, r, c))
+                                self.actions.append(Action(Action.OBJ_PICK, obj.id, my_id, my_id, r, c))
                                 # 播放拾取音效。（即使拾取失败, 以本地判断为准。）
                                 resources.audios['pickOthers'].set_volume(0.15)
                                 resources.audios['pickOthers'].play()
@@ -1120,9 +1605,11 @@ class Game:
                             text_surface = font.render(msg, True, (255, 200, 255))
                             surf.blit(text_surface, [x_text+th*0.2, y_text+th*0.2])
                             # 如果同时还有右键松开，且obj不为空，就发送act.
-                            # 鼠标左键，给敌方(-1下标)使用。
+                            # 鼠标左键，给敌方使用（承受者必须是敌方真实的下标，服务器会丢弃越界的下标）。
                             if mouse_clicked[0] == 2:
-                                self.actions.append(Action(Action.OBJ_USE, i, my_id, -1))
+                                i_opponent = self.opponent(my_id)
+                                if i_opponent is not None:
+                                    self.actions.append(Action(Action.OBJ_USE, i, my_id, i_opponent))
                             # 鼠标右键，给自己使用。
                             if mouse_clicked[2] == 2:
                                 self.actions.append(Action(Action.OBJ_USE, i, my_id, my_id))
@@ -1151,7 +1638,22 @@ class Game:
                 if i == main_player_id:
                     pygame.draw.rect(surf, [50, 100, 50], [x-1, y-1, dw, dh], 3)
 
-                # 网速（略）
+                # 网络状况：RTT、丢包率；自己的还有抖动和收发速率。RTT越大颜色越红。
+                net = self.net_status.get(i)
+                if net:
+                    if net['rtt'] is None:
+                        msg, color = '--ms', [150, 150, 150]
+                    else:
+                        msg = str(net['rtt']) + 'ms'
+                        color = [80, 220, 80] if net['rtt'] < 100 else [230, 200, 60] if net['rtt'] < 200 else [230, 60, 60]
+                    if 'jitter' in net:
+                        msg += ' ±' + str(net['jitter']) + 'ms'
+                    msg += ' 丢包' + str(net['loss']) + '%'
+                    if 'in' in net:
+                        msg += ' 收%.1fK 发%.1fK' % (net['in'] / 1024, net['out'] / 1024)
+                    th = int(dh * 0.35)
+                    font = pygame.font.Font(resources.fonts['simhei'], th)
+                    surf.blit(font.render(msg, True, color), [x, y + dh + 2])
                 # 水晶拾取状态
                 gap_x = int(dw*0.2)
                 xx0 = x+dw+gap_x
@@ -1174,6 +1676,9 @@ class Game:
             x0 = (self.size[0] - w) / 2
             for i, _event in enumerate(status['events']):
                 action, time_remain = _event
+                obj = self.event_object(action)
+                if obj is None:
+                    continue
                 x = x0
                 y = y0 + i*h
                 # 通告的文本
@@ -1182,15 +1687,15 @@ class Game:
                 color_rect = [20,200,40]
                 if action.type == Action.OBJ_USE:
                     if action.applier == my_id:
-                        msg += '你给对方使用了'+Object.INFO[action.value.name][0]
+                        msg += '你给对方使用了'+Object.INFO[obj.name][0]
                     else:
-                        msg += '对方给你使用了'+Object.INFO[action.value.name][0]
+                        msg += '对方给你使用了'+Object.INFO[obj.name][0]
                         color_rect = [200,0,0]
                 elif action.type == Action.OBJ_PICK:
                     if action.applier == my_id:
-                        msg += '你收集到了'+Object.INFO[action.value.name][0]
+                        msg += '你收集到了'+Object.INFO[obj.name][0]
                     else:
-                        msg += '对方收集到了'+Object.INFO[action.value.name][0]
+                        msg += '对方收集到了'+Object.INFO[obj.name][0]
                         color_rect = [200,0,0]
                 # 绘制通告的边框
                 pygame.draw.rect(surf, color_rect, [x, y, w, h], 1)
@@ -5,6 +5,7 @@
 import pygame
 import os
 import threading
+import time
 import asyncio
 
 '''
@@ -179,6 +180,7 @@ class Interface:
 
     def bind_network(self, client):
         self.client = client
+        self.client.bind(self.game)
 
     def run(self):
         while self.mode != 'QUIT':
@@ -324,15 +326,27 @@ class Interface:
     def __run_game_online(self):
         # 子线程：让self.game_client不断获取广播，并发送events.
         threading.Thread(target=self.client.play, name='client_send').start()
+        # 本地镜像预测自己的玩家。
+        self.game.predict_id = self.client.id
 
         # 主线程：游戏渲染，并时时给客户端网络传去动作列表。
         while self.mode == 'GAMING_ONLINE':
             self.screen.fill((0, 0, 0))
-            self.game.draw_and_act(self.screen, self.client.message_list.get_whole()[1],
+            # 把收到的最新快照同步到本地的游戏镜像，然后绘制镜像。
+            self.game.apply_snapshot(self.client.snapshot)
+            # 其他玩家画在插值后的位置上，而不是跳到最新快照的位置。
+            self.game.set_remote_positions(self.client.buffer.sample(time.perf_counter()))
+            self.game.net_status = self.client.net_status()
+            self.game.draw_and_act(self.screen, self.game.get_status(deep=False),
                                    self.resources, self.frame, self.client.id)
-            # 如果game有用户操作，就让客户端发送。
+            # 重连、新地图或关键帧之后，把按着的方向键完整地发一次，让服务器那边的人物方向和本地按键一致。
+            if self.client.resync:
+                self.client.resync = False
+                self.game.actions.extend(self.game.direction_actions(self.client.id))
+            # 本地先预测自己的移动（不等服务器），如果game有用户操作，就带上输入序号放进客户端的发件箱。
+            seq = self.game.predict(self.game.actions, self.clock.get_time() / 1000)
             if self.game.actions:
-                self.client.events.update(['GAMING', self.game.actions])
+                self.client.post_actions(seq, list(self.game.actions))
             pygame.display.flip()
             if self.game.mode == 'GAMEOVER':
                 self.mode = 'GAMEOVER_ONLINE'
@@ -5,49 +5,310 @@
     （让不同的游戏可以复用该网络框架）
     NetworkServer:
         初始化：创建服务器socket,监听.
-        主线程：不断连接新的客户端。
-        线程：不断从每个客户端接收events，并立即更新game.
-        线程：以固定频率更新game，并广播给所有客户端。
+        事件循环（单线程，selectors）：连接新的客户端并分配到房间，从每个客户端接收events并立即更新所在房间的game，
+            以固定频率更新所有房间的game，并广播给房间内的客户端。
     NetworkClient:
         初始化：创建客户端socket.
         主线程：与服务器的连接、断开、重连。
         线程：向服务器发送events.
+    网络状况：两端都每秒向对方发送PING，统计每条连接的RTT、抖动、丢包率和收发速率（LinkStats）。
     备注：NetworkClient不应该实现interface的运行，而是interface中调用NetworkClient.
 """
 import socket
 import time
 import threading
 import copy
-from pickle import loads,dumps
 import selectors
+from struct import error as struct_error
+import collections
+import json
+import secrets
+import zlib
+import os
+import profiler
+import protocol
+import replay
+from game import Action
+
+
+HEADER_SIZE = 4     # 报文前缀：1个字节的报文格式版本号（最高位是压缩标志），3个字节（大端）表示报文长度。
+COMPRESSED = 0x80   # 前缀第一个字节的最高位：报文经过zlib压缩（见Compressor）。
+MAX_MESSAGE = 1 << 24   # 报文的最大字节数（长度字段3个字节），解压时也不允许超过。
+IOV_MAX = 1024      # 一次sendmsg最多提交的缓冲区数。
+UDP_MAX = 1200      # 走UDP的数据包的最大字节数（不超过常见的MTU，避免IP分片）。更大的快照帧仍然走TCP.
+SESSION_MAX = 64    # 新连接的第一个数据包（JOIN或RESUME）的最大字节数。
+
+
+def header(message, compressed=False):
+    """ 报文前缀。 """
+    return bytes([protocol.VERSION | (COMPRESSED if compressed else 0)]) + len(message).to_bytes(3, 'big')
+
+
+def pack(data):
+    """ 将数据编码（较大的报文自动压缩），返回[前缀, 报文]两段，交给sendmsg一次发出（不再拼接成一整段）。 """
+    message = protocol.encode(data)
+    message, compressed = compressor.compress(data[0], message)
+    return [header(message, compressed), message]
+
+
+def check_version(flags):
+    """ 检查前缀的第一个字节（去掉压缩标志后）是否为本程序的报文格式版本号。 """
+    if flags & ~COMPRESSED != protocol.VERSION:
+        raise ValueError('报文格式版本不一致：' + str(flags & ~COMPRESSED))
+
+
+def unpack(flags, message):
+    """ 按前缀的第一个字节，把报文（需要的话先解压）解码成数据。 """
+    if flags & COMPRESSED:
+        message = decompress(message)
+    return protocol.decode(message)
+
+
+def decompress(message):
+    """ 解压一个报文。数据损坏、不完整或者解压后超过MAX_MESSAGE时抛出ValueError. """
+    decompressor = zlib.decompressobj()
+    try:
+        message = decompressor.decompress(message, MAX_MESSAGE)
+    except zlib.error as e:
+        raise ValueError('报文解压失败：' + str(e))
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError('压缩的报文不完整或者过大')
+    return message
+
+
+def read_session(my_socket, buf):
+    """
+    读取新连接（非阻塞）发来的第一个数据包（JOIN或RESUME，见NetworkServer），只读到这个数据包的末尾，不多读。
+    buf是这个连接自己的bytearray，保存已收到的部分：数据包不完整时返回None，下次可读时接着读。
+    返回第一个报文。对方断开时抛出ConnectionError；版本不一致、数据包过大、报文格式不对或者不是JOIN/RESUME时抛出ValueError.
+    """
+    while True:
+        size = HEADER_SIZE
+        if len(buf) >= HEADER_SIZE:
+            check_version(buf[0])
+            size += int.from_bytes(buf[1:HEADER_SIZE], 'big')
+            if size > SESSION_MAX:
+                raise ValueError('第一个数据包过大：' + str(size))
+            if len(buf) == size:
+                break
+        try:
+            chunk = my_socket.recv(size - len(buf))
+        except (BlockingIOError, InterruptedError):
+            return None
+        if not chunk:
+            raise ConnectionError('连接已断开')
+        buf += chunk
+    data = unpack(buf[0], bytes(buf[HEADER_SIZE:]))
+    if data[0] not in ('JOIN', 'RESUME'):
+        raise ValueError('第一个报文不是JOIN或RESUME：' + data[0])
+    return data
 
 
 def send(my_socket, data):
-    """ 阻塞式发送数据: 以大端的方式，开头4个字节表示报文长度，后面跟着报文。"""
-    message = dumps(data)
-    message_length = len(message)
-    # 字节流的前四个字节表示剩下有效字节流的长度。
-    my_socket.sendall(message_length.to_bytes(4, 'big') + message)
+    """
+    阻塞式发送数据: 开头4个字节为前缀：1个字节的报文格式版本号，3个字节（大端）表示报文长度，后面跟着报文。
+    报文由protocol编码（二进制），不再使用pickle.
+    前缀和报文用sendmsg分散/聚集地一次发出，不为拼接而复制报文。（没有sendmsg的平台，如Windows，退回到sendall）
+    返回发送的字节数。
+    """
+    chunks = pack(data)
+    size = sum(len(chunk) for chunk in chunks)
+    if not hasattr(my_socket, 'sendmsg'):
+        my_socket.sendall(b''.join(chunks))
+        return size
+    chunks = [memoryview(chunk) for chunk in chunks]
+    while chunks:
+        consume(chunks, my_socket.sendmsg(chunks))
+    return size
+
+
+class Packet:
+    """ 已编码的数据包。同一个数据包发给多个客户端时只编码一次，各连接共享同一段字节。 """
+    __slots__ = ('name', 'chunks', 'size')
+
+    def __init__(self, data):
+        self.name = data[0]
+        self.chunks = pack(data)
+        self.size = sum(len(chunk) for chunk in self.chunks)
+
+
+class Compressor:
+    """
+    报文的自适应压缩（zlib，线程安全）。
+        编码后不小于threshold字节的报文（地图、关键帧等）才尝试压缩，压缩后确实变小才使用，并在前缀中置COMPRESSED标志；
+        每个tick的小差分不压缩。接收方总是能解压，所以发送方可以随时打开或关闭压缩（enabled）。
+        按报文类型分别统计压缩前后的字节数和耗时。某类报文最近window次压缩省下的字节比例不到min_saving，
+        或者每毫秒压缩时间省下的字节不到min_rate，就暂停压缩这类报文；之后每probe_every个报文再试一次，划算了再恢复。
+    """
+    def __init__(self, threshold=256, level=6, min_saving=0.1, min_rate=2000, window=16, probe_every=50):
+        self.enabled = True
+        self.threshold = threshold
+        self.level = level
+        self.min_saving = min_saving
+        self.min_rate = min_rate
+        self.window = window
+        self.probe_every = probe_every
+        self.lock = threading.Lock()
+        self.types = dict()     # 报文类型: 统计信息（见__info）。
+
+    def __info(self, name):
+        info = self.types.get(name)
+        if info is None:
+            info = {'n': 0, 'bytes_in': 0, 'bytes_out': 0, 'time': 0.0, 'paused': False, 'skipped': 0,
+                    'recent': collections.deque(maxlen=self.window)}
+            self.types[name] = info
+        return info
+
+    def __pays(self, samples):
+        """ 一组(压缩前字节数, 压缩后字节数, 耗时)是否划算。 """
+        n_in = sum(sample[0] for sample in samples)
+        saved = n_in - sum(sample[1] for sample in samples)
+        t = sum(sample[2] for sample in samples)
+        return saved >= self.min_saving * n_in and saved >= self.min_rate * t * 1000
+
+    def compress(self, name, message):
+        """ 返回(要发送的报文, 是否压缩)。 """
+        if not self.enabled or len(message) < self.threshold:
+            return message, False
+        with self.lock:
+            info = self.__info(name)
+            if info['paused']:
+                info['skipped'] += 1
+                if info['skipped'] % self.probe_every:
+                    return message, False
+        t_start = time.perf_counter()
+        compressed = zlib.compress(message, self.level)
+        sample = (len(message), min(len(compressed), len(message)), time.perf_counter() - t_start)
+        with self.lock:
+            info['n'] += 1
+            info['bytes_in'] += sample[0]
+            info['bytes_out'] += sample[1]
+            info['time'] += sample[2]
+            if info['paused']:
+                # 试探的一次划算了，就恢复压缩。
+                if self.__pays([sample]):
+                    info['paused'] = False
+                    info['recent'].clear()
+            else:
+                info['recent'].append(sample)
+                if len(info['recent']) == self.window and not self.__pays(info['recent']):
+                    info['paused'] = True
+                    info['skipped'] = 0
+        if len(compressed) >= len(message):
+            return message, False
+        return compressed, True
+
+    def stats(self):
+        """ 每类报文的压缩统计：压缩次数、压缩后/压缩前的字节比例、总耗时（毫秒）、是否暂停。 """
+        with self.lock:
+            return {name: {'n': info['n'],
+                           'ratio': round(info['bytes_out'] / info['bytes_in'], 3) if info['bytes_in'] else 1.0,
+                           'ms': round(info['time'] * 1000, 2),
+                           'paused': info['paused']}
+                    for name, info in self.types.items()}
+
+
+# 本进程发送报文时共用的压缩器。
+compressor = Compressor()
+
+
+def consume(chunks, n):
+    """ 从待发送的缓冲区列表chunks的开头去掉已发送的n个字节。 """
+    while n:
+        if n >= len(chunks[0]):
+            n -= len(chunks.pop(0))
+        else:
+            chunks[0] = chunks[0][n:]
+            n = 0
 
 
 def recv(my_socket):
-    """ 阻塞式完整地接收一个数据包，且不考虑任何数据的缺失、错误，相信TCP. """
-    # 阻塞式接收4个字节。
-    size_needed = 4
-    size_recv = 0
-    bytes_recv = b""
-    while size_recv < size_needed:
-        bytes_recv += my_socket.recv(size_needed - size_recv)
-        size_recv = len(bytes_recv)
-    size_needed = int.from_bytes(bytes_recv, 'big')
-    size_recv = 0
-    bytes_recv = b""
-    # 阻塞式接收剩下的数据。
-    while size_recv < size_needed:
-        bytes_recv += my_socket.recv(size_needed - size_recv)
-        size_recv = len(bytes_recv)
-    data = loads(bytes_recv)
-    return data
+    """
+    阻塞式完整地接收一个数据包，且不考虑任何数据的缺失、错误，相信TCP.
+    前缀和报文各只分配一次缓冲区，用recv_into就地填充，不再反复拼接bytes.
+    """
+    head = bytearray(HEADER_SIZE)
+    recv_exactly(my_socket, memoryview(head))
+    check_version(head[0])
+    message = bytearray(int.from_bytes(head[1:], 'big'))
+    recv_exactly(my_socket, memoryview(message))
+    return unpack(head[0], message)
+
+
+def recv_exactly(my_socket, view):
+    """ 阻塞式地把view填满。 """
+    while view:
+        n = my_socket.recv_into(view)
+        if not n:
+            raise ConnectionError('连接已断开')
+        view = view[n:]
+
+
+def unpack_datagram(datagram):
+    """ 解码一个UDP数据报（前缀 + 报文）。格式不对的数据报直接忽略，返回None. """
+    if len(datagram) < HEADER_SIZE or datagram[0] & ~COMPRESSED != protocol.VERSION:
+        return None
+    if int.from_bytes(datagram[1:HEADER_SIZE], 'big') != len(datagram) - HEADER_SIZE:
+        return None
+    try:
+        return unpack(datagram[0], memoryview(datagram)[HEADER_SIZE:])
+    except ValueError:
+        return None
+
+
+class FrameReader:
+    """
+    拆包器：自己持有一块可增长的接收缓冲区（bytearray），用recv_into通过memoryview直接填充，
+    一次读取中可能包含多个数据包，全部拆出；报文直接以memoryview交给protocol.decode，不做中间复制。
+    缓冲区中[start, end)是已收到、尚未拆出的字节。
+    """
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.n_bytes = 0    # 累计收到的字节数。
+
+    def __reserve(self, size):
+        """ 保证缓冲区从start开始至少能放下size个字节：先把剩余数据移到开头，不够再扩容。 """
+        n = self.end - self.start
+        if self.start + size <= len(self.buf):
+            return
+        if size <= len(self.buf):
+            self.view[:n] = self.view[self.start:self.end]
+        else:
+            buf = bytearray(max(size, 2 * len(self.buf)))
+            buf[:n] = self.view[self.start:self.end]
+            self.buf = buf
+            self.view = memoryview(self.buf)
+        self.start, self.end = 0, n
+
+    def read(self, my_socket):
+        """ 读取socket中已到达的数据（阻塞socket上会等待），返回拆出的完整数据包列表。对方断开时抛出ConnectionError. """
+        if self.end == len(self.buf):
+            self.__reserve(len(self.buf) - self.start + 1)
+        n = my_socket.recv_into(self.view[self.end:])
+        if not n:
+            raise ConnectionError('连接已断开')
+        self.end += n
+        self.n_bytes += n
+        return self.frames()
+
+    def frames(self):
+        """ 拆出缓冲区中所有完整的数据包并解码。 """
+        messages = []
+        while self.end - self.start >= HEADER_SIZE:
+            check_version(self.buf[self.start])
+            size = HEADER_SIZE + int.from_bytes(self.buf[self.start + 1:self.start + HEADER_SIZE], 'big')
+            if self.end - self.start < size:
+                # 不完整的大包，提前腾出足够的空间，接下来的recv_into可以一次收完。
+                self.__reserve(size)
+                break
+            messages.append(unpack(self.buf[self.start], self.view[self.start + HEADER_SIZE:self.start + size]))
+            self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+        return messages
 
 
 class ThreadSafeList:
@@ -146,30 +407,59 @@ class ThreadSafeVar:
         with self.lock:
             return copy.deepcopy(self.__var)
 
+    def peek(self):
+        """ 不加锁、不复制地读取。只用于不可变的值（如状态字符串）：读取一个引用本身是原子的。 """
+        return self.__var
 
-class EventVar:
-    def __init__(self):
-        self.__var = None
-        self.__event = threading.Event()
 
-    def start(self):
-        self.__event.wait()
+class Outbox:
+    """
+    客户端的动作发件箱。界面线程每帧把这一帧的动作放进来（post），发送线程把积攒的动作合并成一个ACTIONS报文一次发出（take）。
+        发送线程忙（比如正在发送上一批）时，新的动作不会丢失，而是留在发件箱里，下一批一起发出。
+        同一玩家同一方向上相邻的转向动作（按下/松开/连按）只保留最后一个，结果不变；拾取、使用等动作原样按顺序保留。
+        一批动作只带最新的输入序号：服务器一次处理完整批，相当于处理到了这个序号。
+    """
+    MOVES = (Action.MOVE_TURN, Action.MOVE_UNTURN)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.actions = []
+        self.seq = None
+        self.n_posted = 0       # 放进来的动作数。
+        self.n_batches = 0      # 发出的批数。
 
-    def handle(self, func, *args):
-        # 处理
-        func(*args, self.__var)
-        # 重置event, 再次进入休眠，等待被唤醒。
-        self.__event.clear()
-        self.__event.wait()
+    def post(self, seq, actions):
+        with self.lock:
+            for action in actions:
+                self.__merge(action)
+            self.seq = seq
+            self.n_posted += len(actions)
+        self.event.set()
 
-    def update(self, _var_new):
-        # 更新列表
-        self.__var = _var_new
-        # 唤醒处理线程。
-        self.__event.set()
+    def __merge(self, action):
+        if action.type in self.MOVES:
+            # 找到同一玩家的上一个转向动作，如果是同一方向，就用新的动作替换它。
+            for i in range(len(self.actions) - 1, -1, -1):
+                prev = self.actions[i]
+                if prev.type in self.MOVES and prev.target == action.target:
+                    if prev.value == action.value:
+                        del self.actions[i]
+                    break
+        self.actions.append(action)
 
-    def get(self):
-        return self.__var
+    def take(self, timeout=None):
+        """ 等待并取出积攒的一批动作['ACTIONS', seq, actions]. 超时（没有新的动作）返回None. """
+        self.event.wait(timeout)
+        with self.lock:
+            self.event.clear()
+            if self.seq is None:
+                return None
+            data = ['ACTIONS', self.seq, self.actions]
+            self.actions = []
+            self.seq = None
+            self.n_batches += 1
+        return data
 
 
 def get_host_ip():
@@ -179,248 +469,1197 @@ def get_host_ip():
     return local_ip
 
 
+class LinkStats:
+    """
+    一条连接的网络状况（线程安全）：往返时延RTT、抖动、丢包率和收发速率。服务器和客户端各自为每条连接维护一个。
+        每隔interval秒发一个PING（带发送方的本地时间），对方立即原样回复PONG，收到时用本地时间减去其中的时间就是RTT，
+        不需要两端的时钟同步。PING和其他报文排在同一条连接上，排队的时间也算在RTT里。
+        RTT是平滑后的值（每个样本占1/8），抖动是相邻两个RTT样本之差的平滑值（占1/16，同RTP的做法）。
+        超过timeout秒还没有收到PONG的PING算作丢失，丢包率是最近window个PING中丢失的比例。
+        收发速率（字节/秒）每秒统计一次。
+    """
+    def __init__(self, interval=1.0, timeout=2.0, window=20):
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.timeout = timeout
+        self.seq = 0
+        self.t_ping = 0.0
+        self.pending = dict()   # 还没收到PONG的PING，seq: 发出的时间。
+        self.results = collections.deque(maxlen=window)     # 最近的PING是否收到了PONG.
+        self.rtt = None         # 秒。
+        self.rtt_min = None     # 最小的RTT样本（没有排队时的RTT）。
+        self.jitter = 0.0
+        self.last_sample = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.rate_in = 0.0      # 字节/秒。
+        self.rate_out = 0.0
+        self.t_rate = time.perf_counter()
+        self.rate_base = (0, 0)
+
+    def add_in(self, n):
+        with self.lock:
+            self.bytes_in += n
+
+    def add_out(self, n):
+        with self.lock:
+            self.bytes_out += n
+
+    def ping(self, t_now):
+        """ 到了发PING的时间就返回要发送的['PING', seq, t]，否则返回None. 顺便统计超时的PING和收发速率。 """
+        with self.lock:
+            for seq, t_sent in list(self.pending.items()):
+                if t_now - t_sent > self.timeout:
+                    del self.pending[seq]
+                    self.results.append(False)
+            if t_now - self.t_rate >= 1.0:
+                dt = t_now - self.t_rate
+                self.rate_in = (self.bytes_in - self.rate_base[0]) / dt
+                self.rate_out = (self.bytes_out - self.rate_base[1]) / dt
+                self.t_rate = t_now
+                self.rate_base = (self.bytes_in, self.bytes_out)
+            if t_now - self.t_ping < self.interval:
+                return None
+            self.t_ping = t_now
+            self.seq = (self.seq + 1) & 0xFFFFFFFF
+            self.pending[self.seq] = t_now
+            return ['PING', self.seq, t_now]
+
+    def pong(self, seq, t_sent, t_now):
+        """ 收到PONG. 已经算作丢失的（或者重复的）不再计入。 """
+        with self.lock:
+            if self.pending.pop(seq, None) is None:
+                return
+            self.results.append(True)
+            sample = t_now - t_sent
+            self.rtt_min = sample if self.rtt_min is None else min(self.rtt_min, sample)
+            if self.rtt is None:
+                self.rtt = sample
+            else:
+                self.rtt += (sample - self.rtt) / 8
+                self.jitter += (abs(sample - self.last_sample) - self.jitter) / 16
+            self.last_sample = sample
+
+    def summary(self):
+        """ {'rtt': 毫秒（还没有样本时为None）, 'jitter': 毫秒, 'loss': 丢包百分比, 'in'/'out': 字节/秒} """
+        with self.lock:
+            loss = 0
+            if self.results:
+                loss = round(100 * self.results.count(False) / len(self.results))
+            return {'rtt': None if self.rtt is None else round(self.rtt * 1000),
+                    'jitter': round(self.jitter * 1000),
+                    'loss': loss,
+                    'in': round(self.rate_in), 'out': round(self.rate_out)}
+
+
+class SendRate:
+    """
+    服务器向一个客户端发送的频率控制（只在事件循环线程中使用，由Room调用）。
+        大厅状态（MATCHING、PREPARING）：内容有变化时立即发送，没有变化时每lobby_interval秒才重发一次。
+        游戏中：发送间隔interval在[min_interval, max_interval]之间自适应（AIMD）：
+            客户端跟不上（见Room.__congested）时，间隔乘以backoff（降低频率）；
+            否则每发送一次，频率增加step赫兹，直到恢复到服务器的广播频率（min_interval）。
+        游戏中没有变化（客户端已经确认了最新的变化）时，每idle_interval秒才发送一次。
+    """
+    def __init__(self, min_interval, max_interval=0.2, lobby_interval=0.5, idle_interval=0.2,
+                 backoff=1.5, step=2.0, queue_delay=0.1):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lobby_interval = lobby_interval
+        self.idle_interval = idle_interval
+        self.backoff = backoff
+        self.step = step
+        self.queue_delay = queue_delay  # RTT比最小RTT高出这么多（秒），说明在排队。
+        self.interval = min_interval
+        self.t_last = None      # 上一次发送的时间。
+        self.key = None         # 上一次发送的大厅报文的内容。
+        self.n_backoffs = 0
+
+    def due(self, t_now, interval=None):
+        """ 距上一次发送是否已经过了interval（默认为当前的发送间隔）。留半个广播周期的余量，避免和广播周期错开。 """
+        if self.t_last is None:
+            return True
+        interval = self.interval if interval is None else interval
+        return t_now - self.t_last >= interval - self.min_interval / 2
+
+    def sent(self, t_now):
+        self.t_last = t_now
+
+    def lobby(self, t_now, key):
+        """ 大厅报文：内容key有变化，或者到了重发的时间，就记为发送并返回True. """
+        if key == self.key and not self.due(t_now, self.lobby_interval):
+            return False
+        self.key = key
+        self.t_last = t_now
+        return True
+
+    def adapt(self, congested):
+        if congested:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+            self.n_backoffs += 1
+        else:
+            self.interval = max(self.min_interval, 1 / (1 / self.interval + self.step))
+
+
+class Connection:
+    """
+    服务器端的一个客户端连接（非阻塞）。由NetworkServer的事件循环驱动，只在事件循环线程中使用。
+    id是客户端在所在房间中的位置（即玩家id）。
+    读：把收到的字节放入接收缓冲区，从中拆出所有完整的数据包（可能一次收到多个，也可能不完整）。
+    写：要发送的数据包先放入该连接自己的发送队列，socket可写时尽量发送，发不完的等下一次可写。
+        一个慢的客户端只会让自己的队列变长，不会拖慢其他客户端。
+        LATEST_WINS中的报文（快照帧）只保留最新的一个：新的快照入队时，丢弃队列中还没开始发送的旧快照。
+            （快照帧是相对客户端已确认的tick的差分，丢掉一帧不影响后面的帧）
+        其他报文（就绪列表、地图等）是可靠的，从不丢弃。
+        发送队列超过max_pending字节的时间持续overdue秒以上，或者超过hard_limit字节，
+            或者队列非空却stall秒都没能发出任何数据（对方不再接收），视为拥塞，由服务器断开。
+    """
+    LATEST_WINS = ('GAMING',)
+
+    def __init__(self, _socket, i_client):
+        self.socket = _socket
+        self.socket.setblocking(False)
+        self.id = i_client
+        self.room = None    # 所在的房间。
+        self.reader = FrameReader()
+        # 发送队列，每一项为[报文类型, 待发送的缓冲区列表]。队首的一项可能已经发送了一部分（sending为True）。
+        self.outq = collections.deque()
+        self.sending = False
+        self.pending = 0            # 发送队列中的字节数。
+        self.max_pending = 256 * 1024
+        self.hard_limit = 4 * self.max_pending
+        self.overdue = 3.0
+        self.t_over = None          # 开始超出max_pending的时间。
+        self.stall = 10.0
+        self.t_sent = 0.0           # 上一次发出数据（或队列由空变为非空）的时间。
+        self.n_dropped = 0          # 被丢弃的旧快照数。
+        '''
+        UDP（可选）：令牌，以及客户端用令牌登记过的UDP地址。
+        最近udp_timeout秒内从这个地址收到过ACK时，快照帧才走UDP；否则（还没确认、或者UDP不通了，比如NAT映射变了）走TCP.
+        '''
+        self.token = None
+        self.udp_addr = None
+        self.t_udp = 0.0            # 最近一次从登记的地址收到ACK的时间。
+        self.udp_timeout = 1.0
+        self.link = LinkStats()
+        # 会话令牌：分到位置时发给客户端，断线重连时凭它回到原来的位置（见Room.resume）。
+        self.session = None
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def feed(self):
+        """ 读取socket中已到达的数据，返回拆出的完整数据包列表。对方断开时抛出ConnectionError. """
+        n_bytes = self.reader.n_bytes
+        messages = self.reader.read(self.socket)
+        self.link.add_in(self.reader.n_bytes - n_bytes)
+        return messages
+
+    def queue(self, data):
+        """ 把数据包（数据列表，或已编码的Packet）放入发送队列。 """
+        packet = data if isinstance(data, Packet) else Packet(data)
+        if not self.outq:
+            self.t_sent = time.perf_counter()
+        if packet.name in self.LATEST_WINS:
+            self.__drop(packet.name)
+        self.outq.append([packet.name, [memoryview(chunk) for chunk in packet.chunks]])
+        self.pending += packet.size
+
+    def __drop(self, name):
+        """ 丢弃队列中还没开始发送的、类型为name的报文。 """
+        kept = collections.deque()
+        for i, item in enumerate(self.outq):
+            if item[0] == name and not (i == 0 and self.sending):
+                self.pending -= sum(len(chunk) for chunk in item[1])
+                self.n_dropped += 1
+            else:
+                kept.append(item)
+        self.outq = kept
+
+    def flush(self):
+        """ 尽量发送发送队列中的数据，返回是否已全部发送。 """
+        while self.outq:
+            chunks = []
+            for _, item_chunks in self.outq:
+                chunks.extend(item_chunks)
+                if len(chunks) >= IOV_MAX:
+                    break
+            try:
+                if hasattr(self.socket, 'sendmsg'):
+                    n = self.socket.sendmsg(chunks[:IOV_MAX])
+                else:
+                    # 没有sendmsg的平台（如Windows），拼接成一段再发送（可能只发出一部分）。
+                    n = self.socket.send(b''.join(chunks[:IOV_MAX]))
+            except BlockingIOError:
+                return False
+            self.pending -= n
+            self.link.add_out(n)
+            self.t_sent = time.perf_counter()
+            while n:
+                item_chunks = self.outq[0][1]
+                size = sum(len(chunk) for chunk in item_chunks)
+                if n < size:
+                    consume(item_chunks, n)
+                    self.sending = True
+                    break
+                n -= size
+                self.outq.popleft()
+                self.sending = False
+        return True
+
+    def congested(self):
+        """ 发送队列是否持续超出预算（应当断开）。 """
+        if self.outq and time.perf_counter() - self.t_sent > self.stall:
+            return True
+        if self.pending <= self.max_pending:
+            self.t_over = None
+            return False
+        if self.pending > self.hard_limit:
+            return True
+        t_now = time.perf_counter()
+        if self.t_over is None:
+            self.t_over = t_now
+        return t_now - self.t_over > self.overdue
+
+    def close(self):
+        self.socket.close()
+
+
 """
 服务器与客户端的状态
-*独立阶段
-    服务器初始化，进入INITIATED状态，可以手动选择是否进行监听。
-        调用match后，进入监听状态：MATCHING。
-    客户端初始化，进入INITIATED状态，可以手动选择是否进行连接。
-        调用connect后，进入连接状态：CONNECTING.
-*互动阶段
-    服务器一直处于MATCHING状态，并且对已连接的客户端创建广播线程，
-        不断广播：自身状态+已连接的数量。
-    客户端连接成功后，从CONNECTING状态进入CONNECTED状态，不断接收服务器发来的数量。
-    服务器连接数量足够后，进入PREPARING状态。
-        不断广播：自身状态+已就绪的id号。
-    ---
-    服务器就绪数量足够后，进入GAMING状态。
-        不断广播：自身状态+game_status.
-广播格式：
-    长度校正码（4个固定字节），信息列表 [服务器状态，信息]
-    拆解方式：先查看校正码，如果正确，就用list接收列表。
-备注：主要的逻辑判断都在服务器，客户端是很被动的接收。
-        单向广播通路必须一致敞开，且已固定频率发送，而不是只发送1次。
-        服务器需要建立一个全局的消息队列，这样子线程发送的内容就可以变更！！
-        客户端的状态不重要！！因为服务器不会去读取客户端的状态。客户端的状态就是服务器的状态。
-    目前还没有服务器对客户端反馈的响应机制。
-    当客户端断开等时，服务器会报错。
-    
+*服务器（NetworkServer，一个线程的selectors事件循环）
+    创建后处于INITIATED状态，run()开始事件循环后进入RUNNING；作为工作进程时，控制通道关闭后进入CLOSED，事件循环结束。
+    新连接的第一个报文：JOIN分到一个正在匹配的房间；RESUME凭会话令牌回到游戏中为它保留的位置。
+    每个房间（Room）有自己的状态，由事件驱动切换，切换时立即通知房间里的客户端：
+        MATCHING -（人满）-> PREPARING -（最后一个READY）-> PLAYING -（游戏结束）-> PREPARING -> ...
+        等待就绪时有人离开 -> MATCHING；所有人都离开 -> CLOSED（由服务器回收）。
+    游戏中断线的玩家，位置保留Room.grace秒，期间凭令牌重连就能继续；超时或者这一局结束，位置才空出。
+*客户端（NetworkClient）
+    connect()：连接并发送JOIN，等到MATCHING（本机id）。
+    prepare()：发送READY，等到这一局的第一个快照帧。
+    play()：发送线程，把界面放进发件箱的动作成批发出，直到游戏结束。
+    接收线程处理服务器发来的所有报文；游戏中连接断开时，在grace秒内自动重连（RESUME）。
+报文格式：
+    前缀（1个字节的版本号和压缩标志，3个字节的长度）+ protocol编码的报文[报文类型, 内容...]。
+    游戏中的快照帧是相对客户端已确认（ACK）的tick的差分，发送频率由每个客户端的SendRate决定，可以走UDP.
+备注：主要的逻辑判断都在服务器，客户端只发送动作，并用服务器的快照校正自己的预测。
+    格式不对的报文、拥塞或者断开的连接，只会让服务器断开这一个客户端，不影响事件循环和其他房间。
 """
 
 
+class Room:
+    """
+    房间：承载一局游戏（一个Game实例）、它的玩家位置和就绪状态。由NetworkServer的事件循环驱动，只在事件循环线程中使用。
+    房间的状态（由事件驱动，事件发生时立即切换并通知客户端，不轮询、不等待）：
+        MATCHING,   玩家人数不够，匹配玩家中。                   人满 -> PREPARING.
+        PREPARING,  玩家人数足够，等待玩家确认开始。               最后一个READY -> PLAYING；有人离开 -> MATCHING.
+                    （或者一局游戏结束后等待玩家开始下一把）
+        PLAYING,    游戏中。                                    游戏结束（GAMEOVER）-> 发出最后一帧，PREPARING.
+        CLOSED,     所有玩家都已离开，等待服务器回收。
+    快照差分：
+        每个tick生成一个快照，保存最近的一段历史。每个客户端回复它收到的最新tick（ACK），
+        服务器只发送相对于该客户端已确认快照的差分；确认的快照已不在历史中、或距上个关键帧太久时，发送关键帧。
+    每个tick分两步：step()推进一步模拟并生成快照；broadcast()广播最新的状态。服务器落后时可以连续step几次，只广播一次。
+    广播时相同的内容（就绪列表、地图）只编码一次（Packet），各客户端共享同一段字节。
+    发送频率：每个客户端有自己的SendRate. 大厅状态只在变化时（以及低频地）发送；游戏中没有变化时低频发送，
+        跟不上的客户端（发送队列里还有没发完的数据、RTT明显升高、确认的tick落后太多）降低频率，跟上了再逐渐恢复。
+    兴趣管理：每个客户端只收到自己视野窗口（Game.view_window）内的其他玩家和地图块，
+        相对于基准tick新进入窗口的地图块会完整发送；离开窗口的内容不再更新，再次进入时重新发送。
+    断线重连：每个位置有一个会话令牌（进入房间时发给客户端）。游戏中断线的玩家，位置保留grace秒，
+        人物停在原地，游戏照常进行；客户端在此期间凭令牌重连（RESUME），就回到原来的位置，
+        收到地图和一个关键帧后继续游戏。超时未重连、或者这一局已经结束，位置才真正空出。
+    对局记录（可选，record_dir不为None时）：每一局记录成record_dir下的一个回放文件（见replay.Recorder）：
+        地图、交给游戏的每一批动作（都经过__apply）、以及每隔几秒一个关键帧。
+    性能分析（可选，profile_window不为None时）：各阶段的耗时记在self.profiler里（见profiler.TickProfiler），
+        包括等待Game.lock的时间（Game.reset会重建锁，所以每一局开始时重新包装）。
+    """
+    ID_CUR = 0
+
+    def __init__(self, _game, send_func, freq, record_dir=None, profile_window=None):
+        self.id = Room.ID_CUR
+        Room.ID_CUR += 1
+        self.game = _game
+        self.send = send_func   # 发送函数send(conn, data)，由服务器提供。data可以是已编码的Packet.
+        self.freq = freq
+        self.n_players = self.game.n_players
+        self.slots = [None for _ in range(self.n_players)]  # 玩家的连接（Connection），下标即客户端id。
+        self.client_ready = [False for _ in range(self.n_players)]
+        self.mode = 'MATCHING'
+        ''' 快照差分 '''
+        self.tick = 0
+        self.snapshots = dict()     # tick: 快照。
+        self.n_history = 2 * self.freq  # 保留的历史快照数量。
+        self.keyframe_interval = 2 * self.freq  # 每个客户端至少每隔这么多tick收到一个关键帧。
+        self.client_acked = [-1 for _ in range(self.n_players)]    # 每个客户端已确认的tick，-1表示需要关键帧。
+        self.client_keyframe = [-self.keyframe_interval for _ in range(self.n_players)]  # 上一次收到关键帧的tick。
+        self.client_map = [None for _ in range(self.n_players)]    # 每个客户端已收到的地图id。
+        ''' 客户端预测：每个客户端最近一次被处理的输入序号，以及处理之后已经模拟了多长时间（秒）。 '''
+        self.client_seq = [0 for _ in range(self.n_players)]
+        self.client_seq_dt = [0.0 for _ in range(self.n_players)]
+        self.map_info = None    # 当前地图的get_map_info()（缓存）。
+        self.map_packet = None  # 当前地图编码后的MAP报文（缓存）。
+        self.map_packet_id = None
+        ''' 网络状况：每隔net_interval秒，把服务器测得的每个玩家的(RTT, 丢包率)附在快照帧里发给房间里的所有人。 '''
+        self.net_interval = 1.0
+        self.t_net = 0.0
+        self.net = None
+        self.client_net = [False for _ in range(self.n_players)]   # 是否有还没发给该客户端的网络状况。
+        ''' 发送频率：每个客户端的SendRate；游戏状态最近一次变化的tick；每个客户端最近一次输入的回显从哪个tick开始。 '''
+        self.client_rate = [SendRate(1 / self.freq) for _ in range(self.n_players)]
+        self.tick_changed = 0
+        self.client_seq_tick = [0 for _ in range(self.n_players)]
+        ''' 会话：每个位置的会话令牌，以及游戏中断线的玩家断开的时刻（None表示在线）。 '''
+        self.grace = 10.0
+        self.client_token = [None for _ in range(self.n_players)]
+        self.client_lost = [None for _ in range(self.n_players)]
+        ''' 对局记录 '''
+        self.record_dir = record_dir
+        self.recorder = None
+        ''' 性能分析 '''
+        self.profiler = None
+        if profile_window is not None:
+            self.profiler = profiler.TickProfiler(1.0, max(1, round(profile_window)))
+            self.__watch_lock()
+        print('房间', self.id, '已创建，状态：MATCHING.')
+
+    def full(self):
+        return None not in self.slots
+
+    def empty(self):
+        return self.slots.count(None) == self.n_players
+
+    def add(self, conn):
+        """ 让新的客户端占据一个空位置，并立即告诉它自己的id. 人满了就进入PREPARING. """
+        i_client = self.slots.index(None)
+        self.slots[i_client] = conn
+        self.client_rate[i_client] = SendRate(1 / self.freq)
+        self.client_token[i_client] = conn.session
+        conn.id = i_client
+        conn.room = self
+        self.send(conn, ['SESSION', conn.session])
+        self.broadcast()
+        if self.full():
+            self.__enter('PREPARING')
+
+    def remove(self, conn):
+        """
+        客户端断开，空出它的位置。游戏中断开的，位置先保留grace秒（人物停下），等它重连（见resume）。
+        房间里没人了就关闭房间；等待就绪时有人离开，就回到匹配状态。
+        """
+        i_client = conn.id
+        self.slots[i_client] = None
+        self.client_ready[i_client] = False
+        if self.mode == 'PLAYING' and self.grace > 0:
+            self.client_lost[i_client] = time.perf_counter()
+            self.__apply(i_client, [Action(Action.MOVE_UNTURN, i_dir, i_client, i_client) for i_dir in range(4)])
+            print('房间', self.id, '玩家', i_client, '断开，保留位置', self.grace, '秒。')
+            return
+        self.client_token[i_client] = None
+        if self.empty():
+            self.mode = 'CLOSED'
+            print('房间', self.id, '已关闭。')
+        elif self.mode == 'PREPARING':
+            self.__enter('MATCHING')
+
+    def seat(self, token):
+        """ 会话令牌对应的、游戏中仍为它保留的位置；没有的话返回None. """
+        if self.mode != 'PLAYING' or token not in self.client_token:
+            return None
+        return self.client_token.index(token)
+
+    def resume(self, conn, i_client):
+        """ 断线重连的客户端回到原来的位置：重新发送id和地图，下一个快照帧是关键帧。游戏照常进行，不重置。 """
+        self.slots[i_client] = conn
+        self.client_lost[i_client] = None
+        self.client_ready[i_client] = True
+        self.client_rate[i_client] = SendRate(1 / self.freq)
+        self.client_acked[i_client] = -1
+        self.client_map[i_client] = None
+        conn.id = i_client
+        conn.room = self
+        conn.session = self.client_token[i_client]
+        self.send(conn, ['SESSION', conn.session])
+        self.send(conn, ['MATCHING', i_client])
+        print('房间', self.id, '玩家', i_client, '已重连。')
+        self.broadcast()
+
+    def __release(self, i_client):
+        """ 断线的玩家没能回来，真正空出它的位置。房间里没人了就关闭房间。 """
+        self.client_token[i_client] = None
+        self.client_lost[i_client] = None
+        print('房间', self.id, '玩家', i_client, '没有重连，位置已空出。')
+        if self.empty():
+            self.mode = 'CLOSED'
+            self.__stop_recording()
+            print('房间', self.id, '已关闭。')
+
+    def handle(self, i_client, data):
+        """ 处理客户端发来的数据。 """
+        # 客户端确认收到的快照tick，之后以它为差分的基准。（-1表示请求关键帧）
+        if data[0] == 'ACK':
+            self.client_acked[i_client] = data[1]
+            return
+        # PREPARING阶段，若接收到‘READY'开头的报文，就修改client_ready列表并立即广播；最后一个就绪后立即开始游戏。
+        # 只打印大厅里的报文，游戏中每批动作都打印会拖慢事件循环。
+        if self.mode == 'PREPARING':
+            if data[0] == 'READY' and not self.client_ready[i_client]:
+                print('房间', self.id, 'msg from', i_client, data)
+                self.client_ready[i_client] = True
+                if all(self.client_ready):
+                    self.__enter('PLAYING')
+                else:
+                    self.broadcast()
+        # 游戏阶段，若接收到’ACTIONS'开头的报文，那么后面的部分就是[输入序号, actions].
+        elif self.mode == 'PLAYING':
+            if data[0] == 'ACTIONS':
+                self.__apply(i_client, data[2])
+                self.client_seq[i_client] = data[1]
+                self.client_seq_dt[i_client] = 0.0
+                self.client_seq_tick[i_client] = self.tick + 1
+                if self.game.mode == 'GAMEOVER':
+                    self.__finish()
+
+    def update(self, dt):
+        """ 推进一个tick并广播。 """
+        self.step(dt)
+        self.broadcast()
+
+    def step(self, dt):
+        """ 一个tick：空出重连超时的位置；游戏状态下更新一次游戏并生成一个快照。 """
+        if self.profiler is not None:
+            self.profiler.roll(time.perf_counter())
+        if any(t_lost is not None for t_lost in self.client_lost):
+            t_now = time.perf_counter()
+            for i_client, t_lost in enumerate(self.client_lost):
+                if t_lost is not None and t_now - t_lost > self.grace:
+                    self.__release(i_client)
+        if self.mode == 'PLAYING':
+            self.timed('update', self.game.update_by_dt, dt)
+            for i_client in range(self.n_players):
+                self.client_seq_dt[i_client] += dt
+            self.__take_snapshot()
+            if self.game.mode == 'GAMEOVER':
+                self.__finish()
+
+    def __enter(self, mode):
+        """ 切换房间状态，并立即通知客户端（不等下一次广播）。 """
+        self.mode = mode
+        # 新状态的报文不受大厅报文的重发间隔限制，游戏的第一帧也不受刚刚发出的大厅报文的发送间隔限制。
+        for rate in self.client_rate:
+            rate.key = None
+            rate.t_last = None
+        if mode == 'MATCHING':
+            print('房间', self.id, '有玩家离开，重新匹配，状态：MATCHING.')
+        elif mode == 'PREPARING':
+            self.client_ready = [False for _ in range(self.n_players)]
+            print('房间', self.id, '玩家人数足够，正在等待每位玩家就绪，状态：PREPARING.')
+        elif mode == 'PLAYING':
+            self.game.reset(self.n_players)
+            self.__watch_lock()
+            # 新的一局地图完全不同，所有客户端都需要关键帧。
+            self.client_acked = [-1 for _ in range(self.n_players)]
+            self.client_seq = [0 for _ in range(self.n_players)]
+            self.client_seq_dt = [0.0 for _ in range(self.n_players)]
+            self.client_seq_tick = [0 for _ in range(self.n_players)]
+            self.__take_snapshot()
+            self.__start_recording()
+            print('房间', self.id, '游戏开始，状态：PLAYING.')
+        self.broadcast()
+
+    def __finish(self):
+        """
+        游戏结束：生成最后一个快照，立即发给所有客户端（不受发送频率限制），然后回到PREPARING等待下一局。
+        断线的玩家不能再回到已经结束的一局，空出它们的位置；人不齐的话回到MATCHING.
+        """
+        self.__take_snapshot()
+        self.broadcast(force=True)
+        self.__stop_recording()
+        print('房间', self.id, '游戏结束，胜者：', self.game.winner)
+        for i_client, t_lost in enumerate(self.client_lost):
+            if t_lost is not None:
+                self.__release(i_client)
+        if self.mode != 'CLOSED':
+            self.__enter('PREPARING' if self.full() else 'MATCHING')
+
+    def __apply(self, i_client, actions):
+        """ 把一批动作交给游戏（先记录，update_by_actions会修改动作）。 """
+        if self.recorder is not None:
+            self.recorder.actions(self.tick, i_client, actions)
+        self.timed('actions', self.game.update_by_actions, i_client, actions)
+
+    def timed(self, name, func, *args):
+        """ 调用func(*args)并返回它的结果；开启了性能分析时，把耗时记为阶段name. """
+        if self.profiler is None:
+            return func(*args)
+        return self.profiler.timed(name, func, *args)
+
+    def __watch_lock(self):
+        """ 开启了性能分析时，包装游戏的锁，记录每次获取时等待的时间。 """
+        if self.profiler is not None and not isinstance(self.game.lock, profiler.TimedLock):
+            self.game.lock = profiler.TimedLock(self.game.lock, self.profiler.recorder('lock_wait'))
+
+    def __start_recording(self):
+        """ 新的一局开始（已生成第一个快照）：创建回放文件，记录地图和第一个关键帧。 """
+        if self.record_dir is None:
+            return
+        name = '%s-%d-%d-%d.replay' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), self.id, self.map_info['id'])
+        self.recorder = replay.Recorder(os.path.join(self.record_dir, name), self.freq, self.n_players,
+                                        self.game.seed)
+        self.recorder.map(self.tick, self.map_info)
+        self.__record_keyframe()
+
+    def __record_keyframe(self):
+        self.recorder.keyframe(self.tick, self.snapshots[self.tick], self.game.get_map_cells())
+
+    def __stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close(self.tick)
+            print('房间', self.id, '对局记录：', self.recorder.path, self.recorder.n_bytes, '字节')
+            self.recorder = None
+
+    def broadcast(self, force=False):
+        """
+        向房间内到了发送时间的客户端广播（见SendRate）。广播的内容：[房间状态，信息].
+        force为True时，游戏中的快照帧立即发给所有客户端。
+        """
+        t_now = time.perf_counter()
+        preparing = None
+        if self.mode == 'PLAYING' and t_now - self.t_net >= self.net_interval:
+            self.t_net = t_now
+            self.net = [self.__net(conn) for conn in self.slots]
+            self.client_net = [True for _ in range(self.n_players)]
+        for i_client, conn in enumerate(self.slots):
+            if conn is None:
+                continue
+            rate = self.client_rate[i_client]
+            if self.mode == 'MATCHING':
+                if rate.lobby(t_now, ('MATCHING', i_client)):
+                    self.send(conn, ['MATCHING', i_client])
+            elif self.mode == 'PREPARING':
+                if rate.lobby(t_now, ('PREPARING', tuple(self.client_ready))):
+                    if preparing is None:
+                        preparing = Packet(['PREPARING', self.client_ready])
+                    self.send(conn, preparing)
+            elif self.mode == 'PLAYING':
+                # 新的一局先发送地图（每局只发送一次），之后的快照帧就不再包含迷宫矩阵。
+                if self.client_map[i_client] != self.map_info['id']:
+                    if self.map_packet is None or self.map_packet_id != self.map_info['id']:
+                        self.map_packet = Packet(['MAP', self.map_info])
+                        self.map_packet_id = self.map_info['id']
+                    self.send(conn, self.map_packet)
+                    self.client_map[i_client] = self.map_info['id']
+                if not force:
+                    if not rate.due(t_now):
+                        continue
+                    # 客户端已经确认了最新的变化（以及自己最近一次输入的回显），就只低频地发送。
+                    if self.client_acked[i_client] >= max(self.tick_changed, self.client_seq_tick[i_client]) \
+                            and not rate.due(t_now, rate.idle_interval):
+                        continue
+                    rate.adapt(self.__congested(i_client, conn, rate))
+                base_tick = self.__frame_base(i_client)
+                net = self.net if self.client_net[i_client] else None
+                self.client_net[i_client] = False
+                self.send(conn, ['GAMING', self.timed('frame', self.__snapshot_frame, i_client, base_tick, net)])
+                rate.sent(t_now)
+
+    def __congested(self, i_client, conn, rate):
+        """
+        客户端是否跟不上：上一次发送的数据还堵在TCP发送队列里；RTT比最小RTT高出queue_delay以上（在排队）；
+        或者确认的tick落后得比发送间隔加上RTT还多出queue_delay以上（客户端处理不过来，或者UDP在丢包）。
+        """
+        if conn.pending > 0:
+            return True
+        # 用最近一次的RTT样本而不是平滑后的RTT：排队消失后，下一个PING就能让频率恢复。
+        rtt, rtt_min = conn.link.last_sample, conn.link.rtt_min
+        if rtt is not None and rtt - rtt_min > rate.queue_delay:
+            return True
+        acked = self.client_acked[i_client]
+        if acked < 0:
+            return False
+        return (self.tick - acked) / self.freq > rate.interval + (rtt or 0.0) + rate.queue_delay
+
+    @staticmethod
+    def __net(conn):
+        """ 服务器测得的某个玩家的网络状况：(RTT毫秒或None, 丢包百分比)。 """
+        if conn is None:
+            return None, 0
+        summary = conn.link.summary()
+        return summary['rtt'], summary['loss']
+
+    def __take_snapshot(self):
+        """ 生成当前tick的快照，并丢弃过旧的历史快照。 """
+        self.tick += 1
+        snapshot = self.timed('snapshot', self.game.get_snapshot)
+        # 和上一个快照比较，记下游戏状态最近一次变化的tick.
+        prev = self.snapshots.get(self.tick - 1)
+        if prev is None or prev['map_id'] != snapshot['map_id'] or prev['mode'] != snapshot['mode'] \
+                or prev['winner'] != snapshot['winner'] or len(self.game.diff_snapshot(prev, snapshot)) > 2:
+            self.tick_changed = self.tick
+        self.snapshots[self.tick] = snapshot
+        self.snapshots.pop(self.tick - self.n_history, None)
+        if self.map_info is None or self.map_info['id'] != snapshot['map_id']:
+            self.map_info = self.game.get_map_info()
+        if self.recorder is not None and self.recorder.keyframe_due(self.tick):
+            self.__record_keyframe()
+
+    def __frame_base(self, i_client):
+        """
+        当前tick发给某客户端的快照帧以哪个tick为基准：该客户端已确认的tick.
+        基准已不在历史中、地图已更换、或距该客户端上个关键帧太久时，返回-1（发送关键帧）。
+        """
+        snapshot = self.snapshots[self.tick]
+        base_tick = self.client_acked[i_client]
+        base = self.snapshots.get(base_tick)
+        if base is None or base['map_id'] != snapshot['map_id'] \
+                or self.tick - self.client_keyframe[i_client] >= self.keyframe_interval:
+            self.client_keyframe[i_client] = self.tick
+            return -1
+        return base_tick
+
+    def __snapshot_frame(self, i_client, base_tick, net=None):
+        """
+        当前tick发给某客户端、以base_tick为基准的快照帧：[tick, base_tick, 内容]，只包含该客户端视野内的部分。
+        内容中总是带有该tick的服务器时间t（秒，tick/freq，用于客户端插值），
+        以及该客户端最近被处理的输入序号ack_seq和处理之后模拟的时长ack_dt（用于客户端预测）。
+        base_tick为-1时内容是关键帧（完整快照，附带窗口内所有的地图块），否则是相对于base_tick快照的差分，
+        并附带窗口内、该快照的地图版本号之后的脏块，以及新进入窗口的地图块（'cells'）。
+        net不为None时，附带所有玩家的网络状况（'net'）。
+        """
+        snapshot = self.snapshots[self.tick]
+        window = self.game.view_window(snapshot['explorers'][i_client]['pos'])
+        view = self.game.view_snapshot(snapshot, i_client, window)
+        extra = {'t': self.tick / self.freq,
+                 'ack_seq': self.client_seq[i_client], 'ack_dt': self.client_seq_dt[i_client]}
+        if net is not None:
+            extra['net'] = net
+        if base_tick < 0:
+            keyframe = dict(view, **extra)
+            keyframe['cells'] = self.game.get_map_cells(0, window, i_client)
+            return [self.tick, -1, keyframe]
+        base = self.snapshots[base_tick]
+        window_base = self.game.view_window(base['explorers'][i_client]['pos'])
+        delta = self.game.diff_snapshot(self.game.view_snapshot(base, i_client, window_base), view)
+        cells = dict()
+        if 'revision' in delta:
+            cells = self.game.get_map_cells(base['revision'], window, i_client)
+        if window != window_base:
+            r0, r1, c0, c1 = window_base
+            entered = [(r, c) for r in range(window[0], window[1]) for c in range(window[2], window[3])
+                       if not (r0 <= r < r1 and c0 <= c < c1) and (r, c) not in cells]
+            cells.update(self.game.get_map_cells_at(entered, i_client))
+        if cells:
+            delta['cells'] = cells
+        delta.update(extra)
+        return [self.tick, base_tick, delta]
+
+
 class NetworkServer:
     """
-    初始化：根据创建服务器socket，绑定ip和端口，激活监听参数。绑定游戏逻辑。
+    初始化：根据创建服务器socket，绑定ip和端口，激活监听参数。绑定游戏的生成函数。
 
-    主线程：不断连接新的客户端，加入到客户端列表中。或者从客户端列表中删除已经断开的连接。
-    子线程：以固定频率更新game，并将game_status广播给所有客户端。
-    子线程（n个，n为客户端数量）：不断从每个客户端接收events，并立即更新game.
-            优化v2和v3：用select/epoll实现多路复用。
+    事件循环（run）：用selectors（Linux下为epoll）实现IO多路复用，一个线程处理所有的连接：
+        接受新的客户端并分配到房间、接收每个客户端的数据并交给所在的房间、发送数据；
+        同时以固定频率调度tick，更新所有的房间（Room），不再需要的房间被回收。
+    一个进程可以同时承载很多个房间（多局游戏），共用一个监听socket.
+    作为进程池（server_pool.ServerPool）中的工作进程时，不监听端口（server_address为None），
+        而是从控制通道control接收前端进程转交来的客户端socket，并通过它回复统计信息。
+    新连接先发一个报文：JOIN分配到正在匹配的房间；RESUME凭会话令牌回到游戏中为它保留的位置（见Room）。
+        会话令牌的高16位是server_id（进程池中工作进程的下标），前端据此把重连的客户端转交给原来的工作进程。
+        join_timeout秒内没有发来的连接被断开。
+    性能分析（可选，在run之前把profiling设为True）：每个房间记录最近profile_window秒里各阶段的耗时（见profiler），
+        profile()随时取出；profile_interval不为None时，每隔这么多秒打印一次汇总。
+    UDP（可选，udp_address不为None时）：
+        快照帧不怕丢（每一帧都是相对客户端已确认的tick的差分），但TCP丢一个包会堵住后面所有的快照（队头阻塞）。
+        所以客户端用令牌登记了UDP地址之后，游戏中的快照帧（不超过UDP_MAX字节）改走UDP，客户端的ACK也走UDP；
+        可靠的报文（匹配、就绪、地图、动作、游戏结束的快照帧、过大的关键帧）仍然走TCP. 客户端不支持UDP时完全退回TCP.
+        快照帧只在最近1秒内（Connection.udp_timeout）从UDP收到过该客户端的ACK时才走UDP，UDP中途不通了就自动退回TCP.
     """
-    def __init__(self, server_address):
+    def __init__(self, server_address, game_factory=None, control=None, udp_address=None, record_dir=None):
         self.address = server_address
-        self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-        self.socket.bind(self.address)
-        self.socket.listen()
-        self.client_sockets = ThreadSafeList()
-        self.client_ready = ThreadSafeList([False for _ in range(self.max_clients)])
+        self.selector = selectors.DefaultSelector()
+        self.socket = None
+        if self.address is not None:
+            self.socket = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind(self.address)
+            self.socket.listen(128)
+            self.socket.setblocking(False)
+            self.selector.register(self.socket, selectors.EVENT_READ)
+        # 控制通道（AF_UNIX, SOCK_SEQPACKET），每条消息是一个json命令，转交socket时附带文件描述符。
+        self.control = control
+        if self.control is not None:
+            self.control.setblocking(False)
+            self.selector.register(self.control, selectors.EVENT_READ, 'CONTROL')
+        self.udp_socket = None
+        self.udp_tokens = dict()    # 令牌: 连接。
+        self.udp_peers = dict()     # 已登记的UDP地址: 连接。
+        if udp_address is not None:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.bind(udp_address)
+            self.udp_socket.setblocking(False)
+            self.selector.register(self.udp_socket, selectors.EVENT_READ, 'UDP')
 
+        self.server_id = 0
+        self.record_dir = record_dir    # 对局记录的目录，None表示不记录（见Room）。
+        self.joining = dict()       # 还没有发来第一个报文的连接: 接受的时刻。
+        self.join_timeout = 10.0
         self.freq = 60  # 服务器迭代game并广播的频率。
         self.lock = threading.Lock()
         self.counter = 0    # 服务器计数器。
-        ''' 承载的游戏 '''
-        self.game = None
-
-        # self.send_cache_unique=[] 暂时不用写，对于策略类游戏，玩家间保持秘密的时候可以用。
+        self.max_catchup = 5    # 落后时一次最多追赶的步数。
+        # 每隔几个tick广播一次。客户端会对其他玩家做插值（SnapshotBuffer），调大它可以降低带宽而画面依然平滑。
+        self.broadcast_every = 1
+        self.last_broadcast = 0
+        self.n_overruns = 0     # 需要追赶的次数（上一轮的工作超过了一个步长）。
+        self.n_skipped = 0      # 因落后太多而丢弃的步数。
+        self.t_work_max = 0.0   # 最近一段时间里，一轮tick+广播的最长耗时（秒）。
+        # 压力测试（见bots.py）时设为列表（或deque）：记录每一轮tick+广播的耗时（秒），以及每个快照帧的字节数。
+        self.t_work_log = None
+        self.frame_size_log = None
+        self.profiling = False
+        self.profile_window = 10.0
+        self.profile_interval = None
+        ''' 所有的房间。只在事件循环线程中读写。 '''
+        self.rooms = []
+        ''' 游戏的生成函数，每个新房间调用一次，得到一个新的Game实例。 '''
+        self.game_factory = None
+        if game_factory:
+            self.bind(game_factory)
         '''
-        全局变量：服务器状态、消息列表
         服务器的状态：
             INITIATED,  初始化完成。
-            MATCHING,   玩家人数不够，匹配玩家中。（即使客户端没有进行CONNECTING）
-            PREPARING,  玩家人数足够，等待玩家确认开始。（或者一局游戏结束后等待玩家开始下一把）
-            PLAYING,    游戏中。(包含游戏结束等)
-        消息列表中存放要广播的信息。（不包含服务器状态和数据长度校验值）
+            RUNNING,    事件循环运行中。
+            CLOSED,     事件循环结束。
+        各房间有自己的状态（见Room）。
         '''
         self.mode = ThreadSafeVar('INITIATED')
-        # self.message_list = ThreadSafeList()
         print('服务器已创建，状态：INITIATED.')
 
-    def bind(self, _game):
-        self.game = _game
+    def bind(self, game_factory):
+        self.game_factory = game_factory
 
     def run(self):
-        # 运行一开始就创建广播线程。
-        threading.Thread(target=self.__thread_method_broadcast, name='broadcast').start()
-        # 先进入MATCHING.
-        self.mode.update('MATCHING')
-        # 服务器在匹配、准备、游戏运行等状态间一直循环。
-        while self.mode.get() != 'CLOSED':
-            if self.mode.get() == 'MATCHING':
-                self.__match()
-            elif self.mode.get() == 'PREPARING':
-                self.__prepare()
-            elif self.mode.get() == 'PLAYING':
-                self.__play()
-
-    def __match(self):
-        """
-        连接新客户端直到客户端列表已满;
-        所有新连接的客户端都得到一条广播通道，按固定频率广播全局变量消息列表。
-        广播信息：self.mode, 已连接的client_socket列表。
-        2023年12月5日00:44:53
-        广播通道在一开始就有了，这里不需要创建。
-        而是对于每一个客户端，创建一个接收即时数据的线程。
-        """
-        print('开始尝试处理客户端的连入，状态：MATCHING.')
-        while self.client_sockets.size() < self.game.n_players:
-            # 阻塞式等待并连接新客户端。
-            n = self.client_sockets.size()
-            client_socket = self.socket.accept()[0]
-            print('新连入客户端：', client_socket)
-            self.client_sockets.append(client_socket)
-            # 更新消息列表为已连接客户端的列表。（这样客户端就能得到自己的id）
-            # self.message_list.update_whole(self.client_sockets.get_whole())
-            # 对于每一个客户端，创建一个接收即时数据并进行处理的线程。
-            threading.Thread(target=self.__thread_method_recv,
-                             args=(self.client_sockets.size()-1, client_socket),
-                             name='recv_'+str(n)
-                             ).start()
-        # 连接数量足够，退出了while循环。
-        # 先等待一小会儿，让客户端有时间处理id, 然后再修改状态值。
-        time.sleep(2)
-        self.mode.update('PREPARING')
-
-    def __prepare(self):
+        """ 事件循环。处理所有连接的读写，并以固定频率调度tick. """
+        self.mode.update('RUNNING')
+        print('服务器开始运行，状态：RUNNING.')
+        dt = 1.0 / self.freq
+        t_next = time.perf_counter()
+        while self.mode.peek() != 'CLOSED':
+            # 等待IO事件，最多等到下一个tick.
+            timeout = max(0.0, t_next - time.perf_counter())
+            for key, events in self.selector.select(timeout):
+                if key.data is None:
+                    self.__accept()
+                    continue
+                if key.data == 'CONTROL':
+                    self.__control()
+                    continue
+                if key.data == 'UDP':
+                    self.__read_udp()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ:
+                    self.__read(conn)
+                if events & selectors.EVENT_WRITE and conn.socket.fileno() >= 0:
+                    self.__flush(conn)
+            # 固定步长：累计经过的时间，每满dt推进一步模拟；落后时连续追赶几步（最多max_catchup步），再广播一次。
+            # 落后太多（比如卡顿）时，超出的部分直接丢弃，不再追赶。
+            t_now = time.perf_counter()
+            if t_now < t_next:
+                continue
+            n_steps = int((t_now - t_next) / dt) + 1
+            if n_steps > self.max_catchup:
+                self.n_skipped += n_steps - self.max_catchup
+                n_steps = self.max_catchup
+                t_next = t_now - (n_steps - 1) * dt
+            if n_steps > 1:
+                self.n_overruns += 1
+            for _ in range(n_steps):
+                self.__tick(dt)
+                t_next += dt
+            if self.counter - self.last_broadcast >= self.broadcast_every:
+                self.last_broadcast = self.counter
+                self.__broadcast()
+                self.__ping()
+            t_work = time.perf_counter() - t_now
+            self.t_work_max = max(self.t_work_max, t_work)
+            if self.t_work_log is not None:
+                self.t_work_log.append(t_work)
+
+    def stats(self):
+        """ 本服务器（进程）的统计信息。 """
+        n_clients = 0
+        for room in self.rooms:
+            n_clients += room.n_players - room.slots.count(None)
+        return {'rooms': len(self.rooms),
+                'rooms_playing': sum(1 for room in self.rooms if room.mode == 'PLAYING'),
+                'clients': n_clients,
+                'ticks': self.counter,
+                'overruns': self.n_overruns,
+                'skipped': self.n_skipped,
+                'compression': compressor.stats()}
+
+    def profile(self):
         """
-        重置self.client_ready.
-        不断向所有客户端广播已就绪的客户端信息；
-        被动等待每个客户端recv子线程对self.client_ready的修改，直到全部为True;
-        注意！！！！：
-            由于已经有了广播子线程，且子线程会自动固定频率广播全局变量信息列表，
-            而每个客户端子线程也有了，会去修改全局变量客户端就绪列表。
-            所以本函数唯一需要做的就是清空就绪列表，然后修改服务器状态。
+        性能分析的结果（可以转成json）：{'window': 秒, 'all': 所有房间合并的各阶段, 'rooms': {房间id: 各阶段}}，
+        每个阶段是profiler.Histogram.summary()（秒）。已经回收的房间不再计入。没有开启时返回None.
         """
-        print('玩家人数足够，正在等待每位玩家就绪，状态：PREPARING.')
-        self.client_ready.memset(False)
-        while self.client_ready.any(False): # 每隔N秒检测是否全部就绪。
-            # 不断更改消息列表的值为就绪列表。
+        if not self.profiling:
+            return None
+        rooms = [room for room in self.rooms if room.profiler is not None]
+        return {'window': self.profile_window,
+                'all': profiler.summarize(profiler.merge(room.profiler for room in rooms)),
+                'rooms': {room.id: profiler.summarize(room.profiler.histograms()) for room in rooms}}
 
-            time.sleep(0.1)
-        # 先等待一小会儿，让客户端有时间处理, 然后再修改状态值。
-        time.sleep(2)
-        self.mode.update('PLAYING')
+    def __accept(self):
+        client_socket = self.socket.accept()[0]
+        self.__adopt(client_socket)
 
-    def __play(self):
+    def __control(self):
         """
-        重置游戏。
-        子线程（广播和接收）已经包揽了所有活。所以主线程就休眠，不去占用资源。
+        处理控制通道的命令：
+            {'cmd': 'client', 'first': 第一个报文}  附带一个客户端socket的文件描述符，接管该客户端；
+            {'cmd': 'stats'}   回复stats().
+        控制通道关闭（前端进程退出）时，结束事件循环。
         """
-        print('游戏开始，状态：PLAYING.')
-        self.game.reset()
-        while self.game.mode != 'QUIT':
-            # 每N秒检查一次状态。
-            time.sleep(2)
-        # 游戏结束，如果人数足够就进入就绪状态，否则进入匹配阶段（比如有人返回主菜单，则应该断开该客户端）。
-        self.mode.update('PREPARING')
-
-    # 子线程方法：以固定频率更新服务器并向所有客户端广播全局变量中的内容。
-    def __thread_method_broadcast(self):
-        """ 广播的内容：[服务器状态，[消息列表的内容]]. """
-        while self.mode.get() != 'QUIT':
-            dt = 1.0 / self.freq
-            client_sockets = self.client_sockets.get_whole()
-            if not client_sockets:
+        try:
+            msg, fds, _, _ = socket.recv_fds(self.control, 1024, 16)
+        except BlockingIOError:
+            return
+        if not msg:
+            self.mode.update('CLOSED')
+            return
+        cmd = json.loads(msg)
+        if cmd['cmd'] == 'client':
+            for fd in fds:
+                conn = self.__adopt(socket.socket(fileno=fd))
+                # 前端已经读出了第一个报文（JOIN或RESUME）。
+                if 'first' in cmd:
+                    self.__join(conn, cmd['first'])
+        elif cmd['cmd'] == 'stats':
+            self.control.send(json.dumps(self.stats()).encode())
+
+    def __adopt(self, client_socket):
+        """ 接管新的客户端，等待它的第一个报文（JOIN或RESUME，见__join）。 """
+        print('新连入客户端：', client_socket)
+        # 快照帧都是一次整帧发出的，关掉Nagle算法，不等上一帧的ACK.
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = Connection(client_socket, -1)
+        self.selector.register(conn.socket, selectors.EVENT_READ, conn)
+        self.joining[conn] = time.perf_counter()
+        return conn
+
+    def __join(self, conn, data):
+        """ 新连接的第一个报文：JOIN分配到房间；RESUME凭令牌回到原来的位置。其他报文、或者令牌无效，断开。 """
+        self.joining.pop(conn, None)
+        if data[0] == 'JOIN':
+            self.__place(conn)
+        elif not (data[0] == 'RESUME' and self.__resume(conn, data[1])):
+            print('无效的会话，断开：', data[0])
+            self.__disconnect(conn)
+
+    def __place(self, conn):
+        """ 把新的客户端分配到一个正在匹配且未满的房间；没有的话就新建一个房间。 """
+        for room in self.rooms:
+            if room.mode == 'MATCHING' and not room.full():
+                break
+        else:
+            room = Room(self.game_factory(), self.__send, self.freq, self.record_dir,
+                        self.profile_window if self.profiling else None)
+            self.rooms.append(room)
+        conn.session = (self.server_id << 48) | secrets.randbits(48)
+        room.add(conn)
+        self.__offer_udp(conn)
+
+    def __resume(self, conn, token):
+        """ 断线重连：找到令牌对应的保留位置，把新连接放回去。找不到（超时、这一局已结束）返回False. """
+        for room in self.rooms:
+            i_client = room.seat(token)
+            if i_client is not None:
+                break
+        else:
+            return False
+        old = room.slots[i_client]
+        if old is not None:
+            # 旧连接还没被发现断开（比如对方换了网络），以新连接为准。
+            self.__disconnect(old)
+        room.resume(conn, i_client)
+        self.__offer_udp(conn)
+        return True
+
+    def __offer_udp(self, conn):
+        """ 服务器支持UDP时，发给客户端UDP端口和本连接的令牌。 """
+        if self.udp_socket is not None:
+            conn.token = secrets.randbits(32)
+            self.udp_tokens[conn.token] = conn
+            self.__send(conn, ['UDP', conn.token, self.udp_socket.getsockname()[1]])
+
+    def __read_udp(self):
+        """ 接收UDP数据报：HELLO登记客户端的UDP地址并回复；已登记地址发来的其他报文（ACK）交给所在的房间。 """
+        while True:
+            try:
+                datagram, addr = self.udp_socket.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue
+            data = unpack_datagram(datagram)
+            if data is None:
+                continue
+            if data[0] == 'HELLO':
+                conn = self.udp_tokens.get(data[1])
+                if conn is None or conn.socket.fileno() < 0:
+                    continue
+                if conn.udp_addr is not None and conn.udp_addr != addr:
+                    self.udp_peers.pop(conn.udp_addr, None)
+                conn.udp_addr = addr
+                self.udp_peers[addr] = conn
+                self.__sendto(conn, b''.join(pack(['HELLO', conn.token])))
                 continue
-            for i_client, client_socket in enumerate(client_sockets):
-                if self.mode.get() == 'MATCHING':
-                    send(client_socket, ['MATCHING', i_client])
-                elif self.mode.get() == 'PREPARING':
-                    send(client_socket, ['PREPARING', self.client_ready.get_whole()])
-                # 游戏状态下，更新游戏，然后广播game_status.
-                elif self.mode.get() == 'GAMING':
-                    self.game.update_by_dt(dt)
-                    send(client_socket, ['GAMING', self.game.get_status()])
-            # 计数并print，便于调试。
-            self.counter += 1
-            if self.counter % 100 == 0:
-                print('broadcast', 100, 'times.')
-            time.sleep(dt)
-
-    # 子线程方法（每个客户端套接字有一个）：接收客户端信息。若断开，从客户端列表中删除。
-    def __thread_method_recv(self, i_client, client_socket):
+            conn = self.udp_peers.get(addr)
+            if conn is not None and data[0] == 'ACK':
+                conn.link.add_in(len(datagram))
+                conn.t_udp = time.perf_counter()
+                conn.room.handle(conn.id, data)
+
+    def __sendto(self, conn, datagram):
+        """ 发送一个UDP数据报。发不出去（缓冲区满等）就算了，快照帧本来就允许丢失。 """
+        try:
+            self.udp_socket.sendto(datagram, conn.udp_addr)
+            conn.link.add_out(len(datagram))
+        except OSError:
+            pass
+
+    def __read(self, conn):
+        """ 接收客户端的数据并交给所在的房间处理。若断开，从房间中删除。 """
         try:
-            while True:
-                # MATCHING阶段本线程被创建，但服务器能就地统计连接数量，故不接收信息。
-                # PREPARING阶段，若接收到‘READY'开头的报文，就不断修改client_ready列表。
-                data = recv(client_socket)
-                if data:
-                    print('msg from', i_client, data)
-                    if self.mode.get() == 'PREPARING':
-                        if data[0] == 'READY':
-                            print('更新就绪列表')
-                            self.client_ready.update(i_client, True)
-                    # GAMING阶段，若接收到’GAMING'开头的报文，那么后面的部分就是actions.
-                    elif self.mode.get() == 'GAMING':
-                        if data and data[0] == 'GAMING':
-                            actions = data[1]
-                            self.game.update_by_actions(i_client, actions)
-        except Exception as e:
+            messages = conn.feed()
+        except (ConnectionError, OSError, ValueError, IndexError, KeyError, TypeError, struct_error) as e:
             print(f"Error handling client: {e}")
-        finally:
-            # 客户端断开连接，移除它
-            self.client_sockets.pop(client_socket, index=False)
-            client_socket.close()
+            self.__disconnect(conn)
+            return
+        for data in messages:
+            # 格式不对的报文（字段缺失、类型或取值不对）只断开发送它的客户端，不影响事件循环和其他房间。
+            try:
+                # PING立即原样回复；PONG是对服务器的PING的回复。
+                if data[0] == 'PING':
+                    self.__send(conn, ['PONG', data[1], data[2]])
+                elif data[0] == 'PONG':
+                    conn.link.pong(data[1], data[2], time.perf_counter())
+                elif conn.room is None:
+                    self.__join(conn, data)
+                else:
+                    conn.room.handle(conn.id, data)
+            except (ValueError, IndexError, KeyError, TypeError, struct_error) as e:
+                print(f"Error handling client: {e}")
+                self.__disconnect(conn)
+                return
+            if conn.socket.fileno() < 0:
+                return
+
+    def __send(self, conn, data):
+        """ 把数据放入连接的发送缓冲区，并尽量发送。发不完的话，等socket可写时再继续发送。 """
+        if conn.socket.fileno() < 0:
+            return
+        room = conn.room
+        if isinstance(data, Packet):
+            packet = data
+        else:
+            packet = room.timed('encode', Packet, data) if room is not None else Packet(data)
+        if self.frame_size_log is not None and packet.name == 'GAMING':
+            self.frame_size_log.append(packet.size)
+        if room is not None:
+            room.timed('send', self.__deliver, conn, packet, data)
+        else:
+            self.__deliver(conn, packet, data)
+
+    def __deliver(self, conn, packet, data):
+        """ 把已编码的数据包交给连接：游戏中的快照帧走UDP，其他的放入TCP发送缓冲区。 """
+        # 游戏进行中的快照帧，客户端登记了UDP、并且最近从UDP收到过它的ACK，就走UDP；UDP不通时自动退回TCP.
+        if conn.udp_addr is not None and packet.name == 'GAMING' and packet.size <= UDP_MAX \
+                and not isinstance(data, Packet) and data[1][2]['mode'] == 'RUNNING' \
+                and time.perf_counter() - conn.t_udp <= conn.udp_timeout:
+            self.__sendto(conn, b''.join(packet.chunks))
+            return
+        conn.queue(packet)
+        self.__flush(conn)
+        if conn.socket.fileno() >= 0 and conn.congested():
+            print(f"客户端发送队列拥塞，断开：{conn.pending}字节")
+            self.__disconnect(conn)
+
+    def __flush(self, conn):
+        try:
+            done = conn.flush()
+        except OSError as e:
+            print(f"Error handling client: {e}")
+            self.__disconnect(conn)
+            return
+        events = selectors.EVENT_READ if done else selectors.EVENT_READ | selectors.EVENT_WRITE
+        self.selector.modify(conn.socket, events, conn)
+
+    def __disconnect(self, conn):
+        # 客户端断开连接，从房间中移除它
+        if conn.socket.fileno() >= 0:
+            self.selector.unregister(conn.socket)
+            conn.close()
+            self.joining.pop(conn, None)
+            if conn.room is not None:
+                conn.room.remove(conn)
+            self.udp_tokens.pop(conn.token, None)
+            self.udp_peers.pop(conn.udp_addr, None)
+
+    def __tick(self, dt):
+        """ 推进所有房间一步，并回收已关闭的房间。每秒检查一次迟迟不发来第一个报文的连接。 """
+        for room in self.rooms:
+            room.timed('step', room.step, dt)
+        self.rooms = [room for room in self.rooms if room.mode != 'CLOSED']
+        # 计数并print，便于调试。
+        self.counter += 1
+        if self.joining and self.counter % self.freq == 0:
+            t_now = time.perf_counter()
+            for conn, t_accept in list(self.joining.items()):
+                if t_now - t_accept > self.join_timeout:
+                    print('客户端没有发来JOIN或RESUME，断开。')
+                    self.__disconnect(conn)
+        if self.counter % 600 == 0:
+            print('tick', self.counter, '房间数：', len(self.rooms), '追赶：', self.n_overruns, '丢弃：', self.n_skipped,
+                  '最长耗时(ms)：', round(self.t_work_max * 1000, 2))
+            self.t_work_max = 0.0
+        if self.profiling and self.profile_interval and self.counter % round(self.profile_interval * self.freq) == 0:
+            print(profiler.report(self.profile()))
+
+    def __broadcast(self):
+        for room in self.rooms:
+            room.timed('broadcast', room.broadcast)
+
+    def __ping(self):
+        """ 到时间的连接各发一个PING. """
+        t_now = time.perf_counter()
+        for room in self.rooms:
+            for conn in room.slots:
+                if conn is None:
+                    continue
+                ping = conn.link.ping(t_now)
+                if ping is not None:
+                    self.__send(conn, ping)
+
 
+class SnapshotBuffer:
     """
-    待升级（IO多路复用技术）：
-    # 子线程方法：接收actions，更新游戏状态。(用select)
-    def __thread_method_recv_v2(self, i_client, client_socket):
-        return
-
-    # 子线程方法：接收actions，更新游戏状态。(用epoll)
-    def __thread_method_recv_v3(self, i_client, client_socket):
-        return
-    
-    # 原子操作：对self.client_sockets进行增删。
-    def __atomic_update_client_sockets(self,client_socket,mode):
+    客户端的快照插值缓冲区（线程安全）：接收线程放入快照，绘制线程取出其他玩家在某个时刻的位置。
+    其他玩家不是直接画在最新快照的位置上（快照到达的时间有抖动，会一顿一顿的），
+    而是画在稍早一点的服务器时间（当前估计的服务器时间 - delay）上，在前后两个快照之间线性插值；
+    如果这个时刻之后的快照还没到（迟到、丢失），就按最后两个快照的速度外推，最多外推max_extrapolate秒。
+    delay取快照间隔的两倍（且不少于min_delay），所以降低服务器的广播频率后画面依然平滑。
+    """
+    def __init__(self, size=32):
+        self.lock = threading.Lock()
+        self.size = size
+        self.items = []         # [(服务器时间t, {玩家下标: (x, y)})]，按t排列。
+        self.offset = None      # 服务器时间 - 本地时间 的估计值。
+        self.interval = 1 / 60  # 快照的平均间隔（服务器时间，秒）。
+        self.min_delay = 0.05
+        self.max_extrapolate = 0.25
+
+    def push(self, snapshot, t_local):
+        """ 放入一个完整的快照（带有服务器时间t），t_local是收到它的本地时间。 """
+        t = snapshot.get('t')
+        if t is None:
+            return
+        positions = {i: tuple(state['pos']) for i, state in enumerate(snapshot['explorers'])
+                     if 'pos' in state and state.get('visible', 1)}
         with self.lock:
-            if mode.lower()=='add':
-                if client_socket not in self.client_sockets:
-                    self.client_sockets.append(client_socket)
-            elif mode.lower()=='discard':
-                if client_socket in self.client_sockets:
-                    self.client_sockets.remove(client_socket)
-
-    # 原子操作：对self.client_ready进行更改。
-    def __atomic_update_client_ready(self,i_client,mode='flip'):
+            # 服务器时间倒退（换了服务器/房间），重新开始。
+            if self.items and t <= self.items[-1][0]:
+                if t < self.items[-1][0]:
+                    self.items.clear()
+                    self.offset = None
+                else:
+                    return
+            if self.items:
+                self.interval += 0.1 * (t - self.items[-1][0] - self.interval)
+            self.items.append((t, positions))
+            del self.items[:-self.size]
+            # 时钟偏移：到得越早的快照越接近真实的偏移，所以向上立即跟随，向下缓慢跟随（时钟漂移）。
+            sample = t - t_local
+            if self.offset is None or sample > self.offset:
+                self.offset = sample
+            else:
+                self.offset += 0.01 * (sample - self.offset)
+
+    def delay(self):
+        return max(self.min_delay, 2 * self.interval)
+
+    def sample(self, t_local):
+        """ 本地时刻t_local应该绘制的其他玩家位置{玩家下标: (x, y)}. """
         with self.lock:
-            if mode.lower()=='check':
-                return all(self.client_ready)
-            elif mode.lower()=='flip':
-                self.client_ready[i_client] = True
-            elif mode.lower()=='clear':
-                for i in range(self.max_clients):
-                    self.client_ready[i]=False
-
-    def __broadcast(self,data,add_id=False):
-        for i_client,client_socket in enumerate(self.client_sockets):
-            if add_id:
-                send(client_socket,data+'|'+str(i_client))
+            if not self.items:
+                return dict()
+            t = t_local + self.offset - self.delay()
+            # 找到t前后的两个快照。
+            for j in range(len(self.items) - 1, -1, -1):
+                if self.items[j][0] <= t:
+                    break
             else:
-                send(client_socket,data)
-    """
+                return dict(self.items[0][1])
+            t_a, pos_a = self.items[j]
+            if j + 1 < len(self.items):
+                t_b, pos_b = self.items[j + 1]
+                alpha = (t - t_a) / (t_b - t_a)
+            elif j > 0:
+                # 外推：沿着最后两个快照的方向继续走一段。
+                t_b, pos_b = t_a, pos_a
+                t_a, pos_a = self.items[j - 1]
+                alpha = (min(t, t_b + self.max_extrapolate) - t_a) / (t_b - t_a)
+            else:
+                return dict(pos_a)
+            positions = dict()
+            for i, (x_b, y_b) in pos_b.items():
+                if i not in pos_a:
+                    positions[i] = (x_b, y_b)
+                    continue
+                x_a, y_a = pos_a[i]
+                positions[i] = (x_a + (x_b - x_a) * alpha, y_a + (y_b - y_a) * alpha)
+            return positions
 
 
 class NetworkClient:
-    def __init__(self,server_host,server_port):
+    """
+    断线重连：连接后先发JOIN，服务器分到位置时发来会话令牌（SESSION）。游戏中连接断开时，接收线程在grace秒内
+        不断重连并发送['RESUME', 令牌]，回到原来的位置（服务器为它保留位置，见Room），收到地图和关键帧后继续；
+        重连期间发出的报文（动作等）直接丢弃。
+    UDP（可选，use_udp）：服务器通过TCP发来['UDP', 令牌, 端口]后，客户端用令牌向该端口登记自己的UDP地址，
+        之后游戏中的快照帧走UDP（乱序到达的旧快照直接丢弃），ACK也走UDP；其他的报文仍然走TCP.
+        服务器不支持UDP、或者UDP不通时，一切照旧走TCP.
+    """
+    def __init__(self,server_host,server_port, use_udp=True):
         self.server_host=server_host
         self.server_port=server_port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 动作报文很小，关掉Nagle算法，攒好的一批立即发出，不等上一个报文的ACK.
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.use_udp = use_udp
+        self.udp_socket = None
+        self.udp_token = None       # 服务器发来的UDP令牌（每条TCP连接一个，重连后更换）。
+        self.udp_ready = False      # 服务器已确认了UDP登记。
+        # 游戏中udp_timeout秒都没有收到UDP数据报，就认为UDP不通了：清除udp_ready，ACK改走TCP，并重新登记。
+        self.t_udp = 0.0
+        self.udp_timeout = 1.0
+        # 会话令牌（服务器分到位置时发来），以及断线后重连的时限（秒，和服务器为断线玩家保留位置的时间一致）。
+        self.session = None
+        self.grace = 10.0
 
         self.id = None
         self.server_socket = None
         self.is_connected = False
         self.is_prepared = False
+        # 状态切换的事件，由接收线程在收到对应报文时设置，connect和prepare直接等待，不轮询。
+        self.matched = threading.Event()    # 收到MATCHING（得到本机id）。
+        self.started = threading.Event()    # 收到一局游戏的第一个快照帧。
+        self.want_ready = False             # 本机已点击就绪，等待游戏开始。
+        # 重连、新地图或关键帧之后置为True：服务器那边人物的方向可能已经和本地按键不一致（比如断线时被停下），
+        # 界面线程看到后把按键状态完整地发一次（见Game.direction_actions）并清除。
+        self.resync = False
 
         # 几个全局变量,让子线程不断刷新这几个变量。其中events需要interface去刷新。
         # self.n_client_connected=None
@@ -431,12 +1670,37 @@ class NetworkClient:
         # self.server_mode = ThreadSafeVar('INITIATED')
         # 接收数据列表(阻塞式即使接收)(第一个值永远是服务器的状态)
         self.message_list = ThreadSafeList()
-        '''
-        键盘鼠标事件，由外界刷新。但这里要注意几点：
-            EventVar内置了event，有唤醒机制。
-            内部的变量，即键盘鼠标事件本身，必须是可序列化的！！
-        '''
-        self.events = EventVar()
+        # 键盘鼠标产生的动作，由界面每帧放入，发送线程成批发出（见Outbox）。
+        self.outbox = Outbox()
+        # 多个线程（就绪、发送动作、回复ACK）都会向服务器发送，需要互斥，防止报文交错。
+        self.send_lock = threading.Lock()
+        ''' 承载的游戏（用于从差分中还原快照） '''
+        self.game = None
+        # 最近收到的快照 tick: 快照（按tick递增的顺序）。服务器发来的差分以其中某个快照为基准。
+        self.snapshots = collections.OrderedDict()
+        self.n_history = 120
+        # 最近还原的完整快照。message_list里的可能已经是一局结束后的PREPARING.
+        self.snapshot = None
+        # 插值缓冲区：按服务器时间排列的最近的快照，用于平滑地绘制其他玩家。
+        self.buffer = SnapshotBuffer()
+        # TCP和UDP两个接收线程都会处理快照帧，需要互斥。last_tick是已处理的最新快照帧，更旧的直接丢弃。
+        self.recv_lock = threading.Lock()
+        self.last_tick = -1
+        # 网络状况：本机测得的与服务器之间的统计，以及服务器测得的每个玩家的[(RTT毫秒, 丢包百分比), ...]。
+        self.link = LinkStats()
+        self.peer_net = []
+
+    def bind(self, _game):
+        self.game = _game
+
+    def send(self, data):
+        """ 线程安全地向服务器发送数据。有会话（可以重连）时，断线期间发送失败的报文直接丢弃。 """
+        with self.send_lock:
+            try:
+                self.link.add_out(send(self.socket, data))
+            except OSError:
+                if self.session is None:
+                    raise
 
     def connect(self):
         """
@@ -449,41 +1713,89 @@ class NetworkClient:
         self.socket.connect((self.server_host, self.server_port))
         self.is_connected = True
         print('已连接至服务器')
-        # 每隔N秒检查接收区，当接收到服务器MATCHING状态的数据后根据data计算本客户端id.
-        while self.message_list.empty() or self.message_list.get(0) == 'INITIATED':
-            print(self.message_list.get_whole())
-            time.sleep(0.1)
-        # 计算本机id.
-        print('开始计算本机id')
-        self.id = self.message_list.get(1)
-        ''' 
-        for i, client_socket in enumerate(client_sockets):
-            if self.socket == client_socket:
-                self.id = i
-                '''
+        self.send(['JOIN'])
+        threading.Thread(target=self.__thread_method_ping, name='client_ping', daemon=True).start()
+        # 服务器接受连接后立即发来MATCHING，其中是本客户端的id（由接收线程设置）。
+        self.matched.wait()
         print('本客户端id: ', self.id)
 
     def prepare(self):
         """
-        主动向服务器每隔N秒发送一次‘READY’.
-        被动不断接收来自服务器的关于就绪人数的广播。
+        向服务器发送一次‘READY’，然后等待游戏开始（最后一位玩家就绪时服务器立即开始）。
+        等待期间若收到的就绪列表里本机仍未就绪（比如有人离开后房间重新匹配），接收线程会再发一次READY.
         """
         print('本机已就绪')
-        while self.message_list.empty() or self.message_list.get(0) != 'GAMING':
-            # 注意这里要发送列表，以和后面的GAMING的报文的格式保持一致。
-            send(self.socket, ['READY'])
-            time.sleep(2)
+        self.started.clear()
+        self.want_ready = True
+        # 注意这里要发送列表，以和后面的ACTIONS的报文的格式保持一致。
+        self.send(['READY'])
+        self.started.wait()
+        self.want_ready = False
         self.is_prepared = True
         print('本机和其他玩家已全部就绪，进入游戏。')
 
+    def post_actions(self, seq, actions):
+        """ 界面线程调用：把这一帧的动作放进发件箱，不阻塞。 """
+        self.outbox.post(seq, actions)
+
     def play(self):
-        """ send events to server. """
-        self.events.start()
-        while self.message_list.empty() or self.message_list.get(0) != 'GAMEOVER':
-            print('events updated and send:', self.events.get())
-            self.events.handle(send, self.socket)
+        """ 发送线程：把发件箱里积攒的动作成批发给服务器，每批一个报文。 """
+        while not (self.game is not None and self.game.mode == 'GAMEOVER'):
+            data = self.outbox.take(0.1)
+            if data is not None:
+                self.send(data)
+        # 最后再清空一次发件箱。
+        data = self.outbox.take(0)
+        if data is not None:
+            self.send(data)
         print('本局游戏结束。')
 
+    def net_status(self):
+        """ 每个玩家的网络状况，用于绘制：本机是自己测得的完整统计，其他玩家是服务器测得的RTT和丢包率。 """
+        status = {i: {'rtt': rtt, 'loss': loss} for i, (rtt, loss) in enumerate(self.peer_net)}
+        if self.id is not None:
+            status[self.id] = self.link.summary()
+        return status
+
+    def __rebuild_snapshot(self, tick, base_tick, content):
+        """
+        根据快照帧[tick, base_tick, 内容]还原完整快照，并回复ACK.
+        帧中附带的地图脏块直接覆盖到本地的游戏镜像，不放入快照。
+        若作为基准的快照已经不在本地，则请求关键帧，返回None.
+        """
+        cells = content.pop('cells', None)
+        net = content.pop('net', None)
+        if net is not None:
+            self.peer_net = net
+        if base_tick < 0:
+            snapshot = content
+        else:
+            base = self.snapshots.get(base_tick)
+            if base is None:
+                self.__send_ack(-1)
+                return None
+            snapshot = self.game.patch_snapshot(base, content)
+            for key in ('t', 'ack_seq', 'ack_dt'):
+                snapshot[key] = content[key]
+        if cells:
+            self.game.apply_map_cells(snapshot['map_id'], cells)
+        self.snapshots[tick] = snapshot
+        # 收到的tick不一定连续（自适应的发送频率、UDP丢包），淘汰所有早于tick - n_history的快照。
+        while next(iter(self.snapshots)) <= tick - self.n_history:
+            self.snapshots.popitem(last=False)
+        self.__send_ack(tick)
+        return snapshot
+
+    def __send_ack(self, tick):
+        """ 回复ACK. UDP可用时走UDP（丢了也没关系，后面的ACK会覆盖）。 """
+        if self.udp_ready:
+            try:
+                self.link.add_out(self.udp_socket.send(b''.join(pack(['ACK', tick]))))
+                return
+            except OSError:
+                pass
+        self.send(['ACK', tick])
+
     '''
     def __thread_method_send(self):
         """ send events to server. """
@@ -494,28 +1806,180 @@ class NetworkClient:
     '''
     def __thread_method_recv(self):
         """ recv game_status from server. """
+        reader = FrameReader()
         # while self.is_connected:
         while True:
             if not self.is_connected:
                 continue
-            msg = recv(self.socket)
-            if msg:
-                server_mode, data = msg[0], msg[1]
-                self.message_list.update_whole(server_mode, data)
-                '''
-                # 服务器正处于匹配状态，计算本客户端的id并不断刷新全局变量.
-                if msg[0] == 'MATCHING':
-                    client_sockets = msg[1]
-                    for i, client_socket in enumerate(client_sockets):
-                        if self.socket == client_socket:
-                            self.id = i
-                # 服务器正处于准备就绪状态，不断修改全局变量为发来的就绪列表.
-                elif msg[0] == 'PREPARING':
-                    self.clients_ready = msg[1]
-                # 服务器正处于游戏状态，不断修改全局变量game_status.
-                elif msg[0] == 'GAMING':
-                    self.game_status = msg[1]
-                    '''
+            n_bytes = reader.n_bytes
+            try:
+                messages = reader.read(self.socket)
+            except (ConnectionError, OSError, ValueError) as e:
+                print('与服务器的连接断开：', e)
+                reader = self.__reconnect()
+                if reader is None:
+                    self.is_connected = False
+                    return
+                continue
+            self.link.add_in(reader.n_bytes - n_bytes)
+            for msg in messages:
+                self.__handle(msg)
+
+    def __reconnect(self):
+        """
+        接收线程：连接断开后，在grace秒内不断重连，用会话令牌恢复原来的位置。
+        服务器接受时第一个报文是SESSION（之后是MATCHING、地图和关键帧）。成功返回新连接的拆包器，否则返回None.
+        """
+        if self.session is None:
+            return None
+        t_end = time.perf_counter() + self.grace
+        while time.perf_counter() < t_end:
+            try:
+                new_socket = socket.create_connection((self.server_host, self.server_port), timeout=1.0)
+            except OSError:
+                time.sleep(0.5)
+                continue
+            new_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            reader = FrameReader()
+            try:
+                send(new_socket, ['RESUME', self.session])
+                messages = reader.read(new_socket)
+            except (ConnectionError, OSError, ValueError):
+                # 服务器不再为本机保留位置（超时、这一局已结束），不再重连。
+                new_socket.close()
+                break
+            new_socket.settimeout(None)
+            with self.send_lock:
+                self.socket.close()
+                self.socket = new_socket
+            # UDP要用新连接的令牌重新登记。
+            self.udp_ready = False
+            print('已重连，回到原来的位置。')
+            self.link.add_in(reader.n_bytes)
+            for msg in messages:
+                self.__handle(msg)
+            return reader
+        print('重连失败。')
+        self.session = None
+        return None
+
+    def __thread_method_ping(self):
+        """ 每隔一小段时间检查一次，到时间就向服务器发送PING. """
+        while True:
+            ping = self.link.ping(time.perf_counter())
+            if ping is not None:
+                try:
+                    self.send(ping)
+                except OSError:
+                    return
+            time.sleep(0.1)
+
+    def __thread_method_udp(self, port):
+        """
+        UDP接收线程：登记（每隔0.5秒用当前的令牌发送一次HELLO，直到服务器回复），然后接收快照帧。
+        重连后令牌更换、udp_ready被清除，会重新登记。游戏中UDP断了（见udp_timeout）也清除udp_ready，ACK改走TCP，
+        并重新登记；服务器收不到UDP的ACK，快照帧也会退回TCP，等UDP恢复、重新收到UDP的ACK后再改回UDP.
+        """
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.connect((self.server_host, port))
+        self.udp_socket.settimeout(0.5)
+        while True:
+            if self.udp_ready and self.snapshot is not None and self.snapshot['mode'] == 'RUNNING' \
+                    and time.perf_counter() - self.t_udp > self.udp_timeout:
+                self.udp_ready = False
+            if not self.udp_ready:
+                try:
+                    self.udp_socket.send(b''.join(pack(['HELLO', self.udp_token])))
+                except OSError:
+                    pass
+            try:
+                datagram = self.udp_socket.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                # 比如ICMP端口不可达，UDP不通，继续走TCP.
+                time.sleep(0.5)
+                continue
+            self.link.add_in(len(datagram))
+            msg = unpack_datagram(datagram)
+            if msg is None:
+                continue
+            self.t_udp = time.perf_counter()
+            if msg[0] == 'HELLO':
+                self.udp_ready = msg[1] == self.udp_token
+                continue
+            self.__handle(msg)
+
+    def __handle(self, msg):
+        """ 处理服务器发来的一个数据包。 """
+        if not msg:
+            return
+        server_mode, data = msg[0], msg[1]
+        # 服务器的PING立即原样回复；PONG是对本机PING的回复。
+        if server_mode == 'PING':
+            self.send(['PONG', msg[1], msg[2]])
+            return
+        if server_mode == 'PONG':
+            self.link.pong(msg[1], msg[2], time.perf_counter())
+            return
+        # 服务器支持UDP，登记自己的UDP地址（重连后只需要换上新的令牌）。
+        if server_mode == 'UDP':
+            self.udp_token = msg[1]
+            self.udp_ready = False
+            if self.use_udp and self.udp_socket is None:
+                threading.Thread(target=self.__thread_method_udp, args=(msg[2],), name='client_udp',
+                                 daemon=True).start()
+            return
+        if server_mode == 'SESSION':
+            self.session = data
+            self.resync = True
+            return
+        # 每局开始时收到一次地图，直接交给本地的游戏镜像。
+        if server_mode == 'MAP':
+            with self.recv_lock:
+                self.game.load_map(data)
+                self.last_tick = -1
+                self.snapshots.clear()
+            self.resync = True
+            return
+        # 分到房间，记下本机id.
+        if server_mode == 'MATCHING':
+            self.id = data
+            self.matched.set()
+        # 已经点击就绪，但服务器的就绪列表里本机未就绪（房间重新匹配过），再发一次READY.
+        elif server_mode == 'PREPARING':
+            if self.want_ready and self.id is not None and self.id < len(data) and not data[self.id]:
+                self.send(['READY'])
+        # 游戏中收到的是快照帧，先还原成完整的快照。
+        elif server_mode == 'GAMING':
+            with self.recv_lock:
+                # 乱序到达的旧快照帧（UDP），直接丢弃。
+                if data[0] <= self.last_tick:
+                    return
+                data = self.__rebuild_snapshot(*data)
+                if data is None:
+                    return
+                self.last_tick = msg[1][0]
+                self.snapshot = data
+                if msg[1][1] < 0:
+                    self.resync = True
+            self.buffer.push(data, time.perf_counter())
+            self.started.set()
+        self.message_list.update_whole(server_mode, data)
+        '''
+        # 服务器正处于匹配状态，计算本客户端的id并不断刷新全局变量.
+        if msg[0] == 'MATCHING':
+            client_sockets = msg[1]
+            for i, client_socket in enumerate(client_sockets):
+                if self.socket == client_socket:
+                    self.id = i
+        # 服务器正处于准备就绪状态，不断修改全局变量为发来的就绪列表.
+        elif msg[0] == 'PREPARING':
+            self.clients_ready = msg[1]
+        # 服务器正处于游戏状态，不断修改全局变量game_status.
+        elif msg[0] == 'GAMING':
+            self.game_status = msg[1]
+            '''
 
 
 
@@ -0,0 +1,206 @@
+"""
+功能：
+    服务器tick的性能分析。记录每个房间每个阶段的耗时，保存为滚动的直方图（只保留最近window秒），用来找出服务器的时间花在哪里。
+    阶段（见network.Room和network.NetworkServer）：
+        step,       一个房间的一个tick（包含下面的update、snapshot）；
+        actions,    Game.update_by_actions，把一批动作交给游戏；
+        update,     Game.update_by_dt；
+        snapshot,   Game.get_snapshot，生成快照；
+        broadcast,  一次广播（包含下面的frame、encode、send）；
+        frame,      为一个客户端生成快照帧（视野裁剪、差分、地图块）；
+        encode,     编码（和压缩）一个报文；
+        send,       把一个报文交给一个客户端的连接（TCP的发送缓冲区或UDP）；
+        lock_wait,  等待Game.lock的时间（每次获取都记录，没有竞争时几乎为0）。
+    开销：不开启时每个阶段只多一次判断；开启时每个阶段多两次time.perf_counter()和一次直方图计数。
+    直方图按对数刻度分桶（每个2倍区间SUB个桶），分位数取所在桶的上界，误差不超过25%。
+用法：
+    server.profile_interval = 10.0   # NetworkServer开启性能分析，每10秒打印一次汇总
+    print(profiler.report(server.profile()))   # 随时取出（在事件循环线程中调用）
+"""
+import collections
+import math
+import time
+
+SUB = 4             # 每个2倍区间的桶数。
+N_BUCKETS = 1 + 25 * SUB    # 第0个桶是不到1微秒的，最大的桶约为2^25微秒（33秒）。
+
+
+def bucket(t):
+    """ 耗时t（秒）所在的桶。 """
+    us = t * 1e6
+    if us < 1.0:
+        return 0
+    m, e = math.frexp(us)    # us = m * 2^e, 0.5 <= m < 1
+    return min(N_BUCKETS - 1, 1 + (e - 1) * SUB + int((2 * m - 1) * SUB))
+
+
+def bucket_upper(i):
+    """ 第i个桶的上界（秒）。 """
+    if i == 0:
+        return 1e-6
+    e, sub = divmod(i - 1, SUB)
+    return 2 ** e * (1 + (sub + 1) / SUB) * 1e-6
+
+
+class Histogram:
+    """ 耗时的直方图：各桶的计数，以及样本数、总耗时和最大值（秒）。 """
+    __slots__ = ('counts', 'n', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * N_BUCKETS
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, t):
+        self.counts[bucket(t)] += 1
+        self.n += 1
+        self.total += t
+        if t > self.max:
+            self.max = t
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            if count:
+                self.counts[i] += count
+        self.n += other.n
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        """ 第q百分位数的估计（所在桶的上界，不超过最大值）。 """
+        if self.n == 0:
+            return 0.0
+        rank = q / 100 * self.n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bucket_upper(i), self.max)
+        return self.max
+
+    def summary(self):
+        """ 样本数、总耗时、平均值、p50/p90/p99、最大值（秒）。 """
+        return {'n': self.n, 'total': self.total, 'mean': self.total / self.n if self.n else 0.0,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99), 'max': self.max}
+
+
+class TimedLock:
+    """
+    包装一个threading.Lock，记录每次获取时等待的时间。用法和Lock相同（with、acquire、release）。
+    先尝试不阻塞地获取：没有竞争时不调用time.perf_counter()，只记录0.
+    """
+    def __init__(self, lock, record):
+        self.lock = lock
+        self.record = record    # record(等待的秒数)
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.record(0.0)
+            return True
+        if not blocking:
+            return False
+        t0 = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.record(time.perf_counter() - t0)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+
+class TickProfiler:
+    """
+    一个房间的性能分析：每个阶段一个滚动的直方图。
+    时间分成长度为slot秒的时间片，每个时间片一个直方图，只保留最近n_slots个；roll()由房间每个tick调用一次。
+    """
+    def __init__(self, slot=1.0, n_slots=10):
+        self.slot = slot
+        self.n_slots = n_slots
+        self.phases = dict()    # 阶段名: deque([Histogram])，最后一个是当前的时间片。
+        self.t_slot = time.perf_counter()
+
+    def add(self, name, t):
+        """ 记录阶段name的一次耗时t（秒）。 """
+        slots = self.phases.get(name)
+        if slots is None:
+            slots = self.phases[name] = collections.deque([Histogram()], maxlen=self.n_slots)
+        slots[-1].add(t)
+
+    def timed(self, name, func, *args):
+        """ 调用func(*args)，把耗时记为阶段name，返回func的返回值。 """
+        t0 = time.perf_counter()
+        result = func(*args)
+        self.add(name, time.perf_counter() - t0)
+        return result
+
+    def recorder(self, name):
+        """ 只接受耗时的记录函数（给TimedLock用）。 """
+        return lambda t: self.add(name, t)
+
+    def roll(self, t_now):
+        """ 到了下一个时间片，每个阶段开始一个新的直方图，最旧的自动丢弃。 """
+        if t_now - self.t_slot < self.slot:
+            return
+        self.t_slot = t_now
+        for slots in self.phases.values():
+            slots.append(Histogram())
+
+    @property
+    def window(self):
+        return self.slot * self.n_slots
+
+    def histograms(self):
+        """ 每个阶段最近window秒的直方图（合并各时间片）。 """
+        merged = dict()
+        for name, slots in self.phases.items():
+            histogram = merged[name] = Histogram()
+            for part in slots:
+                histogram.merge(part)
+        return merged
+
+
+def merge(profilers):
+    """ 把多个TickProfiler（比如一个进程里的所有房间）的直方图按阶段合并。 """
+    merged = dict()
+    for _profiler in profilers:
+        for name, histogram in _profiler.histograms().items():
+            merged.setdefault(name, Histogram()).merge(histogram)
+    return merged
+
+
+def summarize(histograms):
+    """ {阶段名: Histogram} -> {阶段名: summary()}，可以转成json. """
+    return {name: histogram.summary() for name, histogram in histograms.items()}
+
+
+def report(profile, top=3):
+    """
+    把NetworkServer.profile()的结果排成文本：所有房间合并的各阶段（按总耗时排序），以及总耗时最多的top个房间。
+    耗时的单位是微秒，占比是总耗时占时间窗口的百分比（单线程的事件循环，所有阶段共用这一个线程）。
+    """
+    window = profile['window']
+    lines = ['性能分析（最近%g秒，房间数：%d）' % (window, len(profile['rooms']))]
+
+    def table(summaries, indent):
+        for name, s in sorted(summaries.items(), key=lambda item: -item[1]['total']):
+            lines.append('%s%-10s n %8d  占比 %6.2f%%  平均 %8.1f  p50 %8.1f  p90 %8.1f  p99 %8.1f  max %9.1f  us'
+                         % (indent, name, s['n'], s['total'] / window * 100, s['mean'] * 1e6,
+                            s['p50'] * 1e6, s['p90'] * 1e6, s['p99'] * 1e6, s['max'] * 1e6))
+
+    table(profile['all'], '  ')
+    busiest = sorted(profile['rooms'].items(), key=lambda item: -sum(s['total'] for s in item[1].values()))
+    for room_id, summaries in busiest[:top]:
+        lines.append('  房间 %s：' % room_id)
+        table(summaries, '    ')
+    return '\n'.join(lines)
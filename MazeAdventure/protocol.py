@@ -0,0 +1,357 @@
+"""
+功能：
+    定义服务器和客户端之间的二进制报文格式（代替pickle），由network.send()和network.recv()调用。
+    只支持游戏实际用到的几种报文，每种报文都有固定的结构：
+        ['MATCHING', id]                        服务器->客户端
+        ['PREPARING', [是否就绪, ...]]           服务器->客户端
+        ['MAP', get_map_info()]                 服务器->客户端
+        ['GAMING', [tick, base_tick, 内容]]      服务器->客户端（快照帧：关键帧或差分）
+        ['READY']                               客户端->服务器
+        ['ACK', tick]                           客户端->服务器
+        ['ACTIONS', seq, [Action, ...]]         客户端->服务器（seq: 输入序号，用于客户端预测）
+        ['UDP', token, port]                    服务器->客户端（TCP）：服务器的UDP端口和本连接的令牌
+        ['HELLO', token]                        客户端<->服务器（UDP）：用令牌把UDP地址和TCP连接对应起来
+        ['PING', seq, t]                        客户端<->服务器：测量往返时延，t是发送方的本地时间
+        ['PONG', seq, t]                        客户端<->服务器：原样返回PING的seq和t
+        ['JOIN']                                客户端->服务器：连接后的第一个报文，加入新的一局
+        ['RESUME', 令牌]                         客户端->服务器：连接后的第一个报文，断线重连，恢复原来的位置
+        ['SESSION', 令牌]                        服务器->客户端：分到位置时发放的会话令牌（用于RESUME）
+    UDP数据报的内容和TCP的数据包完全相同（前缀 + 报文），一个数据报只放一个数据包。
+    物品名字、效果名字、游戏状态等字符串都用小整数编码，人物状态用固定布局的struct.
+    解码时只会构造纯数据和Action，不会执行任何来自网络的代码。
+"""
+import struct
+from game import Object, Action
+
+# 报文格式的版本号，放在长度前缀的第一个字节（最高位留给压缩标志，见network.COMPRESSED，所以不能超过127）。
+VERSION = 9
+
+''' 报文类型 '''
+MSG_TYPES = ['MATCHING', 'PREPARING', 'MAP', 'GAMING', 'READY', 'ACK', 'ACTIONS', 'UDP', 'HELLO', 'PING', 'PONG',
+             'JOIN', 'RESUME', 'SESSION']
+MSG_CODES = {name: i for i, name in enumerate(MSG_TYPES)}
+
+''' 字符串编码表（下标即编码）。0号表示空（None或''）。'''
+NAMES = [''] + list(Object.INFO.keys()) + [
+    'destination',
+    # 标记
+    'circle', 'rect', 'footprint',
+    # 效果
+    'effectFrozen', 'effectPoisoned', 'effectFaster', 'effectBlinded', 'effectSmaller',
+]
+NAME_CODES = {name: i for i, name in enumerate(NAMES)}
+MODES = ['', 'RUNNING', 'GAMEOVER', 'QUIT']
+MODE_CODES = {name: i for i, name in enumerate(MODES)}
+
+''' 固定布局 '''
+ST_B = struct.Struct('>B')
+ST_H = struct.Struct('>H')
+ST_I = struct.Struct('>I')
+ST_i = struct.Struct('>i')
+ST_Q = struct.Struct('>Q')
+ST_MATCHING = struct.Struct('>b')
+ST_MAP = struct.Struct('>IHHHdQ')           # id, rows_road, cols_road, width, density, seed
+ST_UDP = struct.Struct('>IH')               # token, port
+ST_PING = struct.Struct('>Id')              # seq, 发送方的本地时间
+ST_NET = struct.Struct('>HB')               # RTT（毫秒，NET_UNKNOWN表示未知）, 丢包率（百分比）
+ST_FRAME = struct.Struct('>IiBBbdIf')       # tick, base_tick, 字段掩码, mode, winner, 服务器时间t, ack_seq, ack_dt
+ST_POS = struct.Struct('>ff')               # x, y
+ST_BODY = struct.Struct('>HHHHH')           # width, height, v[0], v[1], fov
+ST_EVENT = struct.Struct('>BbbB')           # 动作类型, 施加者, 承受者, 物品名字
+ST_CELL = struct.Struct('>HHBB')            # r, c, 物品个数, 标记个数
+ST_OBJECT = struct.Struct('>IBffHH')        # id, 名字, x, y, w, h
+ST_MARK = struct.Struct('>IBffHHb')         # id, 名字, x, y, w, h, visible_id
+ST_ACTION = struct.Struct('>BibbB')         # 动作类型, 值, 施加者, 承受者, 补充参数个数
+
+''' 快照帧的字段掩码 '''
+F_MAP_ID, F_REVISION, F_EXPLORERS, F_EVENTS, F_CELLS, F_NET = 1, 2, 4, 8, 16, 32
+NET_UNKNOWN = 0xFFFF
+''' 人物状态的部分掩码（见Explorer.get_state） '''
+P_POS, P_DIR, P_BODY, P_BAG, P_CRYSTALS, P_EFFECTS, P_BAG_SLOTS, P_VISIBLE = 1, 2, 4, 8, 16, 32, 64, 128
+
+
+class _Reader:
+    """ 在一段字节上依次读取 """
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.offset = 0
+
+    def read(self, st):
+        values = st.unpack_from(self.data, self.offset)
+        self.offset += st.size
+        return values
+
+    def read_one(self, st):
+        return self.read(st)[0]
+
+    def read_bytes(self, n):
+        if self.offset + n > len(self.data):
+            raise ValueError('报文不完整')
+        chunk = self.data[self.offset:self.offset + n]
+        self.offset += n
+        return chunk
+
+
+def _name(code):
+    return NAMES[code] or None
+
+
+def _encode_names(parts, names):
+    parts.append(ST_B.pack(len(names)))
+    parts.append(bytes(NAME_CODES[name or ''] for name in names))
+
+
+def _decode_names(reader):
+    n = reader.read_one(ST_B)
+    return tuple(_name(code) for code in reader.read_bytes(n))
+
+
+def _encode_explorer(parts, state):
+    """ 人物状态（完整的或者差分后的部分）：部分掩码 + 各部分。 """
+    mask = 0
+    body = []
+    if 'pos' in state:
+        mask |= P_POS
+        body.append(ST_POS.pack(*state['pos']))
+    if 'dir' in state:
+        mask |= P_DIR
+        lf, r, u, d, facial = state['dir']
+        body.append(ST_B.pack(lf | r << 1 | u << 2 | d << 3 | facial << 4))
+    if 'body' in state:
+        mask |= P_BODY
+        body.append(ST_BODY.pack(*state['body']))
+    if 'bag' in state:
+        if isinstance(state['bag'], dict):
+            mask |= P_BAG_SLOTS
+            body.append(ST_B.pack(len(state['bag'])))
+            for i, name in state['bag'].items():
+                body.append(bytes([i, NAME_CODES[name or '']]))
+        else:
+            mask |= P_BAG
+            _encode_names(body, state['bag'])
+    if 'crystals' in state:
+        mask |= P_CRYSTALS
+        _encode_names(body, state['crystals'])
+    if 'effects' in state:
+        mask |= P_EFFECTS
+        body.append(ST_B.pack(len(state['effects'])))
+        for name, effect_name in state['effects']:
+            body.append(bytes([NAME_CODES[name], NAME_CODES[effect_name]]))
+    if 'visible' in state:
+        mask |= P_VISIBLE
+        body.append(ST_B.pack(state['visible']))
+    parts.append(ST_B.pack(mask))
+    parts.extend(body)
+
+
+def _decode_explorer(reader):
+    mask = reader.read_one(ST_B)
+    state = dict()
+    if mask & P_POS:
+        state['pos'] = reader.read(ST_POS)
+    if mask & P_DIR:
+        bits = reader.read_one(ST_B)
+        state['dir'] = (bits & 1, bits >> 1 & 1, bits >> 2 & 1, bits >> 3 & 1, bits >> 4)
+    if mask & P_BODY:
+        state['body'] = reader.read(ST_BODY)
+    if mask & P_BAG_SLOTS:
+        n = reader.read_one(ST_B)
+        slots = reader.read_bytes(2 * n)
+        state['bag'] = {slots[2 * j]: _name(slots[2 * j + 1]) for j in range(n)}
+    if mask & P_BAG:
+        state['bag'] = _decode_names(reader)
+    if mask & P_CRYSTALS:
+        state['crystals'] = _decode_names(reader)
+    if mask & P_EFFECTS:
+        n = reader.read_one(ST_B)
+        codes = reader.read_bytes(2 * n)
+        state['effects'] = tuple((NAMES[codes[2 * j]], NAMES[codes[2 * j + 1]]) for j in range(n))
+    if mask & P_VISIBLE:
+        state['visible'] = reader.read_one(ST_B)
+    return state
+
+
+def _encode_cells(parts, cells):
+    parts.append(ST_I.pack(len(cells)))
+    for (r, c), (objects, marks) in cells.items():
+        parts.append(ST_CELL.pack(r, c, len(objects), len(marks)))
+        for _id, name, x, y, w, h in objects:
+            parts.append(ST_OBJECT.pack(_id, NAME_CODES[name], x, y, w, h))
+        for _id, name, x, y, w, h, visible_id in marks:
+            parts.append(ST_MARK.pack(_id, NAME_CODES[name], x, y, w, h, visible_id))
+
+
+def _decode_cells(reader):
+    cells = dict()
+    for _ in range(reader.read_one(ST_I)):
+        r, c, n_objects, n_marks = reader.read(ST_CELL)
+        objects = []
+        for _ in range(n_objects):
+            _id, code, x, y, w, h = reader.read(ST_OBJECT)
+            objects.append((_id, NAMES[code], x, y, w, h))
+        marks = []
+        for _ in range(n_marks):
+            _id, code, x, y, w, h, visible_id = reader.read(ST_MARK)
+            marks.append((_id, NAMES[code], x, y, w, h, visible_id))
+        cells[(r, c)] = (tuple(objects), tuple(marks))
+    return cells
+
+
+def _encode_frame(parts, frame):
+    """ 快照帧：[tick, base_tick, 内容]。base_tick<0时内容为关键帧（explorers是列表），否则为差分。 """
+    tick, base_tick, content = frame
+    mask = 0
+    body = []
+    if 'map_id' in content:
+        mask |= F_MAP_ID
+        body.append(ST_I.pack(content['map_id']))
+    if 'revision' in content:
+        mask |= F_REVISION
+        body.append(ST_I.pack(content['revision']))
+    if 'explorers' in content:
+        mask |= F_EXPLORERS
+        explorers = content['explorers']
+        if not isinstance(explorers, dict):
+            explorers = dict(enumerate(explorers))
+        body.append(ST_B.pack(len(explorers)))
+        for i, state in explorers.items():
+            body.append(ST_B.pack(i))
+            _encode_explorer(body, state)
+    if 'events' in content:
+        mask |= F_EVENTS
+        body.append(ST_B.pack(len(content['events'])))
+        for _type, applier, target, name in content['events']:
+            body.append(ST_EVENT.pack(_type, applier, target, NAME_CODES[name]))
+    if 'cells' in content:
+        mask |= F_CELLS
+        _encode_cells(body, content['cells'])
+    if 'net' in content:
+        # 服务器测得的每个玩家的网络状况：[(RTT毫秒或None, 丢包百分比), ...]
+        mask |= F_NET
+        body.append(ST_B.pack(len(content['net'])))
+        for rtt, loss in content['net']:
+            body.append(ST_NET.pack(NET_UNKNOWN if rtt is None else min(rtt, NET_UNKNOWN - 1), loss))
+    parts.append(ST_FRAME.pack(tick, base_tick, mask, MODE_CODES[content['mode']], content['winner'],
+                               content.get('t', 0.0), content.get('ack_seq', 0), content.get('ack_dt', 0.0)))
+    parts.extend(body)
+
+
+def _decode_frame(reader):
+    tick, base_tick, mask, mode, winner, t, ack_seq, ack_dt = reader.read(ST_FRAME)
+    content = {'mode': MODES[mode], 'winner': winner, 't': t, 'ack_seq': ack_seq, 'ack_dt': ack_dt}
+    if mask & F_MAP_ID:
+        content['map_id'] = reader.read_one(ST_I)
+    if mask & F_REVISION:
+        content['revision'] = reader.read_one(ST_I)
+    if mask & F_EXPLORERS:
+        explorers = dict()
+        for _ in range(reader.read_one(ST_B)):
+            i = reader.read_one(ST_B)
+            explorers[i] = _decode_explorer(reader)
+        # 关键帧中是完整的人物列表，下标必须是0, 1, ...
+        if base_tick < 0 and sorted(explorers) != list(range(len(explorers))):
+            raise ValueError('关键帧的人物下标不连续')
+        content['explorers'] = explorers if base_tick >= 0 else [explorers[i] for i in range(len(explorers))]
+    if mask & F_EVENTS:
+        content['events'] = []
+        for _ in range(reader.read_one(ST_B)):
+            _type, applier, target, code = reader.read(ST_EVENT)
+            content['events'].append((_type, applier, target, NAMES[code]))
+    if mask & F_CELLS:
+        content['cells'] = _decode_cells(reader)
+    if mask & F_NET:
+        content['net'] = []
+        for _ in range(reader.read_one(ST_B)):
+            rtt, loss = reader.read(ST_NET)
+            content['net'].append((None if rtt == NET_UNKNOWN else rtt, loss))
+    return [tick, base_tick, content]
+
+
+def _encode_actions(parts, actions):
+    parts.append(ST_B.pack(len(actions)))
+    for action in actions:
+        parts.append(ST_ACTION.pack(action.type, action.value, action.applier, action.target,
+                                    len(action.args)))
+        for arg in action.args:
+            parts.append(ST_i.pack(arg))
+
+
+def _decode_actions(reader):
+    actions = []
+    for _ in range(reader.read_one(ST_B)):
+        _type, value, applier, target, n_args = reader.read(ST_ACTION)
+        args = [reader.read_one(ST_i) for _ in range(n_args)]
+        actions.append(Action(_type, value, applier, target, *args))
+    return actions
+
+
+def encode(data):
+    """ 将报文列表编码成字节。 """
+    name = data[0]
+    parts = [ST_B.pack(MSG_CODES[name])]
+    if name == 'MATCHING':
+        parts.append(ST_MATCHING.pack(data[1]))
+    elif name == 'PREPARING':
+        parts.append(ST_B.pack(len(data[1])))
+        parts.append(bytes(1 if ready else 0 for ready in data[1]))
+    elif name == 'MAP':
+        # 迷宫由客户端用seed重新生成，不发送迷宫矩阵。
+        info = data[1]
+        parts.append(ST_MAP.pack(info['id'], info['rows_road'], info['cols_road'], info['width'],
+                                 info['density'], info['seed']))
+    elif name == 'GAMING':
+        _encode_frame(parts, data[1])
+    elif name == 'ACK':
+        parts.append(ST_i.pack(data[1]))
+    elif name == 'ACTIONS':
+        parts.append(ST_I.pack(data[1]))
+        _encode_actions(parts, data[2])
+    elif name == 'UDP':
+        parts.append(ST_UDP.pack(data[1], data[2]))
+    elif name == 'HELLO':
+        parts.append(ST_I.pack(data[1]))
+    elif name in ('PING', 'PONG'):
+        parts.append(ST_PING.pack(data[1], data[2]))
+    elif name in ('RESUME', 'SESSION'):
+        parts.append(ST_Q.pack(data[1]))
+    return b''.join(parts)
+
+
+def decode(message):
+    """ 将字节解码成报文列表。报文不完整或者格式不对时抛出ValueError. """
+    try:
+        return _decode(_Reader(message))
+    except (struct.error, IndexError, KeyError) as e:
+        raise ValueError('报文格式不对：' + str(e))
+
+
+def _decode(reader):
+    code = reader.read_one(ST_B)
+    if code >= len(MSG_TYPES):
+        raise ValueError('未知的报文类型：' + str(code))
+    name = MSG_TYPES[code]
+    if name == 'MATCHING':
+        return [name, reader.read_one(ST_MATCHING)]
+    elif name == 'PREPARING':
+        n = reader.read_one(ST_B)
+        return [name, [bool(val) for val in reader.read_bytes(n)]]
+    elif name == 'MAP':
+        _id, rows_road, cols_road, width, density, seed = reader.read(ST_MAP)
+        return [name, {'id': _id, 'rows_road': rows_road, 'cols_road': cols_road,
+                       'width': width, 'density': density, 'seed': seed}]
+    elif name == 'GAMING':
+        return [name, _decode_frame(reader)]
+    elif name == 'ACK':
+        return [name, reader.read_one(ST_i)]
+    elif name == 'ACTIONS':
+        seq = reader.read_one(ST_I)
+        return [name, seq, _decode_actions(reader)]
+    elif name == 'UDP':
+        return [name, *reader.read(ST_UDP)]
+    elif name == 'HELLO':
+        return [name, reader.read_one(ST_I)]
+    elif name in ('PING', 'PONG'):
+        return [name, *reader.read(ST_PING)]
+    elif name in ('RESUME', 'SESSION'):
+        return [name, reader.read_one(ST_Q)]
+    return [name]
@@ -0,0 +1,202 @@
+"""
+功能：
+    对局记录（回放）。服务器把每一局游戏记录成一个紧凑的二进制文件（Recorder），回放器（ReplayPlayer）可以跳到任意时刻。
+    记录的不是每个tick的快照（太大），而是：
+        文件头：魔数、记录格式版本、报文格式版本、tick频率、玩家数、本局的seed（game.Game，可以重新生成同样的开局）；
+        地图（每局一次）；
+        每个tick房间交给Game.update_by_actions的动作批（玩家id和动作）；
+        每隔keyframe_interval秒一个关键帧（完整快照和所有地图块，编码和网络上的关键帧相同）。
+    回放：从不晚于目标时刻的最近的关键帧开始，按记录的动作和固定步长（1/频率）重新模拟到目标时刻。
+        一直往后播放时，每到一个关键帧就与它对齐，消除重新模拟的偏差（比如物品效果的剩余时间不在快照里）。
+    每条记录：类型(1字节)、tick(4字节)、内容长度(4字节)、内容。内容直接复用protocol的报文编码。
+    文件末尾的记录可能不完整（服务器异常退出，最多丢掉最后一个关键帧之后的部分），读取时忽略。
+用法：
+    python replay.py records/xxx.replay               # 显示记录的概要
+    python replay.py records/xxx.replay --seek 12.5   # 跳到第12.5秒，显示每个玩家的位置
+"""
+import argparse
+import bisect
+import collections
+import os
+import struct
+import time
+import game
+import protocol
+
+MAGIC = b'MAZR'
+FORMAT = 1
+ST_HEADER = struct.Struct('>4sBBHBQ')   # 魔数, 记录格式版本, 报文格式版本, tick频率, 玩家数, 随机种子
+ST_RECORD = struct.Struct('>BII')       # 类型, tick, 内容长度
+''' 记录类型 '''
+R_MAP, R_KEYFRAME, R_ACTIONS, R_END = 0, 1, 2, 3
+
+
+class Recorder:
+    """
+    服务器端：记录一局游戏。由Room在事件循环线程中调用，只做编码和写入带缓冲的文件，不做额外的模拟。
+    动作批的tick是房间最近一个快照的tick：这批动作在该快照之后、下一步模拟之前交给游戏。
+    """
+    def __init__(self, path, freq, n_players, seed=0, keyframe_interval=5.0):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.file = open(path, 'wb', buffering=64 * 1024)
+        self.keyframe_every = max(1, int(keyframe_interval * freq))
+        self.tick_keyframe = None   # 上一个关键帧的tick.
+        self.n_bytes = 0
+        self.file.write(ST_HEADER.pack(MAGIC, FORMAT, protocol.VERSION, freq, n_players, seed))
+        self.n_bytes += ST_HEADER.size
+
+    def __write(self, _type, tick, payload):
+        self.file.write(ST_RECORD.pack(_type, tick, len(payload)))
+        self.file.write(payload)
+        self.n_bytes += ST_RECORD.size + len(payload)
+
+    def map(self, tick, info):
+        self.__write(R_MAP, tick, protocol.encode(['MAP', info]))
+
+    def actions(self, tick, i_client, actions):
+        """ 一批动作。必须在交给update_by_actions之前记录（它会修改动作的value）。 """
+        # 复用ACTIONS报文的编码，序号字段记录的是玩家id.
+        self.__write(R_ACTIONS, tick, protocol.encode(['ACTIONS', i_client, actions]))
+
+    def keyframe_due(self, tick):
+        return self.tick_keyframe is None or tick - self.tick_keyframe >= self.keyframe_every
+
+    def keyframe(self, tick, snapshot, cells):
+        """ 关键帧：tick的完整快照（Game.get_snapshot）和所有地图块（Game.get_map_cells）。 """
+        content = dict(snapshot)
+        content['cells'] = cells
+        self.__write(R_KEYFRAME, tick, protocol.encode(['GAMING', [tick, -1, content]]))
+        self.tick_keyframe = tick
+        # 每个关键帧之后把缓冲写进文件：服务器异常退出时，最多丢掉最后一个关键帧之后的记录。
+        self.file.flush()
+
+    def close(self, tick):
+        self.__write(R_END, tick, b'')
+        self.file.close()
+
+
+class ReplayPlayer:
+    """
+    回放器：读入整个记录文件并建立索引（关键帧、每个tick的动作批），seek(t)跳到第t秒，step()前进一个tick.
+    回放的游戏（self.game）由game_factory(玩家数)生成，和客户端的镜像一样用load_map载入地图（一次），
+    再用apply_map_cells、apply_snapshot还原关键帧。
+    """
+    def __init__(self, path, game_factory=game.Game):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        if len(self.data) < ST_HEADER.size:
+            raise ValueError('不是对局记录文件：' + path)
+        magic, fmt, version, self.freq, self.n_players, self.seed = ST_HEADER.unpack_from(self.data)
+        if magic != MAGIC or fmt != FORMAT:
+            raise ValueError('不是对局记录文件：' + path)
+        if version != protocol.VERSION:
+            raise ValueError('对局记录的报文格式版本不一致：' + str(version))
+        self.dt = 1 / self.freq
+        self.map_info = None
+        self.keyframes = []     # [(tick, 偏移, 长度)]，按tick排列。
+        self.key_ticks = []
+        self.actions = collections.defaultdict(list)    # tick: [(偏移, 长度)]
+        self.first_tick = None
+        self.last_tick = None
+        self.finished = False   # 是否有结束记录（否则文件不完整）。
+        self.__scan()
+        if self.map_info is None or not self.keyframes:
+            raise ValueError('对局记录是空的：' + path)
+        # 迷宫只生成一次（由地图的seed决定），每次载入关键帧只替换地图块的内容和游戏状态。
+        self.game = game_factory(self.n_players)
+        self.game.load_map(self.map_info)
+        self.tick = None
+
+    def __scan(self):
+        """ 读一遍所有记录的类型和tick，建立索引。地图直接解码。 """
+        offset = ST_HEADER.size
+        while offset + ST_RECORD.size <= len(self.data):
+            _type, tick, n = ST_RECORD.unpack_from(self.data, offset)
+            offset += ST_RECORD.size
+            if offset + n > len(self.data):
+                break
+            if _type == R_MAP:
+                self.map_info = protocol.decode(self.data[offset:offset + n])[1]
+            elif _type == R_KEYFRAME:
+                self.keyframes.append((tick, offset, n))
+                self.key_ticks.append(tick)
+            elif _type == R_ACTIONS:
+                self.actions[tick].append((offset, n))
+            elif _type == R_END:
+                self.finished = True
+            if self.first_tick is None:
+                self.first_tick = tick
+            self.last_tick = tick
+            offset += n
+
+    @property
+    def duration(self):
+        """ 记录的时长（秒）。 """
+        return (self.last_tick - self.first_tick) / self.freq
+
+    @property
+    def t(self):
+        """ 当前回放到的时刻（秒）。 """
+        return (self.tick - self.first_tick) / self.freq
+
+    def seek(self, t):
+        """ 跳到第t秒（从开局算起）：载入不晚于它的最近的关键帧，再重新模拟到该时刻。返回回放的游戏。 """
+        target = min(max(self.first_tick + round(t * self.freq), self.first_tick), self.last_tick)
+        i = bisect.bisect_right(self.key_ticks, target) - 1
+        # 目标就在当前位置之后、并且中间没有更近的关键帧时，直接往后模拟。
+        if self.tick is None or not (self.key_ticks[i] <= self.tick <= target):
+            self.__load_keyframe(i)
+        while self.tick < target:
+            self.step()
+        return self.game
+
+    def step(self):
+        """ 前进一个tick：先把这个tick记录的动作交给游戏，再模拟一步。到达关键帧时与它对齐。 """
+        for offset, n in self.actions.get(self.tick, ()):
+            _, i_client, actions = protocol.decode(self.data[offset:offset + n])
+            self.game.update_by_actions(i_client, actions)
+        self.game.update_by_dt(self.dt)
+        self.tick += 1
+        i = bisect.bisect_left(self.key_ticks, self.tick)
+        if i < len(self.key_ticks) and self.key_ticks[i] == self.tick:
+            self.__load_keyframe(i)
+
+    def __load_keyframe(self, i):
+        tick, offset, n = self.keyframes[i]
+        _, (_, _, content) = protocol.decode(self.data[offset:offset + n])
+        cells = content.pop('cells', {})
+        self.game.clear_map_cells()
+        self.game.apply_map_cells(self.map_info['id'], cells)
+        self.game.events = []
+        self.game.apply_snapshot(content)
+        self.tick = tick
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MazeAdventure对局记录')
+    parser.add_argument('path', help='对局记录文件')
+    parser.add_argument('--seek', type=float, default=None, help='跳到第几秒')
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    player = ReplayPlayer(args.path)
+    t_load = time.perf_counter() - t0
+    size = len(player.data)
+    print('时长(秒)：', round(player.duration, 2), '频率：', player.freq, '玩家数：', player.n_players,
+          '种子：', player.seed, '完整：', player.finished)
+    print('关键帧：', len(player.keyframes), '动作批：', sum(len(v) for v in player.actions.values()),
+          '文件大小：', size, '字节（每秒 %.0f）' % (size / max(player.duration, 1e-9)),
+          '载入(ms)：', round(t_load * 1000, 2))
+    if args.seek is not None:
+        t0 = time.perf_counter()
+        _game = player.seek(args.seek)
+        print('跳到第', round(player.t, 3), '秒，用时(ms)：', round((time.perf_counter() - t0) * 1000, 2),
+              '状态：', _game.mode, '胜者：', _game.winner)
+        for i, explorer in enumerate(_game.explorers):
+            print('玩家', i, '位置：', (round(explorer.x, 1), round(explorer.y, 1)),
+                  '水晶：', list(explorer.crystals_found.keys()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,13 @@
-import network
+import functools
 import game
+import server_pool
 
 server_address = ('0.0.0.0', 17777)
-my_game = game.Game(2)
-server = network.NetworkServer(server_address, my_game)
-server.run()
-
-
-
-
-
-
-
+# 每个房间一局双人游戏；房间分布在多个工作进程上（默认每个CPU核一个）。
+# 快照帧走UDP（客户端不支持时退回TCP）。每一局都记录到records/下（回放见replay.py）。
+# 单进程运行：network.NetworkServer(server_address, functools.partial(game.Game, 2), udp_address=server_address,
+#                                record_dir='records').run()
+if __name__ == '__main__':
+    pool = server_pool.ServerPool(server_address, functools.partial(game.Game, 2), n_players=2, udp=True,
+                                   record_dir='records')
+    pool.run()
@@ -0,0 +1,231 @@
+"""
+功能：
+    服务器进程池。一个前端进程（ServerPool）监听端口并接受连接，把客户端socket转交给N个工作进程；
+    每个工作进程运行一个network.NetworkServer（不监听端口），承载若干房间，各自占用一个CPU核。
+    前端进程与每个工作进程之间有一条本地控制通道（AF_UNIX, SOCK_SEQPACKET）：
+        前端 -> 工作进程：{'cmd': 'client', 'first': 第一个报文}（附带客户端socket的文件描述符）、{'cmd': 'stats'}；
+        工作进程 -> 前端：stats的回复（json）。
+    放置策略：同一局的玩家必须落在同一个工作进程里；新的一局放到负载（客户端数）最小的工作进程。
+        前端先读出新连接的第一个报文（只读这一个数据包，见network.read_session），和文件描述符一起转交：
+        断线重连的RESUME按会话令牌高16位里的工作进程下标，转交给原来的工作进程（见network.NetworkServer）；
+        JOIN按上面的策略放置。
+    备注：依赖socket.send_fds/recv_fds，仅支持Linux/Unix.
+"""
+import os
+import socket
+import selectors
+import multiprocessing
+import json
+import time
+import network
+
+
+def worker_main(control, game_factory, udp_address=None, worker_id=0, record_dir=None, profile_interval=None):
+    """ 工作进程入口：从控制通道接收客户端，运行房间。 """
+    server = network.NetworkServer(None, game_factory, control, udp_address, record_dir)
+    server.server_id = worker_id
+    if profile_interval is not None:
+        server.profiling = True
+        server.profile_interval = profile_interval
+    server.run()
+
+
+class ServerPool:
+    """
+    前端进程：监听、接受连接、按负载把客户端分配给工作进程，并定期收集各工作进程的统计信息。
+    game_factory需要能被pickle（例如functools.partial(game.Game, 2)），以便传给工作进程。
+    udp为True时，每个工作进程各自绑定一个UDP端口（系统分配），通过TCP告诉它的客户端（见network.NetworkServer）。
+    record_dir不为None时，每个工作进程都把对局记录写到这个目录（见replay）。
+    profile_interval不为None时，每个工作进程都开启性能分析，每隔这么多秒打印一次汇总（见profiler）。
+    """
+    def __init__(self, server_address, game_factory, n_workers=None, n_players=2, udp=False, record_dir=None,
+                 profile_interval=None):
+        self.address = server_address
+        self.game_factory = game_factory
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.n_players = n_players          # 每局的玩家数，凑满一局后再选择新的工作进程。
+        self.stats_interval = 1.0           # 收集统计信息的间隔（秒）。
+        self.udp_address = (server_address[0], 0) if udp else None
+        self.record_dir = record_dir
+        self.profile_interval = profile_interval
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(self.address)
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ)
+
+        self.workers = []           # 工作进程（multiprocessing.Process）。
+        self.channels = []          # 与每个工作进程的控制通道，None表示该工作进程已退出。
+        self.worker_stats = []      # 每个工作进程最近一次回复的统计信息。
+        self.handed = []            # 尚未反映在统计信息里的、转交给每个工作进程的客户端数。
+        self.polled = []            # 发出统计请求时的handed，收到回复后从handed中扣除。
+        self.forming = None         # 正在凑人的一局：[工作进程下标, 剩余空位]。
+        self.joining = dict()       # 还没有发来完整的第一个报文的客户端socket: [接受的时刻, 已收到的部分]。
+        self.join_timeout = 10.0
+        self.mode = network.ThreadSafeVar('INITIATED')
+
+    def start(self):
+        """ 启动所有工作进程。 """
+        for i in range(self.n_workers):
+            parent, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            # 用spawn而不是fork启动，工作进程不会继承监听socket和其他工作进程的控制通道，
+            # 前端退出时每个工作进程都能从控制通道读到EOF并退出。
+            process = multiprocessing.get_context('spawn').Process(
+                target=worker_main,
+                args=(child, self.game_factory, self.udp_address, i, self.record_dir, self.profile_interval),
+                daemon=True)
+            process.start()
+            child.close()
+            self.workers.append(process)
+            self.channels.append(parent)
+            self.worker_stats.append({})
+            self.handed.append(0)
+            self.polled.append(0)
+            self.selector.register(parent, selectors.EVENT_READ, i)
+
+    def run(self):
+        """ 前端的事件循环。 """
+        self.start()
+        self.mode.update('RUNNING')
+        print('服务器进程池开始运行，工作进程数：', self.n_workers)
+        t_stats = time.perf_counter()
+        n_polls = 0
+        while self.mode.peek() != 'CLOSED':
+            timeout = max(0.0, t_stats - time.perf_counter())
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    self.__accept()
+                elif key.data == 'CLIENT':
+                    self.__route(key.fileobj)
+                else:
+                    self.__read(key.data)
+            if time.perf_counter() >= t_stats:
+                t_stats += self.stats_interval
+                self.__poll_stats()
+                self.__expire()
+                n_polls += 1
+                if n_polls % 10 == 0:
+                    print(self.stats())
+            if all(channel is None for channel in self.channels):
+                self.mode.update('CLOSED')
+        self.close()
+
+    def close(self):
+        for client_socket in self.joining:
+            client_socket.close()
+        self.selector.close()
+        self.socket.close()
+        for channel in self.channels:
+            if channel is not None:
+                channel.close()
+        for process in self.workers:
+            process.join(timeout=1.0)
+
+    def load(self, i):
+        """ 工作进程i的负载估计：最近统计的客户端数加上统计之后新转交的客户端数。 """
+        return self.worker_stats[i].get('clients', 0) + self.handed[i]
+
+    def stats(self):
+        """ 汇总的统计信息。 """
+        return {'workers': [dict(stats, alive=self.channels[i] is not None, load=self.load(i))
+                            for i, stats in enumerate(self.worker_stats)],
+                'rooms': sum(stats.get('rooms', 0) for stats in self.worker_stats),
+                'clients': sum(self.load(i) for i in range(self.n_workers) if self.channels[i] is not None)}
+
+    def __place(self):
+        """ 为新客户端选择工作进程：先凑满正在凑人的一局，否则选负载最小的工作进程开新的一局。 """
+        if self.forming is None or self.forming[1] == 0 or self.channels[self.forming[0]] is None:
+            alive = [i for i in range(self.n_workers) if self.channels[i] is not None]
+            if not alive:
+                return None
+            self.forming = [min(alive, key=self.load), self.n_players]
+        self.forming[1] -= 1
+        return self.forming[0]
+
+    def __accept(self):
+        """ 接受新连接，等它发来第一个报文后再转交（见__route）。 """
+        client_socket = self.socket.accept()[0]
+        client_socket.setblocking(False)
+        self.selector.register(client_socket, selectors.EVENT_READ, 'CLIENT')
+        self.joining[client_socket] = [time.perf_counter(), bytearray()]
+
+    def __route(self, client_socket):
+        """
+        新连接有数据可读：接着读它的第一个数据包（读出的部分放在自己的缓冲区里，不会反复查看同样的字节）。
+        读完后，RESUME转交给发放令牌的工作进程，JOIN按负载放置，第一个报文随文件描述符一起转交。
+        """
+        try:
+            data = network.read_session(client_socket, self.joining[client_socket][1])
+        except (ConnectionError, OSError, ValueError):
+            self.__forget(client_socket)
+            return
+        if data is None:
+            return
+        self.selector.unregister(client_socket)
+        del self.joining[client_socket]
+        if data[0] == 'JOIN':
+            i = self.__place()
+        else:
+            i = data[1] >> 48
+            if i >= self.n_workers or self.channels[i] is None:
+                i = None
+        if i is not None:
+            try:
+                socket.send_fds(self.channels[i], [json.dumps({'cmd': 'client', 'first': data}).encode()],
+                                [client_socket.fileno()])
+                self.handed[i] += 1
+            except OSError:
+                self.__drop(i)
+        # 文件描述符已经复制给工作进程，前端不再持有。
+        client_socket.close()
+
+    def __forget(self, client_socket):
+        """ 放弃一个还没有转交的连接。 """
+        self.selector.unregister(client_socket)
+        del self.joining[client_socket]
+        client_socket.close()
+
+    def __expire(self):
+        """ 断开join_timeout秒内都没有发来第一个报文的连接。 """
+        t_now = time.perf_counter()
+        for client_socket, (t_accept, _) in list(self.joining.items()):
+            if t_now - t_accept > self.join_timeout:
+                self.__forget(client_socket)
+
+    def __read(self, i):
+        """ 接收工作进程i的统计回复。 """
+        try:
+            msg = self.channels[i].recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            msg = b''
+        if not msg:
+            self.__drop(i)
+            return
+        self.worker_stats[i] = json.loads(msg)
+        self.handed[i] -= self.polled[i]
+        self.polled[i] = 0
+
+    def __poll_stats(self):
+        msg = json.dumps({'cmd': 'stats'}).encode()
+        for i, channel in enumerate(self.channels):
+            if channel is None:
+                continue
+            try:
+                channel.send(msg)
+                self.polled[i] = self.handed[i]
+            except OSError:
+                self.__drop(i)
+
+    def __drop(self, i):
+        """ 工作进程i退出了，不再向它分配客户端。 """
+        if self.channels[i] is None:
+            return
+        print('工作进程退出：', i)
+        self.selector.unregister(self.channels[i])
+        self.channels[i].close()
+        self.channels[i] = None
@@ -0,0 +1,223 @@
+"""
+功能：
+    游戏逻辑的测试：服务器对客户端动作的检验，客户端预测和服务器校正，
+    同一个seed生成同样的一局，迷宫的连通性。
+用法：
+    python -m pytest -q test_game.py    （或者 python -m unittest test_game）
+"""
+import collections
+import unittest
+
+from game import Game, Map, Object, Action
+
+
+class TestActions(unittest.TestCase):
+    """ Game.update_by_actions：合法的动作生效，不合法的只放弃这一个。 """
+    def use_on(self, i_target):
+        game = Game(2)
+        game.explorers[0].update_bag(Object('snowflake', [0, 0], [10, 10]), mode='add')
+        game.update_by_actions(0, [Action(Action.OBJ_USE, 0, 0, i_target)])
+        return game
+
+    def test_use_on_opponent(self):
+        game = Game(2)
+        self.assertEqual(game.opponent(0), 1)
+        self.assertEqual(game.opponent(1), 0)
+        game = self.use_on(game.opponent(0))
+        self.assertEqual(game.explorers[0].bag[0], None)
+        self.assertEqual([e.effect_name for e in game.explorers[1].effects], ['effectFrozen'])
+        self.assertLess(game.explorers[1].v[0], game.explorers[1].V_MAX[0])
+        self.assertEqual(game.explorers[0].v, game.explorers[0].V_MAX)
+
+    def test_use_out_of_range(self):
+        for i_target in (-1, 2):
+            game = self.use_on(i_target)
+            self.assertEqual(game.explorers[0].bag[0].name, 'snowflake')
+            self.assertEqual(game.explorers[1].v, game.explorers[1].V_MAX)
+
+    def test_single_player_has_no_opponent(self):
+        self.assertIsNone(Game(1).opponent(0))
+
+    def test_wrong_applier(self):
+        game = Game(2)
+        game.update_by_actions(1, [Action(Action.MOVE_TURN, 0, 0, 0), Action(Action.MOVE_TURN, 9, 1, 1),
+                                   Action(Action.MOVE_TURN, 1, 1, 1)])
+        self.assertEqual(game.explorers[0].direction, [0, 0, 0, 0])
+        self.assertEqual(game.explorers[1].direction, [0, 1, 0, 0])
+
+
+class TestPrediction(unittest.TestCase):
+    """ Game.predict和服务器校正：从快照的位置开始，跳过ack_dt，重放服务器还没处理的输入。 """
+    DT = 0.05
+
+    def setUp(self):
+        self.server = Game(2, seed=1)
+        self.client = Game(2, seed=2)
+        self.client.load_map(self.server.get_map_info())
+        self.client.predict_id = 0
+        self.client.apply_snapshot(self.snapshot(self.server, 0, 0.0))
+        # 能走得动的一个水平方向和一个竖直方向（[left, right, up, down]）。
+        self.dirs = [next(i_dir for i_dir in dirs if self.moved([(i_dir, 1)], self.DT)) for dirs in ((0, 1), (2, 3))]
+
+    @staticmethod
+    def snapshot(game, ack_seq, ack_dt):
+        snapshot = game.get_snapshot()
+        snapshot.update({'ack_seq': ack_seq, 'ack_dt': ack_dt})
+        return snapshot
+
+    @staticmethod
+    def turns(*moves):
+        return [Action(Action.MOVE_TURN if val else Action.MOVE_UNTURN, i_dir, 0, 0) for i_dir, val in moves]
+
+    def moved(self, moves, dt):
+        game = Game(2, seed=1)
+        x, y = game.explorers[0].x, game.explorers[0].y
+        game.update_by_actions(0, self.turns(*moves))
+        game.update_by_dt(dt)
+        return (game.explorers[0].x, game.explorers[0].y) != (x, y)
+
+    def position(self, game):
+        return game.explorers[0].x, game.explorers[0].y
+
+    def assertPosition(self, game, pos):
+        self.assertAlmostEqual(game.explorers[0].x, pos[0])
+        self.assertAlmostEqual(game.explorers[0].y, pos[1])
+
+    def play(self):
+        """ 客户端的四帧：第1帧转向（输入1），第3帧换一个方向（输入2）。返回两批动作。 """
+        a, b = self.dirs
+        batch_1 = self.turns((a, 1))
+        batch_2 = self.turns((a, 0), (b, 1))
+        self.assertEqual(self.client.predict(batch_1, self.DT), 1)
+        self.assertEqual(self.client.predict([], self.DT), 1)
+        self.assertEqual(self.client.predict(batch_2, self.DT), 2)
+        self.assertEqual(self.client.predict([], self.DT), 2)
+        return batch_1, batch_2
+
+    def test_predict(self):
+        start = self.position(self.client)
+        self.play()
+        self.assertNotEqual(self.position(self.client), start)
+        self.assertEqual([(seq, dt) for seq, _, dt in self.client.input_log],
+                         [(1, self.DT), (1, self.DT), (2, self.DT), (2, self.DT)])
+        # 服务器还没处理任何输入：校正后仍是预测的位置。
+        predicted = self.position(self.client)
+        self.client.apply_snapshot(self.snapshot(self.server, 0, 0.0))
+        self.assertPosition(self.client, predicted)
+
+    def test_reconcile_in_step(self):
+        # 服务器和客户端的模拟一致：校正不改变预测的位置，已处理的输入从日志中删除。
+        batch_1, batch_2 = self.play()
+        predicted = self.position(self.client)
+        self.server.update_by_actions(0, batch_1)
+        self.server.update_by_dt(self.DT)
+        self.server.update_by_dt(self.DT)
+        self.client.apply_snapshot(self.snapshot(self.server, 1, 2 * self.DT))
+        self.assertPosition(self.client, predicted)
+        self.server.update_by_actions(0, batch_2)
+        self.server.update_by_dt(self.DT)
+        self.client.apply_snapshot(self.snapshot(self.server, 2, self.DT))
+        self.assertPosition(self.client, predicted)
+        self.assertEqual([seq for seq, _, _ in self.client.input_log], [2, 2])
+        self.server.update_by_dt(self.DT)
+        self.client.apply_snapshot(self.snapshot(self.server, 2, 2 * self.DT))
+        self.assertPosition(self.client, self.position(self.server))
+
+    def test_reconcile_ack_dt(self):
+        # 服务器处理输入1后多模拟了半帧（输入2晚到）：客户端跳过这段时间，得到服务器之后的位置。
+        batch_1, batch_2 = self.play()
+        self.server.update_by_actions(0, batch_1)
+        self.server.update_by_dt(2.5 * self.DT)
+        self.client.apply_snapshot(self.snapshot(self.server, 1, 2.5 * self.DT))
+        self.server.update_by_actions(0, batch_2)
+        self.server.update_by_dt(1.5 * self.DT)
+        self.assertPosition(self.client, self.position(self.server))
+
+    def test_not_predicted(self):
+        self.client.predict_id = None
+        self.assertEqual(self.client.predict(self.turns((self.dirs[0], 1)), self.DT), 1)
+        self.assertEqual(self.client.input_log, [])
+        self.client.predict_id = 0
+        self.client.mode = 'GAMEOVER'
+        self.assertEqual(self.client.predict(self.turns((self.dirs[0], 1)), self.DT), 2)
+        self.assertEqual(self.client.input_log, [])
+
+
+class TestSeed(unittest.TestCase):
+    """ 同样的seed（和参数）一定生成同样的迷宫和物品布局，客户端由地图的seed在本地重新生成迷宫。 """
+    @staticmethod
+    def objects(game):
+        return sorted((r, c, obj.name, obj.x, obj.y) for r, row in enumerate(game.map.objects)
+                      for c, cell in row.items() for obj in cell)
+
+    def test_map(self):
+        a, b = Map(30, 20, 100, 0.9, seed=7), Map(30, 20, 100, 0.9, seed=7)
+        self.assertTrue((a.maze == b.maze).all())
+        self.assertNotEqual(a.id, b.id)
+        self.assertFalse((a.maze == Map(30, 20, 100, 0.9, seed=8).maze).all())
+
+    def test_game(self):
+        a, b = Game(2, seed=11), Game(2, seed=11)
+        self.assertTrue((a.map.maze == b.map.maze).all())
+        self.assertEqual(self.objects(a), self.objects(b))
+        # 从同一个seed开始的一连串对局也相同。
+        a.reset(2)
+        b.reset(2)
+        self.assertEqual(a.seed, b.seed)
+        self.assertTrue((a.map.maze == b.map.maze).all())
+        self.assertEqual(self.objects(a), self.objects(b))
+
+    def test_load_map(self):
+        server, client = Game(2), Game(2)
+        client.load_map(server.get_map_info())
+        self.assertTrue((client.map.maze == server.map.maze).all())
+
+    def test_unpredictable(self):
+        self.assertNotEqual(Game(2).seed, Game(2).seed)
+        self.assertNotEqual(Map(3, 3, 100).seed, Map(3, 3, 100).seed)
+
+
+class TestMaze(unittest.TestCase):
+    """ Map的迷宫：边界是墙，所有地块都是路；density=1时是一棵生成树（恰好打通地块数-1面墙），否则再随机拆掉一些内墙；总是连通。 """
+    @staticmethod
+    def n_reachable(maze):
+        """ 从左上角的地块出发能走到的路的格数。 """
+        seen = {(1, 1)}
+        queue = collections.deque(seen)
+        while queue:
+            r, c = queue.popleft()
+            for rn, cn in ((r + 1, c), (r - 1, c), (r, c + 1), (r, c - 1)):
+                if maze[rn, cn] and (rn, cn) not in seen:
+                    seen.add((rn, cn))
+                    queue.append((rn, cn))
+        return len(seen)
+
+    def check(self, rows_road, cols_road, density, seed):
+        m = Map(rows_road, cols_road, 100, density, seed=seed)
+        maze = m.maze
+        self.assertEqual(maze.shape, (rows_road * 2 + 1, cols_road * 2 + 1))
+        self.assertEqual(maze[0].sum() + maze[-1].sum() + maze[:, 0].sum() + maze[:, -1].sum(), 0)
+        self.assertTrue(maze[1::2, 1::2].all())
+        if density == 1.0:
+            self.assertEqual(maze[::2, ::2].sum(), 0)      # 生成树只打通地块之间的墙，墙的交点不会被打通。
+        n_roads = rows_road * cols_road
+        n_inner_walls = (m.rows - 2) * (m.cols - 2) - (n_roads * 2 - 1)
+        self.assertEqual(maze.sum() - n_roads, n_roads - 1 + int((1 - density) * n_inner_walls))
+        self.assertEqual(self.n_reachable(maze), maze.sum())
+
+    def test_perfect(self):
+        for rows_road, cols_road in ((1, 1), (1, 5), (7, 1), (10, 8), (60, 40)):
+            for seed in range(3):
+                self.check(rows_road, cols_road, 1.0, seed)
+
+    def test_simplified(self):
+        for seed in range(3):
+            self.check(10, 8, 0.9, seed)
+            self.check(40, 60, 0.97, seed)
+
+    def test_large(self):
+        self.check(200, 150, 0.97, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
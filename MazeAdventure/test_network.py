@@ -0,0 +1,403 @@
+"""
+功能：
+    网络层的测试：自适应压缩，客户端发件箱的合并，服务器发送队列中旧快照的丢弃，自适应的发送频率，
+    客户端的快照插值，房间的状态切换和断线玩家位置的保留。
+用法：
+    python -m pytest -q test_network.py    （或者 python -m unittest test_network）
+"""
+import os
+import socket
+import time
+import unittest
+import zlib
+
+import network
+from game import Game, Action
+
+
+def keyframe(game, tick):
+    content = game.get_snapshot()
+    content.update({'t': tick * 0.05, 'ack_seq': 0, 'ack_dt': 0.0, 'cells': game.get_map_cells()})
+    return ['GAMING', [tick, -1, content]]
+
+
+class TestCompressor(unittest.TestCase):
+    """ Compressor：压缩不划算的报文类型暂停压缩，之后定期试探，划算了再恢复。 """
+    def setUp(self):
+        # min_rate=0：只看省下的字节比例，结果不受机器快慢影响。
+        self.compressor = network.Compressor(threshold=64, min_rate=0, window=4, probe_every=5)
+
+    def test_small_message(self):
+        message = b'a' * 63
+        self.assertEqual(self.compressor.compress('ACK', message), (message, False))
+        self.assertEqual(self.compressor.stats(), {})
+
+    def test_compressible(self):
+        message = b'a' * 1024
+        for _ in range(10):
+            data, compressed = self.compressor.compress('MAP', message)
+            self.assertTrue(compressed)
+            self.assertEqual(zlib.decompress(data), message)
+        self.assertFalse(self.compressor.stats()['MAP']['paused'])
+
+    def test_pause_and_probe(self):
+        for _ in range(4):
+            message = os.urandom(1024)
+            self.assertEqual(self.compressor.compress('GAMING', message), (message, False))
+        stats = self.compressor.stats()['GAMING']
+        self.assertTrue(stats['paused'])
+        self.assertEqual(stats['n'], 4)
+
+        # 暂停后不再压缩，只有每第probe_every个报文试探一次。
+        for i in range(1, 11):
+            message = os.urandom(1024)
+            self.assertEqual(self.compressor.compress('GAMING', message), (message, False))
+            self.assertEqual(self.compressor.stats()['GAMING']['n'], 4 + i // 5)
+        self.assertTrue(self.compressor.stats()['GAMING']['paused'])
+
+        # 其他类型的报文不受影响。
+        self.assertTrue(self.compressor.compress('MAP', b'a' * 1024)[1])
+
+        # 报文变得可以压缩：在试探之前仍然不压缩，试探划算了就恢复。
+        message = b'a' * 1024
+        for _ in range(4):
+            self.assertEqual(self.compressor.compress('GAMING', message), (message, False))
+        data, compressed = self.compressor.compress('GAMING', message)
+        self.assertTrue(compressed)
+        self.assertEqual(zlib.decompress(data), message)
+        self.assertFalse(self.compressor.stats()['GAMING']['paused'])
+        self.assertTrue(self.compressor.compress('GAMING', message)[1])
+
+    def test_disabled(self):
+        self.compressor.enabled = False
+        message = b'a' * 1024
+        self.assertEqual(self.compressor.compress('MAP', message), (message, False))
+
+
+class TestOutbox(unittest.TestCase):
+    """ Outbox：多帧的动作合并成一批，同一玩家同一方向相邻的转向只保留最后一个。 """
+    def test_empty(self):
+        self.assertIsNone(network.Outbox().take(0))
+
+    def test_coalesce(self):
+        outbox = network.Outbox()
+        outbox.post(1, [Action(Action.MOVE_TURN, 1, 0, 0)])
+        outbox.post(2, [Action(Action.MOVE_UNTURN, 1, 0, 0), Action(Action.MOVE_TURN, 3, 0, 0)])
+        outbox.post(3, [Action(Action.OBJ_PICK, 0, 0, 0), Action(Action.OBJ_PICK, 0, 0, 0),
+                        Action(Action.MOVE_TURN, 1, 0, 0)])
+        outbox.post(4, [Action(Action.MOVE_TURN, 3, 0, 0)])
+        name, seq, actions = outbox.take(0)
+        self.assertEqual((name, seq), ('ACTIONS', 4))
+        # 方向1的按下被松开替换，又被拾取隔开；方向3的两次按下之间隔着其他方向，不合并。
+        self.assertEqual([(a.type, a.value) for a in actions],
+                         [(Action.MOVE_UNTURN, 1), (Action.MOVE_TURN, 3), (Action.OBJ_PICK, 0), (Action.OBJ_PICK, 0),
+                          (Action.MOVE_TURN, 1), (Action.MOVE_TURN, 3)])
+        self.assertEqual((outbox.n_posted, outbox.n_batches), (7, 1))
+        self.assertIsNone(outbox.take(0))
+
+    def test_same_direction(self):
+        outbox = network.Outbox()
+        for seq in range(5):
+            outbox.post(seq, [Action(Action.MOVE_TURN, 2, 1, 1), Action(Action.MOVE_UNTURN, 2, 1, 1)])
+        _, seq, actions = outbox.take(0)
+        self.assertEqual(seq, 4)
+        self.assertEqual([(a.type, a.value, a.target) for a in actions], [(Action.MOVE_UNTURN, 2, 1)])
+
+    def test_other_player(self):
+        # 不同玩家的转向互不合并。
+        outbox = network.Outbox()
+        outbox.post(1, [Action(Action.MOVE_TURN, 2, 0, 0), Action(Action.MOVE_TURN, 2, 1, 1)])
+        _, _, actions = outbox.take(0)
+        self.assertEqual([a.target for a in actions], [0, 1])
+
+
+class TestConnection(unittest.TestCase):
+    """ Connection的发送队列：快照只保留最新的一个，可靠的报文从不丢弃，已经发出一部分的快照不会被丢弃。 """
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+        self.b.setblocking(False)
+        self.conn = network.Connection(self.a, 0)
+        self.game = Game(2)
+
+    def use_tcp(self):
+        """ 换成TCP连接（socketpair可能只整包发送，TCP可以只发出一个数据包的一部分），缓冲区设小一些。 """
+        self.tearDown()
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.a = socket.socket()
+        self.a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        self.a.connect(listener.getsockname())
+        self.b = listener.accept()[0]
+        listener.close()
+        self.b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self.b.setblocking(False)
+        self.conn = network.Connection(self.a, 0)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def drain(self):
+        """ 发完发送队列，返回对方收到的所有报文。 """
+        reader = network.FrameReader()
+        messages = []
+        while True:
+            done = self.conn.flush()
+            try:
+                messages.extend(reader.read(self.b))
+            except BlockingIOError:
+                if done:
+                    return messages
+
+    def test_latest_wins(self):
+        self.conn.queue(keyframe(self.game, 1))
+        self.conn.queue(['MATCHING', 0])
+        self.conn.queue(keyframe(self.game, 2))
+        self.conn.queue(['PREPARING', [True, False]])
+        latest = network.Packet(keyframe(self.game, 3))
+        self.conn.queue(latest)
+        self.assertEqual(self.conn.n_dropped, 2)
+        self.assertEqual([item[0] for item in self.conn.outq], ['MATCHING', 'PREPARING', 'GAMING'])
+        self.assertEqual(self.conn.pending, sum(network.Packet(data).size for data in (
+            ['MATCHING', 0], ['PREPARING', [True, False]])) + latest.size)
+
+        messages = self.drain()
+        self.assertEqual([data[0] for data in messages], ['MATCHING', 'PREPARING', 'GAMING'])
+        self.assertEqual(messages[2][1][0], 3)
+        self.assertEqual(self.conn.pending, 0)
+
+    def test_partial_snapshot_kept(self):
+        # 对方不接收，直到发送缓冲区满、队首的快照只发出一部分。
+        self.use_tcp()
+        packet = network.Packet(keyframe(self.game, 1))
+        while True:
+            self.conn.queue(packet)
+            if not self.conn.flush():
+                break
+        if not self.conn.sending:
+            self.skipTest('发送缓冲区恰好在数据包的边界上填满')
+        head = self.conn.outq[0]
+        self.conn.queue(keyframe(self.game, 2))
+        self.assertEqual([item[0] for item in self.conn.outq], ['GAMING', 'GAMING'])
+        self.assertIs(self.conn.outq[0], head)
+        self.assertEqual(self.conn.n_dropped, 0)
+
+        # 收到的每个数据包都是完整的，最后一个是最新的快照。
+        messages = self.drain()
+        self.assertTrue(all(data[0] == 'GAMING' for data in messages))
+        self.assertEqual(messages[-1][1][0], 2)
+        self.assertEqual(self.conn.pending, 0)
+
+
+class TestSendRate(unittest.TestCase):
+    """ SendRate：客户端跟不上时降低发送频率（不低于1/max_interval），跟上后逐步恢复到广播频率。 """
+    def test_backoff_and_recover(self):
+        rate = network.SendRate(1 / 20, max_interval=0.2, backoff=1.5, step=2.0)
+        rate.adapt(True)
+        self.assertAlmostEqual(rate.interval, 0.075)
+        for _ in range(10):
+            rate.adapt(True)
+        self.assertEqual(rate.interval, 0.2)
+        self.assertEqual(rate.n_backoffs, 11)
+
+        # 每次频率增加step赫兹：5 -> 7 -> 9 -> ...，直到20赫兹。
+        rate.adapt(False)
+        self.assertAlmostEqual(1 / rate.interval, 7.0)
+        for _ in range(6):
+            rate.adapt(False)
+        self.assertAlmostEqual(1 / rate.interval, 19.0)
+        rate.adapt(False)
+        self.assertEqual(rate.interval, 1 / 20)
+        rate.adapt(False)
+        self.assertEqual(rate.interval, 1 / 20)
+
+    def test_due(self):
+        rate = network.SendRate(0.1)
+        self.assertTrue(rate.due(0.0))
+        rate.sent(1.0)
+        # 留半个广播周期的余量。
+        self.assertFalse(rate.due(1.04))
+        self.assertTrue(rate.due(1.05))
+        rate.adapt(True)
+        self.assertFalse(rate.due(1.09))
+        self.assertTrue(rate.due(1.1))
+        self.assertFalse(rate.due(1.1, rate.idle_interval))
+
+    def test_lobby(self):
+        rate = network.SendRate(0.1, lobby_interval=0.5)
+        self.assertTrue(rate.lobby(0.0, ('MATCHING', 0)))
+        self.assertFalse(rate.lobby(0.1, ('MATCHING', 0)))
+        self.assertTrue(rate.lobby(0.2, ('PREPARING', (False, False))))
+        self.assertFalse(rate.lobby(0.6, ('PREPARING', (False, False))))
+        self.assertTrue(rate.lobby(0.65, ('PREPARING', (False, False))))
+
+
+class TestSnapshotBuffer(unittest.TestCase):
+    """ SnapshotBuffer.sample：在延迟delay的服务器时刻，前后两个快照之间线性插值，之后的快照没到时有限度地外推。 """
+    OFFSET = -100.0     # 服务器时间 - 本地时间。
+
+    def setUp(self):
+        # 玩家0每个快照（0.05秒）向右走0.5格，玩家1不动。
+        self.buffer = network.SnapshotBuffer()
+        for k in range(5):
+            self.push(k * 0.05, [{'pos': (1.0 + 0.5 * k, 2.0)}, {'pos': (3.0, 4.0)}])
+
+    def push(self, t, explorers):
+        self.buffer.push({'t': t, 'explorers': explorers}, t - self.OFFSET)
+
+    def at(self, t):
+        """ 要画出服务器时刻t的位置，应该在本地的哪个时刻取样。 """
+        return self.buffer.sample(t - self.OFFSET + self.buffer.delay())
+
+    def test_offset_and_delay(self):
+        self.assertAlmostEqual(self.buffer.offset, self.OFFSET)
+        self.assertGreater(self.buffer.interval, 1 / 60)
+        self.assertEqual(self.buffer.delay(), max(self.buffer.min_delay, 2 * self.buffer.interval))
+
+    def test_interpolate(self):
+        positions = self.at(0.125)
+        self.assertAlmostEqual(positions[0][0], 2.25)
+        self.assertAlmostEqual(positions[0][1], 2.0)
+        self.assertEqual(positions[1], (3.0, 4.0))
+        self.assertAlmostEqual(self.at(0.1)[0][0], 2.0)
+
+    def test_before_first(self):
+        self.assertEqual(self.at(-1.0), {0: (1.0, 2.0), 1: (3.0, 4.0)})
+
+    def test_extrapolate(self):
+        # 最后一个快照在0.2秒（x=3.0），按最后两个快照的速度（10格/秒）外推，最多max_extrapolate秒。
+        self.assertAlmostEqual(self.at(0.23)[0][0], 3.3)
+        self.assertAlmostEqual(self.at(10.0)[0][0], 3.0 + 10 * self.buffer.max_extrapolate)
+
+    def test_hidden_and_new(self):
+        # 看不见的玩家不画；新出现的玩家直接画在它的位置上。
+        self.push(0.25, [{'pos': (3.5, 2.0)}, {'pos': (3.0, 4.0), 'visible': 0}])
+        self.push(0.3, [{'pos': (4.0, 2.0)}, {'pos': (5.0, 5.0)}])
+        positions = self.at(0.275)
+        self.assertAlmostEqual(positions[0][0], 3.75)
+        self.assertEqual(positions[1], (5.0, 5.0))
+        self.assertNotIn(1, self.at(0.25))
+
+    def test_server_time_goes_back(self):
+        self.push(0.2, [{'pos': (9.0, 9.0)}, {'pos': (9.0, 9.0)}])    # 重复的快照：忽略。
+        self.assertEqual(len(self.buffer.items), 5)
+        self.push(0.1, [{'pos': (9.0, 9.0)}, {'pos': (9.0, 9.0)}])    # 换了房间：重新开始。
+        self.assertEqual(len(self.buffer.items), 1)
+        self.assertEqual(self.buffer.sample(0.0), {0: (9.0, 9.0), 1: (9.0, 9.0)})
+
+    def test_empty(self):
+        buffer = network.SnapshotBuffer()
+        buffer.push({'explorers': [{'pos': (1.0, 1.0)}]}, 0.0)    # 没有服务器时间的快照：忽略。
+        self.assertEqual(buffer.sample(0.0), {})
+
+
+class FakeConnection:
+    """ 房间只用到连接的这些属性（发送由房间的send函数完成）。 """
+    def __init__(self, session):
+        self.session = session
+        self.id = None
+        self.room = None
+        self.pending = 0
+        self.link = network.LinkStats()
+
+
+class TestRoom(unittest.TestCase):
+    """ Room：人满进入PREPARING，最后一个READY立即开始游戏；游戏中断线的玩家，位置保留grace秒。 """
+    def setUp(self):
+        self.sent = []
+        self.room = network.Room(Game(2), lambda conn, data: self.sent.append((conn, data)), 20)
+        self.conns = [FakeConnection(100 + i) for i in range(2)]
+
+    def names(self, conn):
+        """ 发给conn的报文类型，并清空记录。 """
+        names = [(data.name if isinstance(data, network.Packet) else data[0]) for c, data in self.sent if c is conn]
+        self.sent = [(c, data) for c, data in self.sent if c is not conn]
+        return names
+
+    def play(self):
+        for conn in self.conns:
+            self.room.add(conn)
+        for conn in self.conns:
+            self.room.handle(conn.id, ['READY'])
+        self.assertEqual(self.room.mode, 'PLAYING')
+        self.sent = []
+
+    def test_match_prepare_play(self):
+        self.room.add(self.conns[0])
+        self.assertEqual(self.room.mode, 'MATCHING')
+        self.assertEqual(self.sent, [(self.conns[0], ['SESSION', 100]), (self.conns[0], ['MATCHING', 0])])
+        self.sent = []
+        self.room.add(self.conns[1])
+        self.assertEqual((self.room.mode, self.conns[1].id, self.conns[1].room), ('PREPARING', 1, self.room))
+        self.assertEqual(self.names(self.conns[0]), ['PREPARING'])
+        self.assertEqual(self.names(self.conns[1]), ['SESSION', 'MATCHING', 'PREPARING'])
+
+        self.room.handle(0, ['READY'])
+        self.room.handle(0, ['READY'])
+        self.assertEqual(self.room.mode, 'PREPARING')
+        self.assertEqual(self.room.client_ready, [True, False])
+        self.assertEqual(self.names(self.conns[0]), ['PREPARING'])
+        self.assertEqual(self.names(self.conns[1]), ['PREPARING'])
+
+        # 最后一个READY：不等下一个tick，立即开始并发出地图和关键帧。
+        self.room.handle(1, ['READY'])
+        self.assertEqual(self.room.mode, 'PLAYING')
+        for conn in self.conns:
+            self.assertEqual(self.names(conn), ['MAP', 'GAMING'])
+
+    def test_leave_while_preparing(self):
+        for conn in self.conns:
+            self.room.add(conn)
+        self.room.handle(0, ['READY'])
+        self.room.remove(self.conns[1])
+        self.assertEqual(self.room.mode, 'MATCHING')
+        self.assertEqual(self.room.client_token, [100, None])
+        # 再次人满时，所有人都要重新就绪。
+        self.room.add(FakeConnection(102))
+        self.assertEqual(self.room.mode, 'PREPARING')
+        self.assertEqual(self.room.client_ready, [False, False])
+        self.room.remove(self.room.slots[1])
+        self.room.remove(self.conns[0])
+        self.assertEqual(self.room.mode, 'CLOSED')
+
+    def test_grace(self):
+        self.play()
+        self.room.handle(1, ['ACTIONS', 1, [Action(Action.MOVE_TURN, 3, 1, 1)]])
+        self.room.remove(self.conns[1])
+        # 位置保留，人物停下，游戏照常进行。
+        self.assertEqual(self.room.mode, 'PLAYING')
+        self.assertIsNone(self.room.slots[1])
+        self.assertEqual(self.room.game.explorers[1].direction, [0, 0, 0, 0])
+        self.assertEqual(self.room.seat(101), 1)
+        self.assertIsNone(self.room.seat(999))
+        tick = self.room.tick
+        self.room.update(0.05)
+        self.assertEqual(self.room.tick, tick + 1)
+        self.assertEqual(self.room.seat(101), 1)
+
+        # 凭令牌重连：回到原来的位置，重新收到id、地图和关键帧。
+        conn = FakeConnection(None)
+        self.room.resume(conn, self.room.seat(101))
+        self.assertEqual((conn.id, conn.session, self.room.slots[1]), (1, 101, conn))
+        self.assertEqual(self.names(conn), ['SESSION', 'MATCHING', 'MAP', 'GAMING'])
+        self.assertEqual(self.room.client_lost, [None, None])
+
+    def test_grace_expired(self):
+        self.play()
+        self.room.remove(self.conns[1])
+        self.room.update(0.05)
+        self.assertEqual(self.room.seat(101), 1)
+        self.room.client_lost[1] = time.perf_counter() - self.room.grace - 1
+        self.room.update(0.05)
+        self.assertIsNone(self.room.seat(101))
+        self.assertEqual(self.room.client_token, [100, None])
+        self.assertEqual(self.room.mode, 'PLAYING')
+        # 最后一个人也离开（游戏中，同样保留位置），超时后房间关闭。
+        self.room.remove(self.conns[0])
+        self.assertEqual(self.room.mode, 'PLAYING')
+        self.room.client_lost[0] = time.perf_counter() - self.room.grace - 1
+        self.room.update(0.05)
+        self.assertEqual(self.room.mode, 'CLOSED')
+
+
+if __name__ == '__main__':
+    unittest.main()
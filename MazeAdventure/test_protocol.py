@@ -0,0 +1,171 @@
+"""
+功能：
+    报文格式的测试：每种报文编码后能原样解码，差分帧能还原出关键帧，
+    不完整或者损坏的报文（protocol.decode和network.FrameReader）只抛出ValueError.
+用法：
+    python -m pytest -q test_protocol.py    （或者 python -m unittest test_protocol）
+"""
+import socket
+import struct
+import unittest
+import zlib
+
+import protocol
+import network
+from game import Game, Action
+
+
+def round_trip(data):
+    return protocol.decode(protocol.encode(data))
+
+
+def frame_bytes(message, compressed=False):
+    """ 带前缀的数据包。 """
+    return network.header(message, compressed) + message
+
+
+class TestRoundTrip(unittest.TestCase):
+    """ 每种报文编码后再解码，得到相同的内容。 """
+    def test_simple(self):
+        for data in (['MATCHING', 3], ['MATCHING', -1], ['PREPARING', [True, False, True]],
+                     ['READY'], ['ACK', 42], ['ACK', -1], ['UDP', 123456, 40001], ['HELLO', 123456],
+                     ['PING', 7, 1.5], ['PONG', 7, 1.5], ['JOIN'], ['RESUME', 2 ** 48 - 1], ['SESSION', 12345]):
+            self.assertEqual(round_trip(data), data)
+
+    def test_map(self):
+        info = Game(2).get_map_info()
+        self.assertEqual(round_trip(['MAP', info]), ['MAP', info])
+
+    def test_actions(self):
+        actions = [Action(Action.MOVE_TURN, 2, 1, 1), Action(Action.OBJ_USE, 3, 0, 1, 5, -6)]
+        name, seq, decoded = round_trip(['ACTIONS', 9, actions])
+        self.assertEqual((name, seq), ('ACTIONS', 9))
+        self.assertEqual([(a.type, a.value, a.applier, a.target, a.args) for a in decoded],
+                         [(a.type, a.value, a.applier, a.target, a.args) for a in actions])
+
+    def test_keyframe(self):
+        game = Game(2)
+        content = game.get_snapshot()
+        content.update({'t': 0.5, 'ack_seq': 3, 'ack_dt': 0.25, 'cells': game.get_map_cells(),
+                        'net': [(20, 0), (None, 5)]})
+        name, (tick, base_tick, decoded) = round_trip(['GAMING', [10, -1, content]])
+        self.assertEqual((name, tick, base_tick), ('GAMING', 10, -1))
+        self.assertEqual(decoded['explorers'], content['explorers'])
+        self.assertEqual(decoded['net'], content['net'])
+        self.assertEqual(set(decoded['cells']), set(content['cells']))
+        for key in ('map_id', 'mode', 'winner', 'revision', 'events', 't', 'ack_seq', 'ack_dt'):
+            self.assertEqual(decoded[key], content[key], key)
+
+
+class TestDelta(unittest.TestCase):
+    """ 关键帧 + 差分帧 = 下一个关键帧。 """
+    def test_rebuild(self):
+        game = Game(2)
+        base = game.get_snapshot()
+        game.update_by_actions(0, [Action(Action.MOVE_TURN, 1, 0, 0)])
+        game.update_by_actions(1, [Action(Action.MOVE_TURN, 3, 1, 1), Action(Action.MOVE_TURN, 1, 1, 1)])
+        for _ in range(10):
+            game.update_by_dt(0.05)
+        cur = game.get_snapshot()
+        delta = game.diff_snapshot(base, cur)
+        self.assertIn('explorers', delta)
+
+        _, (_, _, base_decoded) = round_trip(['GAMING', [1, -1, base]])
+        _, (_, base_tick, delta_decoded) = round_trip(['GAMING', [2, 1, delta]])
+        _, (_, _, cur_decoded) = round_trip(['GAMING', [2, -1, cur]])
+        self.assertEqual(base_tick, 1)
+        rebuilt = game.patch_snapshot(base_decoded, delta_decoded)
+        for key in ('map_id', 'mode', 'winner', 'revision', 'events', 'explorers'):
+            self.assertEqual(rebuilt[key], cur_decoded[key], key)
+
+    def test_bag_slots(self):
+        # 背包按格子发送差分。
+        name = protocol.NAMES[1]
+        base = {'map_id': 0, 'mode': 'RUNNING', 'winner': -1, 'revision': 1, 'events': [],
+                'explorers': [{'pos': (1.0, 2.0), 'bag': (None, name, None)}]}
+        cur = {'map_id': 0, 'mode': 'RUNNING', 'winner': -1, 'revision': 2, 'events': [],
+               'explorers': [{'pos': (1.0, 2.0), 'bag': (name, None, None)}]}
+        delta = Game.diff_snapshot(base, cur)
+        self.assertEqual(delta['explorers'], {0: {'bag': {0: name, 1: None}}})
+        _, (_, _, delta_decoded) = round_trip(['GAMING', [2, 1, delta]])
+        self.assertEqual(Game.patch_snapshot(base, delta_decoded)['explorers'], cur['explorers'])
+
+
+class TestCorrupt(unittest.TestCase):
+    """ 不完整或者损坏的报文只抛出ValueError，不会抛出struct.error、IndexError等。 """
+    def messages(self):
+        game = Game(2)
+        content = game.get_snapshot()
+        content['cells'] = game.get_map_cells()
+        return [protocol.encode(data) for data in (
+            ['MATCHING', 1], ['PREPARING', [True, False]], ['MAP', game.get_map_info()],
+            ['GAMING', [1, -1, content]], ['ACK', 1], ['ACTIONS', 1, [Action(Action.OBJ_USE, 0, 0, 0, 1)]],
+            ['UDP', 1, 2], ['HELLO', 1], ['PING', 1, 0.0], ['PONG', 1, 0.0], ['RESUME', 1], ['SESSION', 1])]
+
+    def test_truncated(self):
+        for message in self.messages():
+            for n in range(len(message)):
+                with self.assertRaises(ValueError):
+                    protocol.decode(message[:n])
+
+    def test_out_of_range(self):
+        bad = [bytes([len(protocol.MSG_TYPES)]),
+               bytes([protocol.MSG_CODES['GAMING']]) + struct.pack('>IiBBbdIf', 1, -1, 0, 200, -1, 0, 0, 0),
+               # 关键帧里人物的下标不连续
+               bytes([protocol.MSG_CODES['GAMING']]) + struct.pack('>IiBBbdIf', 1, -1, protocol.F_EXPLORERS,
+                                                                    1, -1, 0, 0, 0) + bytes([1, 5, 0]),
+               bytes([protocol.MSG_CODES['GAMING']]) + struct.pack('>IiBBbdIf', 1, -1, protocol.F_EVENTS,
+                                                                    1, -1, 0, 0, 0) + bytes([1, 1, 0, 0, 250])]
+        for message in bad:
+            with self.assertRaises(ValueError):
+                protocol.decode(message)
+
+    def test_corrupt_bytes(self):
+        # 随便改动一个字节：要么仍然能解码，要么抛出ValueError.
+        for message in self.messages():
+            for i in range(len(message)):
+                data = bytearray(message)
+                data[i] ^= 0xFF
+                try:
+                    protocol.decode(bytes(data))
+                except ValueError:
+                    pass
+
+    def test_frame_reader(self):
+        message = protocol.encode(['ACTIONS', 1, [Action(Action.OBJ_USE, 0, 0, 0, 1)]])
+        bad = [frame_bytes(message[:-2]),                                   # 报文不完整
+               frame_bytes(zlib.compress(message)[:-3], compressed=True),    # 压缩的报文不完整
+               frame_bytes(b'not zlib data', compressed=True),             # 压缩的报文损坏
+               bytes([protocol.VERSION - 1]) + frame_bytes(message)[1:]]     # 版本不一致
+        for packet in bad:
+            a, b = socket.socketpair()
+            try:
+                a.sendall(packet)
+                with self.assertRaises(ValueError):
+                    network.FrameReader().read(b)
+            finally:
+                a.close()
+                b.close()
+
+    def test_frame_reader_split(self):
+        # 完整的数据包分多次到达，最后一次才拆出。
+        packets = b''.join(network.pack(['PING', 1, 2.0])) + b''.join(network.pack(['ACK', 5]))
+        reader = network.FrameReader(16)
+        a, b = socket.socketpair()
+        try:
+            messages = []
+            for i in range(len(packets)):
+                a.sendall(packets[i:i + 1])
+                messages.extend(reader.read(b))
+            self.assertEqual(messages, [['PING', 1, 2.0], ['ACK', 5]])
+        finally:
+            a.close()
+            b.close()
+
+    def test_datagram(self):
+        self.assertIsNone(network.unpack_datagram(frame_bytes(protocol.encode(['ACK', 1])[:-1])))
+        self.assertEqual(network.unpack_datagram(b''.join(network.pack(['ACK', 1]))), ['ACK', 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
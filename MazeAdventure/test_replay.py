@@ -0,0 +1,111 @@
+"""
+功能：
+    对局记录的测试：房间记录的一局，回放器跳到任意时刻得到的位置和实际对局中同一tick的位置相同。
+用法：
+    python -m pytest -q test_replay.py    （或者 python -m unittest test_replay）
+"""
+import glob
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import network
+import replay
+from game import Game, Action
+
+
+class FakeConnection:
+    def __init__(self, session):
+        self.session = session
+        self.id = None
+        self.room = None
+        self.pending = 0
+        self.link = network.LinkStats()
+
+
+class TestReplay(unittest.TestCase):
+    """ ReplayPlayer.seek：从最近的关键帧重新模拟到目标时刻，结果和实际对局一致。 """
+    FREQ = 20
+    N_TICKS = 12 * FREQ     # 12秒，跨过两个关键帧（每5秒一个）。
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        room = network.Room(Game(2, seed=3), lambda conn, data: None, cls.FREQ, record_dir=cls.dir)
+        for i in range(2):
+            room.add(FakeConnection(i + 1))
+        for i in range(2):
+            room.handle(i, ['READY'])
+        # 随机的转向动作，记下每个tick实际的位置。
+        rng = random.Random(1)
+        cls.positions = dict()
+        cls.first_tick = room.tick
+        cls.positions[room.tick] = [state['pos'] for state in room.snapshots[room.tick]['explorers']]
+        for _ in range(cls.N_TICKS):
+            for i in range(2):
+                if rng.random() < 0.2:
+                    room.handle(i, ['ACTIONS', 0, [Action(rng.choice((Action.MOVE_TURN, Action.MOVE_UNTURN)),
+                                                          rng.randrange(4), i, i)]])
+            room.step(1 / cls.FREQ)
+            cls.positions[room.tick] = [state['pos'] for state in room.snapshots[room.tick]['explorers']]
+        with room.game.lock:
+            room.game.mode = 'GAMEOVER'
+        room.step(1 / cls.FREQ)
+        cls.last_tick = room.tick
+        cls.path = glob.glob(os.path.join(cls.dir, '*.replay'))[0]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def assertLive(self, player):
+        """ 回放的游戏和实际对局在同一tick的位置相同（关键帧里的坐标有舍入）。 """
+        for explorer, (x, y) in zip(player.game.explorers, self.positions[player.tick]):
+            self.assertAlmostEqual(explorer.x, x, places=3)
+            self.assertAlmostEqual(explorer.y, y, places=3)
+
+    def test_index(self):
+        player = replay.ReplayPlayer(self.path)
+        self.assertTrue(player.finished)
+        self.assertEqual((player.freq, player.n_players), (self.FREQ, 2))
+        self.assertEqual(len(player.keyframes), 3)
+        self.assertEqual((player.first_tick, player.last_tick), (self.first_tick, self.last_tick))
+        self.assertAlmostEqual(player.duration, (self.last_tick - self.first_tick) / self.FREQ)
+
+    def test_seek(self):
+        player = replay.ReplayPlayer(self.path)
+        # 关键帧上、关键帧之间、往回跳、继续往后跳。
+        for t in (0.0, 5.0, 2.35, 7.2, 11.95, 4.95, 5.05, 0.5):
+            player.seek(t)
+            self.assertEqual(player.tick, player.first_tick + round(t * self.FREQ))
+            self.assertLive(player)
+        # 超出范围的时刻停在两端。
+        player.seek(-1.0)
+        self.assertEqual(player.tick, player.first_tick)
+        player.seek(100.0)
+        self.assertEqual(player.tick, player.last_tick)
+
+    def test_play(self):
+        player = replay.ReplayPlayer(self.path)
+        player.seek(0.0)
+        while player.tick < self.first_tick + self.N_TICKS:
+            player.step()
+            self.assertLive(player)
+
+    def test_truncated(self):
+        # 服务器异常退出：文件末尾的记录不完整，读取时忽略，前面的部分仍然可以回放。
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        path = os.path.join(self.dir, 'truncated.replay')
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) * 2 // 3])
+        player = replay.ReplayPlayer(path)
+        self.assertFalse(player.finished)
+        player.seek(6.0)
+        self.assertLive(player)
+
+
+if __name__ == '__main__':
+    unittest.main()